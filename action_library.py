@@ -0,0 +1,239 @@
+"""コンパイル済みアクションライブラリ（バイナリ）の作成と読み込み
+
+ファイル形式（リトルエンディアン）:
+    ヘッダ（64バイト） LIBRARY_HEADER_DTYPE
+    索引（80バイト × アクション数） LIBRARY_INDEX_DTYPE（名前のバイト列順に並べる）
+    フレーム（int16 × 6 × 全フレーム数） 全アクションの軌道を連結したもの
+
+読み込み時はファイルをメモリマップし、各アクションの軌道はコピーせずに
+そのままNumPyのビュー（書き換え不可）として返す。索引は二分探索するので、
+起動時・リクエストごとのI/Oはアクション数に関係なく一定。
+
+    python action_library.py robotaction.json   # ビルドだけ行う
+"""
+import asyncio
+import hashlib
+import mmap
+import os
+import sys
+from functools import lru_cache
+import numpy as np
+from trajectory import NUM_JOINTS
+
+LIBRARY_MAGIC = b"RALB"
+LIBRARY_VERSION = 1
+LIBRARY_EXTENSION = ".actlib"
+NAME_SIZE = 64
+# ソースファイルの変更を確認する間隔（秒）
+WATCH_INTERVAL = 1.0
+
+LIBRARY_HEADER_DTYPE = np.dtype([
+    ("magic", "S4"),
+    ("version", "<u2"),
+    ("joints", "<u2"),
+    ("count", "<u4"),
+    ("reserved", "<u4"),
+    ("source_mtime_ns", "<i8"),
+    ("source_size", "<i8"),
+    ("params", "S32"),  # 軌道生成パラメータのハッシュ
+])
+LIBRARY_INDEX_DTYPE = np.dtype([
+    ("name", f"S{NAME_SIZE}"),
+    ("offset", "<u8"),  # 先頭からのフレーム番号
+    ("length", "<u4"),  # フレーム数
+    ("order", "<u4"),  # ソースでの並び順
+])
+
+
+def library_path(source):
+    """ソースJSONに対応するライブラリファイルのパス"""
+    return os.path.splitext(source)[0] + LIBRARY_EXTENSION
+
+
+def params_key(params):
+    """軌道生成パラメータ（補間方法・周期・初期位置など）を固定長のキーにする"""
+    return hashlib.sha256(repr(params).encode("utf-8")).hexdigest()[:32].encode("ascii")
+
+
+def write_library(path, trajectories, source_mtime_ns=0, source_size=0, params=None):
+    """{アクション名: (frames, 6) の軌道} をライブラリファイルに書き出す
+
+    一時ファイルに書いてから置き換えるので、読み込み中のプロセスが壊れたファイルを見ることはない。
+    """
+    order = {name: i for i, name in enumerate(trajectories)}
+    names = sorted(trajectories, key=lambda name: name.encode("utf-8"))
+    index = np.zeros(len(names), dtype=LIBRARY_INDEX_DTYPE)
+    frames = []
+    offset = 0
+    for i, name in enumerate(names):
+        encoded = name.encode("utf-8")
+        if len(encoded) > NAME_SIZE:
+            raise ValueError(f"アクション名が長すぎます（{NAME_SIZE}バイトまで）: {name}")
+        trajectory = np.asarray(trajectories[name], dtype="<i2").reshape(-1, NUM_JOINTS)
+        index[i] = (encoded, offset, len(trajectory), order[name])
+        frames.append(trajectory)
+        offset += len(trajectory)
+    header = np.zeros(1, dtype=LIBRARY_HEADER_DTYPE)
+    header[0] = (LIBRARY_MAGIC, LIBRARY_VERSION, NUM_JOINTS, len(names), 0,
+                 source_mtime_ns, source_size, params_key(params))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.tobytes())
+        f.write(index.tobytes())
+        for trajectory in frames:
+            f.write(trajectory.tobytes())
+    os.replace(tmp_path, path)
+
+
+class ActionLibrary:
+    """メモリマップしたアクションライブラリ。library[name] で軌道のビューを返す"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < LIBRARY_HEADER_DTYPE.itemsize:
+            raise ValueError(f"アクションライブラリが壊れています: {path}")
+        self.header = np.frombuffer(self._mmap, dtype=LIBRARY_HEADER_DTYPE, count=1)[0]
+        if self.header["magic"] != LIBRARY_MAGIC or self.header["version"] != LIBRARY_VERSION:
+            raise ValueError(f"アクションライブラリの形式が違います: {path}")
+        if self.header["joints"] != NUM_JOINTS:
+            raise ValueError(f"関節数が違います: {self.header['joints']}")
+        count = int(self.header["count"])
+        self._index = np.frombuffer(self._mmap, dtype=LIBRARY_INDEX_DTYPE, count=count,
+                                    offset=LIBRARY_HEADER_DTYPE.itemsize)
+        frames_offset = LIBRARY_HEADER_DTYPE.itemsize + LIBRARY_INDEX_DTYPE.itemsize * count
+        total = int(self._index["length"].sum()) if count else 0
+        if len(self._mmap) < frames_offset + total * NUM_JOINTS * 2:
+            raise ValueError(f"アクションライブラリが壊れています: {path}")
+        self._frames = np.frombuffer(self._mmap, dtype="<i2", count=total * NUM_JOINTS,
+                                     offset=frames_offset).reshape(total, NUM_JOINTS)
+
+    def is_current(self, source_mtime_ns, source_size, params):
+        return (int(self.header["source_mtime_ns"]) == source_mtime_ns
+                and int(self.header["source_size"]) == source_size
+                and self.header["params"] == params_key(params))
+
+    def names(self):
+        """アクション名をソースでの並び順で返す"""
+        ordered = self._index["name"][np.argsort(self._index["order"])]
+        return [name.decode("utf-8") for name in ordered]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def _find(self, name):
+        encoded = name.encode("utf-8")
+        i = int(np.searchsorted(self._index["name"], encoded))
+        if i < len(self._index) and self._index["name"][i] == encoded:
+            return self._index[i]
+        return None
+
+    def __getitem__(self, name):
+        entry = self._find(name)
+        if entry is None:
+            raise ValueError(f"未定義のactionです: {name}")
+        offset = int(entry["offset"])
+        return self._frames[offset:offset + int(entry["length"])]
+
+
+def build_library(source, path, compile_fn, params, load_fn):
+    """ソースの全アクションを compile_fn(name, data) で軌道にしてライブラリを書き出す"""
+    stat = os.stat(source)
+    data = load_fn(source)
+    trajectories = {name: compile_fn(name, data) for name in data}
+    write_library(path, trajectories, stat.st_mtime_ns, stat.st_size, params)
+    print(f"アクションライブラリを作成しました: {path}（{len(trajectories)}件）")
+
+
+@lru_cache(maxsize=8)
+def _open_library(source, path, mtime_ns, size, params, compile_fn, load_fn):
+    try:
+        library = ActionLibrary(path)
+        if library.is_current(mtime_ns, size, params):
+            return library
+    except (OSError, ValueError):
+        pass
+    build_library(source, path, compile_fn, params, load_fn)
+    return ActionLibrary(path)
+
+
+def open_library(source, params, compile_fn, load_fn, path=None):
+    """ソースJSONに対応するライブラリを開く。無い・古い・パラメータが違うときは作り直す
+
+    params は軌道生成パラメータ（ハッシュ可能なタプル）、compile_fn(name, data) は1アクションの軌道を返す関数。
+    ソースの更新時刻とサイズでメモ化するので、変更が無い間はリクエストごとに stat 1回だけで済む。
+    """
+    path = path or library_path(source)
+    stat = os.stat(source)
+    return _open_library(source, path, stat.st_mtime_ns, stat.st_size, params, compile_fn, load_fn)
+
+
+class LibraryWatcher:
+    """ソースファイルを監視し、変更されたら load() し直して current を差し替える
+
+    差し替えは参照の代入1回なので、実行中のリクエストは古いものを最後まで使い、
+    次のリクエストから新しいものを使う。読み込み・検証に失敗したら前のものを使い続ける。
+    """
+
+    def __init__(self, source, load, interval=WATCH_INTERVAL):
+        self.source = source
+        self.load = load
+        self.interval = interval
+        self.current = None
+        self._stat = None
+        self._task = None
+
+    def _stat_key(self):
+        stat = os.stat(self.source)
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self):
+        # 読み込み中に書き換えられたら、次の確認でもう一度読み込む
+        key = self._stat_key()
+        current = self.load()
+        self.current = current
+        self._stat = key
+        return current
+
+    async def start(self):
+        """最初の読み込みを行い（失敗したら例外）、監視を始める"""
+        if self.current is None:
+            self.reload()
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                key = self._stat_key()
+            except OSError:
+                # 保存中に一時的に消えていることがある
+                continue
+            if key == self._stat:
+                continue
+            try:
+                await asyncio.to_thread(self.reload)
+                print(f"[WATCH] {self.source} を再読み込みしました")
+            except Exception as e:
+                # 同じ内容で失敗し続けないよう、次に変更されるまで待つ
+                self._stat = key
+                print(f"[WATCH] {self.source} の再読み込みに失敗しました。前の定義を使い続けます: {e}")
+
+
+if __name__ == "__main__":
+    import robotactionBLE
+    source = sys.argv[1] if len(sys.argv) > 1 else robotactionBLE.ACTION_FILE
+    library = robotactionBLE.get_action_library(source)
+    print(f"{library.path}: {', '.join(library.names())}")
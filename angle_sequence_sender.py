@@ -1,27 +1,52 @@
 import asyncio
 import sys
-import time
 import json
-import numpy as np
 import os
-from bleak import BleakClient, BleakScanner
+from transport import get_transport
+from trajectory import compile_waypoints
+from action_library import open_library
+from protocol import (
+    PROTOCOL_BINARY,
+    PROTOCOL_BATCH,
+    PROTOCOL_STREAM,
+    PROTOCOL_CAPS_DELTA,
+    has_capability,
+    is_device_packet,
+    parse_protocol_caps,
+    read_protocol_caps,
+)
+from streaming import (
+    FlowController,
+    FrameEncoder,
+    PacedScheduler,
+    can_send_batched,
+    send_paced_frames,
+    send_trajectory_batched,
+    send_trajectory_flow_controlled,
+)
 
 # 設定パラメータ
 CONFIG = {
     "angle_file": "angle_sequences.json",  # 制御角のセットが保存されているファイル
-    "interpolated_file": "interpolated_angles.json",  # 補間された角度を保存するファイル
+    "interpolated_file": "interpolated_angles.actlib",  # 補間された角度を保存するファイル（バイナリのライブラリ）
     "minimum_step": 10,  # 角度の最小ステップ（度）
     "delay_between_steps": 0.02,  # ステップ間の遅延（秒）
     "delay_between_sequences": 1.0,  # シーケンス間の遅延（秒）
     "repeat_count": 3,  # シーケンスの繰り返し回数（-1で無限ループ）
+    "protocol": "auto",  # 送信フォーマット（"auto"でファームウェアと交渉、"ascii"、"binary"、"batch"、"stream"）
     "ble_device_name": "ESP32 BLE Device",  # BLEデバイス名
     "ble_characteristic_uuid": "beb5483e-36e1-4688-b7f5-ea07361b26a8"  # BLEキャラクタリスティックUUID
 }
 
+# 状態通知によるフロー制御
+flow_controller = FlowController()
+
 # BLE通知ハンドラ
 def notification_handler(sender, data):
-    """BLEデバイスからの通知を処理する"""
-    print(f"BLEデバイスからの通知: {data.decode()}")
+    """BLEデバイスからの通知を処理する（状態通知はフロー制御に渡す）"""
+    if flow_controller.handle_notification(sender, data) or is_device_packet(data):
+        return
+    print(f"BLEデバイスからの通知: {data.decode(errors='replace')}")
 
 def load_angle_sequences(filename):
     """JSONファイルから角度シーケンスを読み込む"""
@@ -34,72 +59,27 @@ def load_angle_sequences(filename):
         print(f"エラー: 角度シーケンスファイルの読み込みに失敗しました: {e}")
         sys.exit(1)
 
-def interpolate_angles(start_angles, end_angles, min_step):
-    """2つの角度セット間を最小ステップで分割する"""
-    # 各サーボの角度差の最大値を計算
-    max_diff = max([abs(end - start) for start, end in zip(start_angles, end_angles)])
-    
-    # 必要なステップ数を計算（最小ステップで分割）
-    steps = max(1, int(np.ceil(max_diff / min_step)))
-    
-    # 各ステップの角度を計算
-    angle_steps = []
-    for i in range(steps + 1):
-        # 線形補間
-        t = i / steps
-        interpolated = [int(start + (end - start) * t) for start, end in zip(start_angles, end_angles)]
-        angle_steps.append(interpolated)
-    
-    return angle_steps
+def _interpolate_sequence(name, sequences):
+    print(f"シーケンス '{name}' を補間中...")
+    # 最初の角度セットはそのまま、以降は各区間を補間して連結（1回のベクトル演算）
+    return compile_waypoints(sequences[name], CONFIG["minimum_step"])
+
+def load_interpolated_angles():
+    """補間済みのライブラリを開く（角度ファイルか最小ステップが変わっていれば作り直す）"""
+    return open_library(CONFIG["angle_file"], ("linear", CONFIG["minimum_step"]),
+                        _interpolate_sequence, load_angle_sequences, CONFIG["interpolated_file"])
 
 def generate_all_interpolated_angles():
-    """すべての角度シーケンスを補間して別ファイルに保存する"""
-    # 角度シーケンスを読み込む
-    sequences = load_angle_sequences(CONFIG["angle_file"])
-    
-    # 補間結果を格納する辞書
-    all_interpolated = {}
-    
-    # 各シーケンスを処理
-    for name, sequence in sequences.items():
-        print(f"シーケンス '{name}' を補間中...")
-        
-        # このシーケンスの補間結果
-        interpolated_sequence = []
-        
-        # 前の角度セットを保存（最初はNone）
-        prev_angles = None
-        
-        for i, angles in enumerate(sequence):
-            # 前の角度セットがある場合は補間
-            if prev_angles is not None:
-                interpolated_steps = interpolate_angles(prev_angles, angles, CONFIG["minimum_step"])
-                # 最初のステップは前の角度と同じなのでスキップ
-                interpolated_sequence.extend(interpolated_steps[1:])
-            else:
-                # 最初の角度セットはそのまま追加
-                interpolated_sequence.append(angles)
-            
-            # 現在の角度を保存
-            prev_angles = angles
-        
-        # この補間シーケンスを結果に追加
-        all_interpolated[name] = interpolated_sequence
-    
-    # 補間結果をファイルに保存
-    with open(CONFIG["interpolated_file"], 'w') as f:
-        json.dump(all_interpolated, f, indent=2)
-    
-    print(f"補間された角度シーケンスを保存しました: {CONFIG['interpolated_file']}")
-    
-    return all_interpolated
+    """すべての角度シーケンスを補間して別ファイルに保存し、{名前: 軌道のビュー} を返す"""
+    library = load_interpolated_angles()
+    print(f"補間された角度シーケンス: {CONFIG['interpolated_file']}")
+    return {name: library[name] for name in library.names()}
 
 async def execute_interpolated_angles():
     """補間された角度シーケンスを実行する"""
-    # 補間された角度シーケンスを読み込む
+    # 補間された角度シーケンスをメモリマップで読み込む
     try:
-        with open(CONFIG["interpolated_file"], 'r') as f:
-            all_interpolated = json.load(f)
+        all_interpolated = generate_all_interpolated_angles()
     except Exception as e:
         print(f"エラー: 補間された角度ファイルの読み込みに失敗しました: {e}")
         return
@@ -108,7 +88,8 @@ async def execute_interpolated_angles():
     
     # BLEデバイスを検索
     print(f"'{CONFIG['ble_device_name']}'を検索中...")
-    device = await BleakScanner.find_device_by_name(CONFIG["ble_device_name"])
+    transport = get_transport()
+    device = await transport.find_device(CONFIG["ble_device_name"])
     
     if not device:
         print(f"エラー: '{CONFIG['ble_device_name']}'が見つかりません")
@@ -118,15 +99,38 @@ async def execute_interpolated_angles():
     
     # BLEデバイスに接続
     try:
-        async with BleakClient(device) as client:
+        async with transport.create_client(device) as client:
             print(f"{device.name}に接続しました")
             
             # 通知を受信するためのハンドラを設定
             await client.start_notify(CONFIG["ble_characteristic_uuid"], notification_handler)
             
+            # 送信フォーマットを決定（DLT1対応なら変わった関節だけの差分フレームで送る）
+            caps = await read_protocol_caps(client, CONFIG["ble_characteristic_uuid"])
+            delta = has_capability(caps, PROTOCOL_CAPS_DELTA)
+            protocol = CONFIG["protocol"]
+            if protocol == "auto":
+                protocol = parse_protocol_caps(caps)
+            if protocol in (PROTOCOL_BATCH, PROTOCOL_STREAM) and not can_send_batched(client):
+                protocol = PROTOCOL_BINARY
+            print(f"送信フォーマット: {protocol}{'（差分）' if delta else ''}")
+            write_kind = "ascii" if protocol == "ascii" else "binary"
+            
+            # 各シーケンスを事前にフレーム化
+            all_frames = {
+                name: FrameEncoder(sequence, protocol, delta=delta)
+                for name, sequence in all_interpolated.items()
+            }
+            
+            # 繰り返し全体を1本の時間軸で送る（締め切りベースなので遅れが積み重ならない）
+            scheduler = PacedScheduler(CONFIG["delay_between_steps"])
+            
             # 繰り返し回数
             repeat = CONFIG["repeat_count"]
             count = 0
+            # シーケンス番号はシーケンス・繰り返しをまたいで続ける（前のシーケンスの状態通知が遅れて
+            # 届いても、新しいシーケンスの再生済みフレームと取り違えないように）
+            seq = 0
             
             while repeat == -1 or count < repeat:
                 if repeat != -1:
@@ -137,29 +141,43 @@ async def execute_interpolated_angles():
                 for name, interpolated_sequence in all_interpolated.items():
                     print(f"\n=== シーケンス '{name}' を開始 ({len(interpolated_sequence)}ステップ) ===")
                     
-                    for i, angles in enumerate(interpolated_sequence):
-                        if i % 10 == 0 or i == len(interpolated_sequence) - 1:  # 10ステップごとに進捗表示
-                            print(f"ステップ {i+1}/{len(interpolated_sequence)}")
-                        
-                        # 角度を文字列に変換
-                        angle_str = ' '.join(map(str, angles))
-                        
+                    if protocol in (PROTOCOL_BATCH, PROTOCOL_STREAM):
+                        # MTUサイズのバッチでまとめて送信（再生はファームウェアのタイマー）
                         try:
-                            # BLEでデータを送信
-                            await client.write_gatt_char(CONFIG["ble_characteristic_uuid"], angle_str.encode('utf-8'))
-                            print(f"送信: {angle_str}")
+                            if protocol == PROTOCOL_STREAM:
+                                # 応答なし書き込み + 状態通知によるフロー制御
+                                writes = await send_trajectory_flow_controlled(
+                                    client, CONFIG["ble_characteristic_uuid"], interpolated_sequence,
+                                    int(CONFIG["delay_between_steps"] * 1000), flow_controller, seq, delta=delta)
+                            else:
+                                writes = await send_trajectory_batched(
+                                    client, CONFIG["ble_characteristic_uuid"], interpolated_sequence,
+                                    int(CONFIG["delay_between_steps"] * 1000), seq, delta=delta)
+                            print(f"{writes}回の書き込みで送信しました")
                         except Exception as e:
                             print(f"送信エラー: {e}")
-                            # エラーが発生した場合はファイルに保存
-                            with open("failed_angles.txt", "a") as f:
-                                f.write(f"{angle_str}\n")
-                            print(f"送信に失敗した角度をfailed_angles.txtに保存しました")
-                        
-                        # 次のステップまで待機
-                        await asyncio.sleep(CONFIG["delay_between_steps"])
+                        seq = (seq + len(interpolated_sequence)) & 0xFFFF
+                        print(f"=== シーケンス '{name}' 完了 ===\n")
+                        await asyncio.sleep(CONFIG["delay_between_sequences"])
+                        continue
+                    
+                    encoder = all_frames[name]
+                    encoder.reset()
+                    
+                    def on_sent(i, frame):
+                        if i % 10 == 0 or i == len(interpolated_sequence) - 1:  # 10ステップごとに進捗表示
+                            print(f"ステップ {i+1}/{len(interpolated_sequence)}")
+                    
+                    # 直前と同じ姿勢のフレームは書き込まない（送信周期はそのまま）。
+                    # 書き込みに失敗したら次の締め切りで最新の姿勢を送り、続けて失敗したら中断する
+                    await send_paced_frames(client, CONFIG["ble_characteristic_uuid"], encoder, scheduler,
+                                            write_kind, on_sent)
                     
                     print(f"=== シーケンス '{name}' 完了 ===\n")
-                    await asyncio.sleep(CONFIG["delay_between_sequences"])
+                    # シーケンス間の待ちも締め切りをずらして表現する
+                    scheduler.delay(CONFIG["delay_between_sequences"])
+            
+            print(f"送信タイミング: {scheduler.stats.summary()}")
             
             # 通知の受信を停止
             await client.stop_notify(CONFIG["ble_characteristic_uuid"])
@@ -0,0 +1,364 @@
+"""シミュレーションデバイスを使ったエンドツーエンドのベンチマーク
+
+    python benchmark.py                       # 全項目を実行して benchmark_results.json に保存
+    python benchmark.py --only compile encode # 一部だけ実行
+    python benchmark.py --compare old.json    # 前回の結果と比較して表示
+
+計測項目:
+- compile : 軌道生成（線形補間 / 台形プロファイル）の時間と、経由点数・ステップ幅の関係
+- encode  : アクションごとのフレーム数・送信バイト数・書き込み回数（ASCII / BIN1 / BAT1 / 差分 DLT1）
+- kinematics : 逆運動学で直線経路（送信周期ごとの点）を解く時間と、キャッシュから返す時間、
+               初期位置から届く点への /move_to の軌道（直線 / 関節ごと / 失敗の件数と計算時間）
+- stream  : 各プロトコルで実際に再生されたフレームレートとフレーム間隔のジッタ
+- api     : N個の同時クライアントから /action を送ったときの、リクエストから最初のフレームまでの時間
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+
+# API・スクリプトはすべてシミュレーションデバイスにつなぐ
+os.environ.setdefault("ROBOTARM_TRANSPORT", "sim")
+
+import robotactionBLE
+import simulated_esp32
+from ble_manager import BLEConnectionManager
+from kinematics import ArmKinematics, UnreachableError
+from planner import plan_waypoints
+from protocol import encode_frames, encode_batch_frames, encode_delta_batch_frames, PROTOCOL_ASCII, PROTOCOL_BINARY
+from streaming import FrameEncoder
+from trajectory import compile_waypoints, load_actions
+from transport import SimulatedTransport
+
+DEFAULT_OUTPUT = "benchmark_results.json"
+# api で受け付けられたアクションがすべて終わるのを待つ上限（秒）
+API_WAIT_TIMEOUT = 120.0
+
+# プロトコルとファームウェアが公開する対応プロトコルの対応
+PROTOCOL_CAPS = {
+    "ascii": b"",
+    "binary": b"PROTO ASCII BIN1",
+    "batch": b"PROTO ASCII BIN1 BAT1",
+    "stream": b"PROTO ASCII BIN1 BAT1 FLOW1",
+    "binary_delta": b"PROTO ASCII BIN1 DLT1",
+    "stream_delta": b"PROTO ASCII BIN1 BAT1 FLOW1 DLT1",
+}
+
+
+def _quiet():
+    """計測中の送信ログ（print）を捨てる（コンソール出力で計測が歪まないように）。計測の区間だけで使う"""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def _timeit(func, repeat):
+    """最小実行時間（秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_compile(repeat=20):
+    """経由点数とステップ幅を変えて軌道生成の時間を測る"""
+    rng = np.random.default_rng(0)
+    results = []
+    for waypoints in (2, 10, 100, 1000):
+        wp = rng.integers([0, 30, 30, 30, 0, 0], [270, 240, 240, 240, 180, 180], size=(waypoints, 6))
+        for min_step in (1, 5, 10):
+            frames = len(compile_waypoints(wp, min_step))
+            results.append({
+                "method": "linear",
+                "waypoints": waypoints,
+                "min_step": min_step,
+                "frames": frames,
+                "seconds": _timeit(lambda: compile_waypoints(wp, min_step), repeat),
+            })
+        for interval in (0.01, 0.02):
+            frames = len(plan_waypoints(wp, interval)[1])
+            results.append({
+                "method": "trapezoid",
+                "waypoints": waypoints,
+                "interval": interval,
+                "frames": frames,
+                "seconds": _timeit(lambda: plan_waypoints(wp, interval), repeat),
+            })
+    return results
+
+
+def bench_encode(mtu=247):
+    """アクションごとのフレーム数・バイト数・書き込み回数"""
+    results = []
+    interval_ms = int(robotactionBLE.DELAY_BETWEEN_STEPS * 1000)
+    for name in load_actions():
+        trajectory = robotactionBLE.compile_action_sequence(name)
+        ascii_frames = encode_frames(trajectory, PROTOCOL_ASCII)
+        binary_frames = encode_frames(trajectory, PROTOCOL_BINARY)
+        batches = encode_batch_frames(trajectory, interval_ms, mtu)
+        delta_batches = encode_delta_batch_frames(trajectory, interval_ms, mtu)
+        # 遅れてフレームを飛ばすことはないものとして、1フレームずつ送る経路で実際に書き込むフレーム
+        encoder = FrameEncoder(trajectory, PROTOCOL_BINARY, delta=True)
+        delta_frames = [frame for frame in map(encoder.frame, range(len(encoder))) if frame is not None]
+        results.append({
+            "action": name,
+            "frames": len(trajectory),
+            "ascii_bytes": sum(map(len, ascii_frames)),
+            "binary_bytes": sum(map(len, binary_frames)),
+            "batch_bytes": sum(map(len, batches)),
+            "batch_writes": len(batches),
+            "delta_frames": len(delta_frames),
+            "delta_bytes": sum(map(len, delta_frames)),
+            "delta_batch_bytes": sum(map(len, delta_batches)),
+            "delta_batch_writes": len(delta_batches),
+        })
+    return results
+
+
+def bench_kinematics(repeat=5):
+    """送信周期ごとの点に分けた直線経路を逆運動学で解く時間（送信周期より十分短ければ、経路をその場で解いて送れる）"""
+    kinematics = ArmKinematics()
+    start = np.asarray(robotactionBLE.INIT_POSITION, dtype=np.float64)
+    start_position, start_pitch = kinematics.forward(start)
+    goal = start_position + np.array([80.0, 60.0, -10.0])
+    results = []
+    for points in (10, 100, 1000):
+        path = start_position + np.linspace(0, 1, points)[:, None] * (goal - start_position)
+        for pitch in (None, start_pitch):
+            def solve():
+                # キャッシュを使わずに解く時間
+                kinematics._solve(path, None if pitch is None else np.full(points, pitch), start, None, None)
+            kinematics.inverse(path, pitch, start)
+            seconds = _timeit(solve, repeat)
+            results.append({
+                "points": points,
+                "pitch": "free" if pitch is None else "fixed",
+                "seconds": seconds,
+                "per_point_us": seconds / points * 1e6,
+                "cached_seconds": _timeit(lambda: kinematics.inverse(path, pitch, start), repeat),
+                "path_seconds": points * robotactionBLE.DELAY_BETWEEN_STEPS,
+            })
+    return results
+
+
+def bench_move_to(targets=200, seed=0):
+    """初期位置（どのアクションもここに戻る）から、届く点へ /move_to の軌道を作る
+
+    直線で動かせた件数・関節ごとの移動に切り替えた件数・作れなかった件数（0 のはず）と計算時間。
+    """
+    rng = np.random.default_rng(seed)
+    start = robotactionBLE.INIT_POSITION
+    counts = {"linear": 0, "joint": 0, "failed": 0}
+    seconds = []
+    while len(seconds) < targets:
+        position = rng.uniform([-200.0, -200.0, 0.0], [250.0, 250.0, 250.0])
+        try:
+            robotactionBLE.KINEMATICS.inverse(position, None, start)
+        except UnreachableError:
+            continue
+        t0 = time.perf_counter()
+        try:
+            with _quiet() as log:
+                robotactionBLE.compile_move_to(position, start_position=start)
+            counts["joint" if log.getvalue() else "linear"] += 1
+        except UnreachableError:
+            counts["failed"] += 1
+        seconds.append(time.perf_counter() - t0)
+    seconds = np.array(seconds)
+    return {
+        "targets": targets,
+        **counts,
+        "plan_p50_ms": float(np.percentile(seconds, 50) * 1000),
+        "plan_max_ms": float(seconds.max() * 1000),
+    }
+
+
+async def _stream_once(protocol, trajectory, transport_options):
+    simulated_esp32.PROTOCOL_CAPS = PROTOCOL_CAPS[protocol]
+    transport = SimulatedTransport(**transport_options)
+    manager = BLEConnectionManager(transport=transport)
+    await manager.start()
+    await manager.wait_connected()
+    device = transport.devices[manager.device_name]
+    device.applied_log.clear()
+    start = time.perf_counter()
+    await manager.execute(trajectory)
+    # バッチ再生の最後のフレームを待つ
+    await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    await manager.stop()
+    times = np.array([t for t, _ in device.applied_log])
+    gaps = np.diff(times) * 1000
+    return {
+        "protocol": protocol,
+        "frames_sent": len(trajectory),
+        "frames_applied": len(times),
+        "writes": device.writes_received,
+        "bytes": device.bytes_received,
+        "seconds": elapsed,
+        "frames_per_sec": (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 else 0.0,
+        "interval_mean_ms": float(gaps.mean()) if len(gaps) else 0.0,
+        "jitter_std_ms": float(gaps.std()) if len(gaps) else 0.0,
+        "jitter_max_ms": float(np.abs(gaps - gaps.mean()).max()) if len(gaps) else 0.0,
+    }
+
+
+async def bench_stream(frames=200, transport_options=None):
+    """各プロトコルで再生されたフレームレートとジッタ"""
+    rng = np.random.default_rng(1)
+    trajectory = rng.integers([0, 30, 30, 30, 0, 0], [270, 240, 240, 240, 180, 180], size=(frames, 6)).astype(np.int16)
+    results = []
+    for protocol in PROTOCOL_CAPS:
+        results.append(await _stream_once(protocol, trajectory, transport_options or {}))
+    return results
+
+
+async def bench_api(clients=8, action="place"):
+    """N個の同時クライアントからの /action のリクエスト→最初のフレームまでの時間"""
+    import httpx
+    import robotarm_api as api
+
+    simulated_esp32.PROTOCOL_CAPS = PROTOCOL_CAPS["stream"]
+    first_frame = {}
+    publish = api.job_scheduler.on_progress
+
+    def on_progress(job):
+        first_frame.setdefault(job.id, time.perf_counter())
+        publish(job)
+    api.job_scheduler.on_progress = on_progress
+
+    await api.startup_event()
+    await api.ble_manager.wait_connected()
+    requested = {}
+    accepted = []
+
+    def finished():
+        return all((api.action_status.get(i) or "pending") not in ("pending", "running") for i in accepted)
+
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def post(i):
+            action_id = f"bench-{i}"
+            requested[action_id] = time.perf_counter()
+            response = await client.post("/action", json={"action": action, "action_id": action_id})
+            # 429（キューが満杯）・409 で断られたリクエストには状態がつかないので、終了を待たない
+            if response.status_code == 200:
+                accepted.append(action_id)
+            return response.status_code
+        status_codes = await asyncio.gather(*[post(i) for i in range(clients)])
+        deadline = time.perf_counter() + API_WAIT_TIMEOUT
+        while not finished() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        timed_out = not finished()
+    await api.shutdown_event()
+
+    latency = np.array([first_frame[i] - requested[i] for i in accepted if i in first_frame]) * 1000
+
+    def stat(f):
+        # すべて断られたときは計測値が無い
+        return float(f(latency)) if len(latency) else None
+    return {
+        "clients": clients,
+        "action": action,
+        "status_codes": sorted(set(status_codes)),
+        "accepted": len(accepted),
+        "timed_out": timed_out,
+        "first_frame_p50_ms": stat(lambda x: np.percentile(x, 50)),
+        "first_frame_p95_ms": stat(lambda x: np.percentile(x, 95)),
+        "first_frame_max_ms": stat(np.max),
+        "first_frame_min_ms": stat(np.min),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(old, new):
+    """前回の結果と比較して、主要な値の変化を表示する"""
+    def rows(result):
+        out = {}
+        for item in result.get("compile", []):
+            key = f"compile {item['method']} wp={item['waypoints']} {item.get('min_step', item.get('interval'))}"
+            out[key] = item["seconds"] * 1e6
+        for item in result.get("kinematics", []):
+            out[f"kinematics {item['pitch']} points={item['points']}"] = item["seconds"] * 1e6
+        if "move_to" in result:
+            out["move_to plan_p50_ms"] = result["move_to"]["plan_p50_ms"]
+        for item in result.get("stream", []):
+            out[f"stream {item['protocol']} frames/sec"] = item["frames_per_sec"]
+            out[f"stream {item['protocol']} jitter_std_ms"] = item["jitter_std_ms"]
+        if "api" in result:
+            out["api first_frame_p50_ms"] = result["api"]["first_frame_p50_ms"]
+            out["api first_frame_p95_ms"] = result["api"]["first_frame_p95_ms"]
+        return out
+    before, after = rows(old), rows(new)
+    for key in after:
+        if key in before and before[key] and after[key] is not None:
+            change = (after[key] - before[key]) / before[key] * 100
+            print(f"{key:45s} {before[key]:12.2f} -> {after[key]:12.2f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ロボットアーム送信パイプラインのベンチマーク（シミュレーションデバイス使用）")
+    parser.add_argument("--only", nargs="+", choices=["compile", "encode", "kinematics", "stream", "api"],
+                        help="実行する項目（省略時はすべて）")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="結果を書き出すJSONファイル")
+    parser.add_argument("--compare", help="比較する前回の結果JSON")
+    parser.add_argument("--frames", type=int, default=200, help="stream で送るフレーム数")
+    parser.add_argument("--interval", type=float, default=robotactionBLE.DELAY_BETWEEN_STEPS, help="ステップ間隔（秒）")
+    parser.add_argument("--clients", type=int, default=8, help="api の同時クライアント数")
+    parser.add_argument("--action", default="place", help="api で送るアクション名")
+    parser.add_argument("--connection-interval", type=float, default=0.0075, help="シミュレーションの接続間隔（秒）")
+    parser.add_argument("--write-latency", type=float, default=0.0, help="シミュレーションの書き込み遅延（秒）")
+    args = parser.parse_args()
+
+    robotactionBLE.DELAY_BETWEEN_STEPS = args.interval
+    items = args.only or ["compile", "encode", "kinematics", "stream", "api"]
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "interval": args.interval,
+    }
+    if "compile" in items:
+        result["compile"] = bench_compile()
+    if "encode" in items:
+        result["encode"] = bench_encode()
+    if "kinematics" in items:
+        result["kinematics"] = bench_kinematics()
+        result["move_to"] = bench_move_to()
+        move_to = result["move_to"]
+        print(f"move_to（初期位置から{move_to['targets']}点）: 直線 {move_to['linear']} / "
+              f"関節ごと {move_to['joint']} / 失敗 {move_to['failed']}")
+    if "stream" in items:
+        with _quiet():
+            result["stream"] = asyncio.run(bench_stream(args.frames, {
+                "connection_interval": args.connection_interval,
+                "write_latency": args.write_latency,
+            }))
+    if "api" in items:
+        with _quiet():
+            result["api"] = asyncio.run(bench_api(args.clients, args.action))
+
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(f"ベンチマーク結果を保存しました: {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+import asyncio
+import time
+import numpy as np
+from transport import TRANSPORT_ERRORS, get_transport
+import robotactionBLE
+from robotactionBLE import (
+    BLE_DEVICE_NAME,
+    BLE_CHARACTERISTIC_UUID,
+    INIT_POSITION,
+    send_sequence_ble,
+)
+from protocol import (
+    PROTOCOL_ASCII,
+    PROTOCOL_BATCH,
+    PROTOCOL_STREAM,
+    PROTOCOL_CAPS_DELTA,
+    PROTOCOL_CAPS_TELEMETRY,
+    encode_clear_frame,
+    has_capability,
+    parse_protocol_caps,
+    read_protocol_caps,
+)
+from streaming import FlowController, timed_write
+from planner import plan_waypoints
+from telemetry import TelemetryBuffer
+from metrics import (
+    BLE_CONNECT_FAILURES,
+    BLE_CONNECT_SECONDS,
+    BLE_CONNECTS,
+    BLE_DISCONNECTS,
+    BLE_SCAN_SECONDS,
+    FRAMES_SKIPPED,
+    SEND_RESYNCS,
+)
+
+# 再接続バックオフ設定（秒）
+RECONNECT_INITIAL_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+# 接続待ちのタイムアウト（秒）
+CONNECT_WAIT_TIMEOUT = 30.0
+# 1つの軌道の送信に失敗して再開してよい回数
+SEND_RETRIES = 3
+# 送信の再開時に再接続を待つ時間（秒）
+RESYNC_TIMEOUT = 10.0
+# 再開時にアームの姿勢の報告（テレメトリ）を待つ時間（秒）
+RESYNC_POSE_TIMEOUT = 0.2
+
+
+class BLEConnectionManager:
+    """BLE接続を常時維持し、軌道を送信する（実行順の管理は jobs.ActionJobScheduler）"""
+
+    def __init__(self, device_name=BLE_DEVICE_NAME, characteristic_uuid=BLE_CHARACTERISTIC_UUID, transport=None,
+                 address=None, connect_lock=None):
+        self.device_name = device_name
+        # address を指定したらアドレスで探す（複数台のアームを区別するため）
+        self.address = address
+        self.transport = transport or get_transport()
+        # 複数台で共有するとスキャンと接続を1台ずつ行う（BlueZは同時スキャン・同時接続に弱い）
+        self.connect_lock = connect_lock
+        self.characteristic_uuid = characteristic_uuid
+        self.client = None
+        self.device = None
+        self.protocol = PROTOCOL_ASCII
+        self.flow = None
+        # ファームウェアが TLM1 に対応していれば、現在角度・エンコーダの定期通知を貯める
+        self.telemetry = TelemetryBuffer()
+        self.telemetry_enabled = False
+        # ファームウェアが DLT1 に対応していれば、変わった関節だけの差分フレームで送る
+        self.delta_enabled = False
+        self._seq = 0
+        # 最後に送信（再生）したフレームの姿勢。割り込み時はここから次の動作につなぐ
+        self.current_pose = list(INIT_POSITION)
+        # 切断や送信失敗のあと、次の送信の前にデバイスと姿勢を合わせ直す
+        self._resync_needed = False
+        # 合わせ直したときにアームが報告した姿勢（次の送信はここからつなぐ）
+        self._resync_pose = None
+        self._connected = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._disconnected.set()
+        self._tasks = []
+        self._running = False
+
+    @property
+    def is_connected(self):
+        return self.client is not None and getattr(self.client, 'is_connected', False)
+
+    async def start(self):
+        """接続維持タスク（切断されたら再接続し続ける）を起動する。送信は execute() を呼ぶ側（jobs.ActionJobScheduler）が行う"""
+        if self._running:
+            return
+        self._running = True
+        self._tasks = [
+            asyncio.create_task(self._connection_loop()),
+        ]
+
+    async def stop(self):
+        """タスクを停止してBLEを切断する"""
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.is_connected:
+            await self.client.disconnect()
+            print("[BLE] 切断しました")
+        self.client = None
+        self._connected.clear()
+        self._disconnected.set()
+
+    def _on_disconnect(self, client):
+        print("[BLE] 切断を検知しました。バックグラウンドで再接続します。")
+        BLE_DISCONNECTS.labels(arm=self.label).inc()
+        self._resync_needed = True
+        self._connected.clear()
+        self._disconnected.set()
+
+    @property
+    def label(self):
+        return self.address or self.device_name
+
+    async def _connect_once(self):
+        if self.connect_lock is None:
+            await self._connect()
+            return
+        async with self.connect_lock:
+            await self._connect()
+
+    async def _find_device(self):
+        with BLE_SCAN_SECONDS.labels(arm=self.label).time():
+            if self.address:
+                print(f"[BLE] アドレス {self.address} を検索中...")
+                return await self.transport.find_device_by_address(self.address)
+            print(f"[BLE] '{self.device_name}' を検索中...")
+            return await self.transport.find_device(self.device_name)
+
+    async def _connect(self):
+        if self.device is None:
+            self.device = await self._find_device()
+            if not self.device:
+                raise RuntimeError(f"BLEデバイスが見つかりません: {self.label}")
+        client = self.transport.create_client(self.device, disconnected_callback=self._on_disconnect)
+        started = time.perf_counter()
+        try:
+            await client.connect()
+        except Exception:
+            # アドレスが変わっている可能性があるので次回は再スキャンする
+            self.device = None
+            raise
+        self.client = client
+        caps = await read_protocol_caps(client, self.characteristic_uuid)
+        self.protocol = parse_protocol_caps(caps)
+        self.telemetry_enabled = has_capability(caps, PROTOCOL_CAPS_TELEMETRY)
+        self.delta_enabled = has_capability(caps, PROTOCOL_CAPS_DELTA)
+        self.flow = None
+        if self.protocol == PROTOCOL_STREAM:
+            # 状態通知をフロー制御に使う
+            self.flow = FlowController()
+        if self.flow is not None or self.telemetry_enabled:
+            await client.start_notify(self.characteristic_uuid, self._on_notify)
+        self._disconnected.clear()
+        self._connected.set()
+        BLE_CONNECT_SECONDS.labels(arm=self.label).observe(time.perf_counter() - started)
+        BLE_CONNECTS.labels(arm=self.label).inc()
+        print(f"[BLE] {self.device.name}（{self.device.address}）に接続しました（プロトコル: {self.protocol}）")
+
+    def _on_notify(self, sender, data):
+        if self.flow is not None and self.flow.handle_notification(sender, data):
+            return
+        self.telemetry.handle_notification(sender, data)
+
+    def _skip_settled_frames(self, trajectory):
+        """テレメトリで報告された姿勢と同じ先頭フレームの数（すでにその姿勢にいるので送らない）
+
+        送ったフレームがすべて適用済みで、報告が新しいときだけ数える。
+        """
+        if not self.telemetry_enabled or self.protocol == PROTOCOL_ASCII:
+            return 0
+        reported = self.telemetry.current_pose()
+        if reported is None or reported[0] != (self._seq - 1) & 0xFFFF:
+            return 0
+        same = np.all(np.asarray(trajectory) == reported[1], axis=1)
+        return len(trajectory) if same.all() else int(np.argmin(same))
+
+    async def _connection_loop(self):
+        """切断されるたびに指数バックオフで再接続する"""
+        delay = RECONNECT_INITIAL_DELAY
+        while self._running:
+            await self._disconnected.wait()
+            try:
+                await self._connect_once()
+                delay = RECONNECT_INITIAL_DELAY
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                BLE_CONNECT_FAILURES.labels(arm=self.label).inc()
+                print(f"[BLE] 接続失敗: {e}。{delay:.1f}秒後に再試行します。")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def wait_connected(self, timeout=CONNECT_WAIT_TIMEOUT):
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"BLEデバイスに接続できません: {self.label}")
+
+    async def execute(self, trajectory, on_progress=None):
+        """軌道を送信し、再生が終わるまで待つ。キャンセルされたらデバイス側の再生待ちも破棄する
+
+        on_progress(i, angles) には再生済みのフレーム番号と姿勢を渡す。
+        送信に失敗したら再接続を待ち、アームが報告した姿勢から「今再生しているはずのフレーム」へ
+        つないで再開する（止まっている間に再生時刻を過ぎたフレームは送らない）。再開は SEND_RETRIES 回まで。
+        再開するのは接続・タイムアウトのエラー（transport.TRANSPORT_ERRORS）だけで、それ以外はすぐに失敗にする。
+        """
+        await self.wait_connected()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        interval = robotactionBLE.DELAY_BETWEEN_STEPS
+        offset = 0
+        failures = 0
+        while True:
+            try:
+                if self._resync_needed:
+                    await self._resync()
+                await self._send(trajectory, offset, on_progress)
+                return
+            except asyncio.CancelledError:
+                await self._clear_device_queue()
+                raise
+            except TRANSPORT_ERRORS as e:
+                failures += 1
+                if failures > SEND_RETRIES:
+                    raise
+                print(f"[BLE] 送信に失敗しました: {e}。再接続を待って再開します（{failures}/{SEND_RETRIES}）")
+                self._resync_needed = True
+                due = min(len(trajectory) - 1, int((loop.time() - started) / interval))
+                if due > offset:
+                    FRAMES_SKIPPED.inc(due - offset)
+                    offset = due
+
+    async def _send(self, trajectory, offset, on_progress):
+        """trajectory[offset:] を送る。再開直後ならアームが報告した姿勢からのつなぎを先に送る"""
+        skip = offset + self._skip_settled_frames(trajectory[offset:])
+        bridge = self._bridge(trajectory[min(skip, len(trajectory) - 1)])
+
+        def progress(i):
+            if i < len(bridge):
+                # つなぎのフレームはアクションのフレーム番号に数えない
+                self.current_pose = bridge[i].tolist()
+                return
+            i += skip - len(bridge)
+            self.current_pose = trajectory[i].tolist()
+            if on_progress:
+                on_progress(i, self.current_pose)
+
+        if skip == len(trajectory):
+            # すでに最終姿勢にいる（送るフレームがないので progress は通さず最終フレームを直接報告する）
+            self.current_pose = trajectory[-1].tolist()
+            if on_progress:
+                on_progress(len(trajectory) - 1, self.current_pose)
+            return
+        remaining = np.concatenate([bridge, trajectory[skip:]]) if len(bridge) else trajectory[skip:]
+        start_seq = self._seq
+        self._seq = (self._seq + len(remaining)) & 0xFFFF
+        if self.telemetry_enabled:
+            self.telemetry.schedule(start_seq, len(remaining), time.perf_counter(),
+                                    robotactionBLE.DELAY_BETWEEN_STEPS)
+        await send_sequence_ble(self.client, remaining, self.characteristic_uuid,
+                                self.protocol, start_seq, self.flow, progress, self.delta_enabled)
+
+    def _bridge(self, target):
+        """合わせ直した姿勢から target までの速度・加速度制限つきのつなぎ（target 自体は含めない）"""
+        reported, self._resync_pose = self._resync_pose, None
+        if reported is None or np.array_equal(reported, target):
+            return np.zeros((0, len(target)), dtype=np.int16)
+        return plan_waypoints([reported, target], robotactionBLE.DELAY_BETWEEN_STEPS)[1][:-1]
+
+    async def _resync(self):
+        """再接続を待ち、デバイスに残った古い再生待ちフレームを捨てて、アームが報告した姿勢とseqに合わせる
+
+        テレメトリが無ければ最後に送ったフレームの姿勢にいるものとみなす。
+        """
+        await self.wait_connected(RESYNC_TIMEOUT)
+        if self.protocol in (PROTOCOL_BATCH, PROTOCOL_STREAM):
+            # 捨てられなければ古いフレームの後ろに積むことになるので、失敗したら再開もやり直す
+            await timed_write(self.client, self.characteristic_uuid, encode_clear_frame(), "clear", frames=0)
+        self._resync_needed = False
+        SEND_RESYNCS.labels(arm=self.label).inc()
+        if self.flow is not None and self.flow.last_seq is not None:
+            self._seq = (self.flow.last_seq + 1) & 0xFFFF
+        if not self.telemetry_enabled:
+            return
+        since = time.perf_counter()
+        deadline = since + RESYNC_POSE_TIMEOUT
+        while time.perf_counter() < deadline:
+            reported = self.telemetry.pose_since(since)
+            if reported is not None:
+                # 届かなかったフレームの分のseqは飛ばさず、デバイスが最後に適用したseqの次から送る
+                self._seq = (reported[0] + 1) & 0xFFFF
+                self._resync_pose = reported[1]
+                self.current_pose = reported[1].tolist()
+                print(f"[BLE] アームの姿勢に合わせました: {self.current_pose}")
+                return
+            await asyncio.sleep(0.01)
+        print("[BLE] アームの姿勢の報告が届きません。最後に送った姿勢から再開します。")
+
+    async def _clear_device_queue(self):
+        """バッチ送信済みでまだ再生されていないフレームを破棄させる"""
+        if self.protocol in (PROTOCOL_BATCH, PROTOCOL_STREAM) and self.is_connected:
+            try:
+                await timed_write(self.client, self.characteristic_uuid, encode_clear_frame(), "clear", frames=0)
+            except Exception as e:
+                print(f"[BLE] 再生待ちフレームの破棄に失敗しました: {e}")
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+from ble_manager import BLEConnectionManager
+from jobs import ActionJobScheduler, GroupStart
+from robotactionBLE import BLE_DEVICE_NAME
+from transport import get_transport
+
+# アーム構成ファイル（環境変数 ROBOTARM_FLEET で変更できる）
+DEFAULT_FLEET_CONFIG = "arms.json"
+# 構成ファイルが無いときの1台だけのアームのID
+DEFAULT_ARM_ID = "default"
+# 全アームを表すグループ名
+ALL_ARMS = "all"
+
+
+class UnknownArmError(Exception):
+    """指定されたアームまたはグループが登録されていない"""
+
+
+class Arm:
+    """1台のアーム（BLE接続とジョブキュー）"""
+
+    def __init__(self, arm_id, manager, scheduler):
+        self.id = arm_id
+        self.manager = manager
+        self.scheduler = scheduler
+
+    def status(self):
+        current = self.scheduler.current
+        return {
+            "id": self.id,
+            "connected": self.manager.is_connected,
+            "protocol": self.manager.protocol,
+            "queue_depth": self.scheduler.queue_depth,
+            "current": current.id if current is not None else None,
+        }
+
+
+class Fleet:
+    """デバイスアドレスをキーにした複数アームの登録簿
+
+    すべてのアームの接続とジョブキューは同じイベントループ上で並行に動く。
+    グループへのアクションは各アームのキューに積み、全アームの準備がそろった時刻に同時に開始する。
+    """
+
+    def __init__(self, transport=None, on_update=None, on_progress=None):
+        self.transport = transport or get_transport()
+        self.on_update = on_update
+        self.on_progress = on_progress
+        self.arms = {}
+        self.groups = {}
+        # スキャンと接続は1台ずつ行う
+        self._connect_lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls, path=None, **kwargs):
+        """構成ファイルからアームを登録する。ファイルが無ければ BLE_DEVICE_NAME の1台だけ
+
+        {"arms": [{"address": "AA:BB:..."}, ...], "groups": {"left": ["AA:BB:...", ...]}}
+        """
+        path = path or os.environ.get("ROBOTARM_FLEET", DEFAULT_FLEET_CONFIG)
+        fleet = cls(**kwargs)
+        if not os.path.exists(path):
+            fleet.add_arm(DEFAULT_ARM_ID)
+            return fleet
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        for arm in config.get("arms", []):
+            fleet.add_arm(arm["address"], address=arm["address"], device_name=arm.get("name", BLE_DEVICE_NAME))
+        for name, members in config.get("groups", {}).items():
+            fleet.add_group(name, members)
+        return fleet
+
+    def add_arm(self, arm_id, address=None, device_name=BLE_DEVICE_NAME):
+        manager = BLEConnectionManager(device_name, transport=self.transport, address=address,
+                                       connect_lock=self._connect_lock)
+        scheduler = ActionJobScheduler(manager, on_update=self.on_update, on_progress=self.on_progress)
+        arm = Arm(arm_id, manager, scheduler)
+        self.arms[arm_id] = arm
+        return arm
+
+    def add_group(self, name, members):
+        unknown = [arm_id for arm_id in members if arm_id not in self.arms]
+        if unknown:
+            raise UnknownArmError(f"グループ {name} に未登録のアームがあります: {', '.join(unknown)}")
+        self.groups[name] = list(members)
+
+    @property
+    def default(self):
+        """/action など、アームを指定しないAPIが使うアーム（最初に登録したもの）"""
+        return next(iter(self.arms.values()))
+
+    def resolve(self, target):
+        """アームID・グループ名・"all" から対象のアームの一覧を返す"""
+        if target in self.arms:
+            return [self.arms[target]]
+        if target == ALL_ARMS:
+            return list(self.arms.values())
+        if target in self.groups:
+            return [self.arms[arm_id] for arm_id in self.groups[target]]
+        raise UnknownArmError(f"アームまたはグループが見つかりません: {target}")
+
+    async def start(self):
+        for arm in self.arms.values():
+            await arm.manager.start()
+            await arm.scheduler.start()
+
+    async def stop(self):
+        for arm in self.arms.values():
+            await arm.scheduler.stop()
+        await asyncio.gather(*[arm.manager.stop() for arm in self.arms.values()])
+
+    def submit(self, target, action_id, action, priority=0, preempt=False, blend=False):
+        """対象のアームにジョブを積み、{アームID: ジョブID} を返す
+
+        複数台のときはジョブIDを "<action_id>@<アームID>" にし、全アームで同時に開始する。
+        1台でも積めなければどのアームにも積まない。
+        """
+        arms = self.resolve(target)
+        if len(arms) == 1:
+            arms[0].scheduler.submit(action_id, action, priority, preempt, blend=blend)
+            return {arms[0].id: action_id}
+        jobs = {arm.id: f"{action_id}@{arm.id}" for arm in arms}
+        for arm in arms:
+            arm.scheduler.check_submit(jobs[arm.id])
+        group = GroupStart(len(arms))
+        for arm in arms:
+            arm.scheduler.submit(jobs[arm.id], action, priority, preempt, group, blend=blend)
+        return jobs
+
+    def find_job(self, job_id):
+        """実行中のジョブを探す"""
+        for arm in self.arms.values():
+            current = arm.scheduler.current
+            if current is not None and current.id == job_id:
+                return current
+        return None
+
+    def cancel(self, action_id):
+        """ジョブを取り消す。グループのaction_idなら全アーム分を取り消す"""
+        cancelled = False
+        for arm in self.arms.values():
+            for job_id in (action_id, f"{action_id}@{arm.id}"):
+                if arm.scheduler.cancel(job_id):
+                    cancelled = True
+        return cancelled
+
+    def status(self):
+        return {
+            "arms": [arm.status() for arm in self.arms.values()],
+            "groups": self.groups,
+        }
@@ -0,0 +1,269 @@
+import asyncio
+import heapq
+import itertools
+import time
+from robotactionBLE import compile_action_chain, compile_action_job
+from metrics import ACTIONS, ACTION_QUEUE_WAIT_SECONDS, ACTION_SECONDS
+
+# 待ち行列に積めるジョブ数の上限（超えたら QueueFullError → HTTP 429）
+MAX_QUEUED_JOBS = 16
+
+# グループ開始: 全アームの準備がそろってから開始するまでの余裕と、準備を待つ上限（秒）
+GROUP_START_LEAD_TIME = 0.1
+GROUP_START_TIMEOUT = 60.0
+
+# ジョブの状態
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+JOB_ERROR = "error"
+
+
+class QueueFullError(Exception):
+    """待ち行列が満杯でジョブを受け付けられない"""
+
+
+class DuplicateJobError(Exception):
+    """同じaction_idのジョブが待機中または実行中"""
+
+
+class GroupStart:
+    """複数アームのジョブを同じ時刻に開始させる
+
+    各アームのジョブは軌道を用意したあと wait() で待ち、全員がそろったら
+    GROUP_START_LEAD_TIME 後の同じ時刻に送信を始める。1台でも取り消し・失敗したら全員やめる。
+    """
+
+    def __init__(self, parties, lead_time=GROUP_START_LEAD_TIME, timeout=GROUP_START_TIMEOUT):
+        self.parties = parties
+        self.lead_time = lead_time
+        self.timeout = timeout
+        self.start_at = None
+        self.aborted = False
+        self._arrived = 0
+        self._ready = asyncio.Event()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        self._arrived += 1
+        if self._arrived >= self.parties:
+            self.start_at = loop.time() + self.lead_time
+            self._ready.set()
+        try:
+            await asyncio.wait_for(self._ready.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self.abort()
+            raise RuntimeError("グループの他のアームの準備がそろいませんでした")
+        if self.aborted:
+            raise RuntimeError("グループの他のアームが取り消されたか失敗しました")
+        await asyncio.sleep(max(0.0, self.start_at - loop.time()))
+
+    def abort(self):
+        if self.start_at is None:
+            self.aborted = True
+            self._ready.set()
+
+
+class ActionJob:
+    """1回のアクション実行要求（action はアクション名、またはつないで実行するアクション名のリスト）"""
+
+    def __init__(self, job_id, action, priority=0, preempt=False, group=None, plan=None, blend=False):
+        self.id = job_id
+        self.action = action
+        # plan(start_position) を渡すと、アクション名の代わりにその軌道を実行する（/move_to など）
+        self.plan = plan
+        # True なら、直前のジョブは初期位置に戻らずに終わり、その姿勢からこのジョブへ直接つなぐ
+        self.blend = blend
+        # False なら初期位置に戻らずに終わった（次の blend のジョブへつなぐため）
+        self.return_home = True
+        self.priority = priority
+        self.preempt = preempt
+        self.group = group
+        self.status = JOB_PENDING
+        self.error = None
+        self.created_at = time.time()
+        self.progress = (0, 0)  # (再生済みフレーム番号, 全フレーム数)
+        self.angles = None
+
+    @property
+    def status_text(self):
+        if self.status == JOB_ERROR:
+            return f"error: {self.error}"
+        return self.status
+
+
+class ActionJobScheduler:
+    """アクションを優先度つきの有限キューで1つずつ実行する
+
+    優先度の高いジョブから実行し、同じ優先度なら到着順。preempt=True のジョブは、
+    実行中のジョブの優先度以上であれば実行中のジョブを中断し、現在の姿勢から直接つないで始める。
+    """
+
+    def __init__(self, manager, maxsize=MAX_QUEUED_JOBS, on_update=None, on_progress=None):
+        self.manager = manager
+        self.maxsize = maxsize
+        # on_update(job) は状態が変わったとき、on_progress(job) はフレームが進んだときに呼ばれる
+        self.on_update = on_update
+        self.on_progress = on_progress
+        self.current = None
+        self._heap = []
+        self._pending = {}
+        self._counter = itertools.count()
+        self._available = asyncio.Event()
+        self._current_task = None
+        self._interrupted = None
+        self._runner = None
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    async def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+            self._runner = None
+
+    def _notify(self, job):
+        if self.on_update:
+            self.on_update(job)
+
+    def check_submit(self, job_id):
+        """submit できるか確かめる。満杯なら QueueFullError、同じIDが処理中なら DuplicateJobError"""
+        if job_id in self._pending or (self.current is not None and self.current.id == job_id):
+            raise DuplicateJobError(f"同じaction_idのジョブが処理中です: {job_id}")
+        if len(self._pending) >= self.maxsize:
+            raise QueueFullError(f"待ち行列が満杯です（{self.maxsize}件）")
+
+    def submit(self, job_id, action, priority=0, preempt=False, group=None, plan=None, blend=False):
+        """ジョブを積む。group（GroupStart）を渡すと他のアームと同時に開始する
+
+        plan(start_position) を渡すと、実行時の姿勢からの軌道を返すその関数で軌道を作る（action は表示用の名前）。
+        blend=True なら、前のジョブのあと初期位置に戻らずに直接このジョブを始める。
+        """
+        self.check_submit(job_id)
+        job = ActionJob(job_id, action, priority, preempt, group, plan, blend)
+        self._pending[job_id] = job
+        heapq.heappush(self._heap, (-priority, next(self._counter), job))
+        self._notify(job)
+        self._available.set()
+        if preempt and self.current is not None and priority >= self.current.priority:
+            print(f"[JOB] {self.current.id} を中断して {job_id} を実行します")
+            self._interrupt()
+        return job
+
+    def cancel(self, job_id):
+        """待機中または実行中のジョブを取り消す。対象が無ければ False"""
+        job = self._pending.pop(job_id, None)
+        if job is not None:
+            # ヒープからは取り出し時に読み飛ばす
+            job.status = JOB_CANCELLED
+            ACTIONS.labels(status=JOB_CANCELLED).inc()
+            if job.group is not None:
+                job.group.abort()
+            self._notify(job)
+            return True
+        if self.current is not None and self.current.id == job_id:
+            self._interrupt()
+            return True
+        return False
+
+    def _interrupt(self):
+        """実行中のジョブを中断する"""
+        self._interrupted = self.current
+        self._current_task.cancel()
+
+    def _peek(self):
+        """次に実行するジョブ（取り出さない）。無ければ None"""
+        while self._heap and self._heap[0][2].id not in self._pending:
+            heapq.heappop(self._heap)
+        return self._heap[0][2] if self._heap else None
+
+    def _pop(self):
+        while self._heap:
+            _, _, job = heapq.heappop(self._heap)
+            if self._pending.pop(job.id, None) is not None:
+                return job
+        return None
+
+    async def _run(self):
+        while True:
+            job = self._pop()
+            if job is None:
+                self._available.clear()
+                await self._available.wait()
+                continue
+            self.current = job
+            job.status = JOB_RUNNING
+            started = time.time()
+            ACTION_QUEUE_WAIT_SECONDS.observe(started - job.created_at)
+            self._notify(job)
+            self._current_task = asyncio.create_task(self._execute(job))
+            try:
+                await self._current_task
+                job.status = JOB_DONE
+            except asyncio.CancelledError:
+                if self._interrupted is not job:
+                    # スケジューラ自体の停止
+                    raise
+                # 取り消し、または割り込みによる中断
+                job.status = JOB_CANCELLED
+            except Exception as e:
+                job.status = JOB_ERROR
+                job.error = e
+            finally:
+                if job.group is not None and job.status != JOB_DONE:
+                    job.group.abort()
+                self.current = None
+                self._current_task = None
+                self._interrupted = None
+            ACTIONS.labels(status=job.status).inc()
+            ACTION_SECONDS.observe(time.time() - started)
+            self._notify(job)
+            if job.status == JOB_DONE and not job.return_home and self._peek() is None:
+                # つなぐはずだったジョブが取り消された
+                await self._return_home()
+
+    async def _return_home(self):
+        try:
+            await self.manager.execute(compile_action_chain([], self.manager.current_pose))
+        except Exception as e:
+            print(f"[JOB] 初期位置に戻れませんでした: {e}")
+
+    async def _execute(self, job):
+        # 前の動作が中断されていれば、その姿勢から直接つなぐ
+        # 軌道の計算（逆運動学など）はイベントループを止めないよう別スレッドで行う
+        if job.plan is not None:
+            trajectory = await asyncio.to_thread(job.plan, self.manager.current_pose)
+            home_start = len(trajectory)
+        else:
+            trajectory, home_start = await asyncio.to_thread(compile_action_job, job.action,
+                                                             self.manager.current_pose)
+        job.progress = (0, len(trajectory))
+        if job.group is not None:
+            # 軌道の用意ができたら、グループの他のアームを待って同時に始める
+            await job.group.wait()
+
+        def on_progress(i, angles, offset=0):
+            job.progress = (offset + i + 1, len(trajectory))
+            job.angles = angles
+            if self.on_progress:
+                self.on_progress(job)
+
+        await self.manager.execute(trajectory[:home_start], on_progress)
+        if home_start == len(trajectory):
+            return
+        # 初期位置へ戻る区間は、最後の経由点まで動き終えてから送る。その時点で次のジョブが blend なら
+        # 戻らずに終わり、次のジョブはこの姿勢から始める（動作中に届いた blend のジョブもつなげる）
+        following = self._peek()
+        if following is not None and following.blend:
+            job.return_home = False
+            job.progress = (home_start, home_start)
+            return
+        await self.manager.execute(trajectory[home_start:],
+                                   lambda i, angles: on_progress(i, angles, home_start))
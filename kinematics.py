@@ -0,0 +1,250 @@
+"""6軸アームの順運動学・逆運動学（NumPyでまとめて解く）
+
+座標系: 原点は土台の床面、z が上、x が土台サーボ（1番）の基準方向、y が左。単位は mm と度。
+サーボ角 s と関節角 q の関係は q = (s - joint_zero) * joint_direction。
+
+    q0 土台の旋回（z軸まわり）
+    q1 肩の仰角（水平から上向きが正）
+    q2 肘（上腕に対する角度）
+    q3 手首の曲げ（前腕に対する角度）。ツールの向き pitch = q1 + q2 + q3（0 が水平、-90 が真下）
+    q4 手首の回転、q5 グリッパー（位置には関係しないのでサーボ角のまま扱う）
+
+リンクの長さと基準角は kinematics.json（ROBOTARM_KINEMATICS で変更できる）で実機に合わせる。
+稼働範囲は servo6-6.ino の minAngles / maxAngles（trajectory.py）を使う。
+
+逆運動学は解析解をまとめて計算する。位置だけ指定したとき（ツールの向きが自由）は、
+向きの候補・肘の上下・土台の前後の全組み合わせを一度に解き、稼働範囲内の解から
+直前の解（warm start）に最も近いものを順に選ぶ。同じ入力の解はキャッシュする。
+"""
+import json
+import os
+from functools import lru_cache
+import numpy as np
+from planner import JOINT_MAX_VELOCITY
+from trajectory import JOINT_MAX_ANGLES, JOINT_MIN_ANGLES, NUM_JOINTS
+
+# 構成ファイル（環境変数 ROBOTARM_KINEMATICS で変更できる）
+DEFAULT_KINEMATICS_CONFIG = "kinematics.json"
+# リンクの長さ（mm）: 床から肩の軸まで、上腕、前腕、手首の軸からグリッパーの先まで
+BASE_HEIGHT = 80.0
+UPPER_ARM_LENGTH = 105.0
+FOREARM_LENGTH = 100.0
+TOOL_LENGTH = 120.0
+# 関節角が0になるサーボ角と回転の向き（初期位置 [135, 200, 30, 45, 90, 90] で上腕が後ろに少し傾き、
+# 前腕がほぼ水平、グリッパーが下を向く）
+JOINT_ZERO = (135.0, 90.0, 135.0, 135.0, 90.0, 90.0)
+JOINT_DIRECTION = (1.0, 1.0, 1.0, 1.0, 1.0, 1.0)
+
+# ツールの向きが自由なときに試す向きの刻み（度）
+PITCH_CANDIDATE_STEP = 5.0
+# 解を選ぶときの、ツールの向きの変化1度あたりの重み（サーボ角の変化1度を1とする）
+PITCH_WEIGHT = 2.0
+# 直線移動の既定の速さ（mm/秒）
+CARTESIAN_SPEED = 100.0
+# 直線移動の軌道のフレーム数の上限（関節の速度上限に合わせてゆっくりにするときも、これ以上は延ばさない）
+MAX_LINEAR_FRAMES = 3000
+# キャッシュのキーにする精度（mm・度の小数点以下の桁数）
+CACHE_DECIMALS = 2
+# 腕を伸ばしきった点は丸め誤差でわずかに届かなくなるので、この割合までは届くとみなす
+REACH_TOLERANCE = 1e-3
+
+
+class UnreachableError(ValueError):
+    """目標の位置・向きが稼働範囲内の関節角で実現できない"""
+
+
+def _wrap(deg):
+    """角度を [-180, 180) に収める"""
+    return deg - 360.0 * np.floor((deg + 180.0) / 360.0)
+
+
+def _angle_distance(a, b):
+    """[-180, 180) の角度どうしの差の大きさ（0〜180度）"""
+    d = np.abs(a - b)
+    return np.minimum(d, 360.0 - d)
+
+
+class ArmKinematics:
+    """リンクの長さとサーボの基準角を持ち、順運動学・逆運動学を解く"""
+
+    def __init__(self, base_height=BASE_HEIGHT, upper_arm=UPPER_ARM_LENGTH, forearm=FOREARM_LENGTH,
+                 tool=TOOL_LENGTH, joint_zero=JOINT_ZERO, joint_direction=JOINT_DIRECTION):
+        self.base_height = float(base_height)
+        self.upper_arm = float(upper_arm)
+        self.forearm = float(forearm)
+        self.tool = float(tool)
+        self.joint_zero = np.asarray(joint_zero, dtype=np.float64).reshape(NUM_JOINTS)
+        self.joint_direction = np.asarray(joint_direction, dtype=np.float64).reshape(NUM_JOINTS)
+
+    @classmethod
+    def from_config(cls, path=None):
+        """構成ファイルから読み込む。ファイルが無ければ既定の寸法
+
+        {"base_height": 80, "upper_arm": 105, "forearm": 100, "tool": 120,
+         "joint_zero": [135, 90, 135, 135, 90, 90], "joint_direction": [1, 1, 1, 1, 1, 1]}
+        """
+        path = path or os.environ.get("ROBOTARM_KINEMATICS", DEFAULT_KINEMATICS_CONFIG)
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    @property
+    def params(self):
+        """キャッシュのキー（寸法・基準角が変わったら別の解になる）"""
+        return (self.base_height, self.upper_arm, self.forearm, self.tool,
+                tuple(self.joint_zero.tolist()), tuple(self.joint_direction.tolist()))
+
+    def joint_angles(self, servo_angles):
+        return (np.asarray(servo_angles, dtype=np.float64) - self.joint_zero) * self.joint_direction
+
+    def servo_angles(self, joint_angles):
+        return np.asarray(joint_angles, dtype=np.float64) * self.joint_direction + self.joint_zero
+
+    def forward(self, servo_angles):
+        """サーボ角 (n, 6) → (グリッパー先端の位置 (n, 3), ツールの向き (n,))。1姿勢 (6,) なら (3,) とスカラー"""
+        angles = np.asarray(servo_angles, dtype=np.float64)
+        q = np.radians(self.joint_angles(angles.reshape(-1, NUM_JOINTS)))
+        a1 = q[:, 1]
+        a2 = a1 + q[:, 2]
+        a3 = a2 + q[:, 3]
+        r = self.upper_arm * np.cos(a1) + self.forearm * np.cos(a2) + self.tool * np.cos(a3)
+        z = self.base_height + self.upper_arm * np.sin(a1) + self.forearm * np.sin(a2) + self.tool * np.sin(a3)
+        position = np.stack([r * np.cos(q[:, 0]), r * np.sin(q[:, 0]), z], axis=1)
+        pitch = _wrap(np.degrees(a3))
+        if angles.ndim == 1:
+            return position[0], float(pitch[0])
+        return position, pitch
+
+    def inverse(self, positions, pitch=None, seed=None, roll=None, gripper=None):
+        """グリッパー先端の位置 (n, 3) → サーボ角 (n, 6)。1点 (3,) なら (6,)
+
+        pitch はツールの向き（度、スカラーか (n,)）。None なら自由に選ぶ。
+        seed は直前の姿勢（サーボ角）。各点は1つ前の点の解に最も近い解を選ぶので、
+        経路を渡すと関節角が連続に変わる。roll・gripper は5・6番のサーボ角（None なら seed のまま）。
+        どれかの点に解が無ければ UnreachableError。結果は書き換え不可（キャッシュを共有する）。
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        points = positions.reshape(-1, 3)
+        n = len(points)
+        seed = self.servo_angles(np.zeros(NUM_JOINTS)) if seed is None else np.asarray(seed, dtype=np.float64)
+        columns = [np.round(points, CACHE_DECIMALS)]
+        for value in (pitch, roll, gripper):
+            columns.append(np.full((n, 1), np.nan) if value is None
+                           else np.round(np.broadcast_to(value, (n,)), CACHE_DECIMALS)[:, None])
+        key = np.ascontiguousarray(np.hstack(columns))
+        solution = _inverse_cached(self.params, key.tobytes(), n, tuple(np.round(seed, CACHE_DECIMALS).tolist()))
+        return solution[0] if positions.ndim == 1 else solution
+
+    def _candidates(self, points, pitch, seed):
+        """全ての点について、向き・肘・土台の前後の組み合わせごとの解 (n, k, 4) とツールの向き (n, k)"""
+        n = len(points)
+        x, y, z = points[:, 0:1], points[:, 1:2], points[:, 2:3]
+        r = np.hypot(x, y)
+        if pitch is None:
+            # 直前の姿勢の向きも候補に入れ、届くならそのまま保つ。腕を伸ばしきった向き（肩から目標へ）も
+            # 入れておく（遠い点は届く向きの幅が狭く、刻みの候補では外れることがある）
+            grid = np.broadcast_to(np.append(np.arange(-180.0, 180.0, PITCH_CANDIDATE_STEP), self.forward(seed)[1]),
+                                   (n, int(360 / PITCH_CANDIDATE_STEP) + 1))
+            straight = np.degrees(np.arctan2(z - self.base_height, np.hstack([r, -r])))
+            phi = np.hstack([grid, straight])
+        else:
+            phi = np.asarray(pitch, dtype=np.float64).reshape(n, 1)
+        # 真上・真下（r=0）では旋回角が決まらないので直前の姿勢のまま
+        yaw = np.where(r > 1e-6, np.degrees(np.arctan2(y, x)), self.joint_angles(seed)[0])
+        solutions = []
+        pitches = []
+        for reach, base in ((r, yaw), (-r, _wrap(yaw + 180.0))):
+            phi_rad = np.radians(phi)
+            wr = reach - self.tool * np.cos(phi_rad)
+            wz = z - self.base_height - self.tool * np.sin(phi_rad)
+            cos_elbow = (wr ** 2 + wz ** 2 - self.upper_arm ** 2 - self.forearm ** 2) / (2 * self.upper_arm * self.forearm)
+            # 届かない組み合わせは NaN のまま（稼働範囲の判定で落ちる）
+            cos_elbow = np.where(np.abs(cos_elbow) <= 1 + REACH_TOLERANCE, np.clip(cos_elbow, -1.0, 1.0), np.nan)
+            elbow_abs = np.arccos(cos_elbow)
+            for elbow in (elbow_abs, -elbow_abs):
+                shoulder = np.arctan2(wz, wr) - np.arctan2(self.forearm * np.sin(elbow),
+                                                          self.upper_arm + self.forearm * np.cos(elbow))
+                q1 = _wrap(np.degrees(shoulder))
+                q2 = np.degrees(elbow)
+                q3 = _wrap(phi - q1 - q2)
+                solutions.append(np.stack(np.broadcast_arrays(base, q1, q2, q3), axis=-1))
+                pitches.append(phi)
+        return np.concatenate(solutions, axis=1), np.concatenate(pitches, axis=1)
+
+    def _solve(self, points, pitch, seed, roll, gripper):
+        joints, phi = self._candidates(points, pitch, seed)
+        servo = joints * self.joint_direction[:4] + self.joint_zero[:4]
+        # サーボには整数の角度で送るので、丸めて範囲内になるものは範囲内とみなす
+        feasible = np.all((servo >= JOINT_MIN_ANGLES[:4] - 0.5) & (servo <= JOINT_MAX_ANGLES[:4] + 0.5), axis=-1)
+        servo = np.clip(servo, JOINT_MIN_ANGLES[:4], JOINT_MAX_ANGLES[:4])
+        unreachable = np.flatnonzero(~feasible.any(axis=1))
+        if unreachable.size:
+            raise UnreachableError(f"稼働範囲内で届かない点があります: {points[unreachable[0]].tolist()}"
+                                   f"（{unreachable.size}点）")
+
+        out = np.empty((len(points), NUM_JOINTS))
+        previous = seed[:4]
+        previous_pitch = self.forward(seed)[1]
+        for i in range(len(points)):
+            cost = np.abs(servo[i] - previous).sum(axis=1) + PITCH_WEIGHT * _angle_distance(phi[i], previous_pitch)
+            k = int(np.argmin(np.where(feasible[i], cost, np.inf)))
+            previous = out[i, :4] = servo[i, k]
+            previous_pitch = phi[i, k]
+        out[:, 4] = seed[4] if roll is None else roll
+        out[:, 5] = seed[5] if gripper is None else gripper
+        bad = np.flatnonzero((out[:, 4:] < JOINT_MIN_ANGLES[4:]).any(axis=1) | (out[:, 4:] > JOINT_MAX_ANGLES[4:]).any(axis=1))
+        if bad.size:
+            raise UnreachableError(f"手首の回転・グリッパーの角度が稼働範囲外です: {out[bad[0], 4:].tolist()}")
+        return out
+
+    def plan_linear(self, start, position, interval, pitch=None, roll=None, gripper=None,
+                    speed=CARTESIAN_SPEED, max_velocity=JOINT_MAX_VELOCITY):
+        """start（サーボ角）から position まで、グリッパー先端を直線で動かす軌道 (n, 6) のint16配列
+
+        先頭は start、末尾は目標の姿勢。速さは speed（mm/秒）で、両端は滑らかに加減速する。
+        ツールの向きも start の向きから目標の向き（pitch が None なら目標の位置の解の向き）まで
+        滑らかに変える（点ごとに向きを選ぶと刻みの候補の間で切り替わり、関節角が飛ぶ）。
+        特異点の近くなどで関節の速度上限を超える区間があれば、全体をゆっくりにして解き直す。
+        途中で関節角が飛ぶ（特異点を通る・解の枝が切り替わる）経路や、MAX_LINEAR_FRAMES に
+        収まらない経路は UnreachableError にする。
+        """
+        start = np.asarray(start, dtype=np.float64)
+        start_position, start_pitch = self.forward(start)
+        goal = np.asarray(position, dtype=np.float64)
+        if pitch is None:
+            pitch = self.forward(self.inverse(goal, None, start, roll, gripper))[1]
+        frames = max(1, int(np.ceil(np.linalg.norm(goal - start_position) / speed / interval)))
+        previous_step = np.inf
+        while frames <= MAX_LINEAR_FRAMES:
+            t = np.arange(1, frames + 1) / frames
+            s = (3 - 2 * t) * t * t
+            path_pitch = start_pitch + s * _wrap(pitch - start_pitch)
+            path_roll = None if roll is None else start[4] + s * (roll - start[4])
+            path_gripper = None if gripper is None else start[5] + s * (gripper - start[5])
+            angles = self.inverse(start_position + s[:, None] * (goal - start_position), path_pitch, start,
+                                  path_roll, path_gripper)
+            trajectory = np.vstack([start, angles])
+            steps = np.abs(np.diff(trajectory, axis=0))
+            ratio = (steps / (max_velocity * interval)).max()
+            if ratio <= 1.0:
+                return np.rint(trajectory).astype(np.int16)
+            # 滑らかな経路ならフレームを増やせば1フレームの変化は小さくなる。小さくならなければ関節角が飛んでいる
+            step = steps.max()
+            if step >= previous_step:
+                raise UnreachableError(f"直線で移動できません（途中で関節角が不連続に変わります）: {position}")
+            previous_step = step
+            frames = int(np.ceil(frames * ratio))
+        raise UnreachableError(f"直線で移動できません（{MAX_LINEAR_FRAMES}フレームに収まりません）: {position}")
+
+
+@lru_cache(maxsize=1024)
+def _inverse_cached(params, key, n, seed):
+    base_height, upper_arm, forearm, tool, joint_zero, joint_direction = params
+    kinematics = ArmKinematics(base_height, upper_arm, forearm, tool, joint_zero, joint_direction)
+    columns = np.frombuffer(key, dtype=np.float64).reshape(n, 6)
+    pitch, roll, gripper = (None if np.isnan(columns[:, c]).all() else columns[:, c] for c in (3, 4, 5))
+    solution = kinematics._solve(columns[:, :3], pitch, np.asarray(seed), roll, gripper)
+    # キャッシュを共有するので書き換え不可にしておく
+    solution.setflags(write=False)
+    return solution
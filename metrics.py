@@ -0,0 +1,238 @@
+"""カウンタ・ゲージ・ヒストグラムと、Prometheus のテキスト形式での出力
+
+送信ループなどのホットパスから呼ばれるので、記録は辞書の更新と加算だけで済ませる。
+値はプロセスごと（uvicorn のワーカーを増やした場合はワーカーごと）に持つ。
+"""
+import os
+import time
+from contextlib import contextmanager
+
+# 時間のヒストグラムの既定のバケット（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 毎フレームのログは N 回に1回だけ出す（コンソール出力で送信周期が乱れないように）
+LOG_SAMPLE_EVERY = int(os.environ.get("ROBOTARM_LOG_SAMPLE_EVERY", "50"))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus のテキスト形式（text/plain; version=0.0.4）"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        registry.register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _unlabelled(self):
+        return self._children[()]
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    """増えるだけの値（Prometheus側で rate() を取って毎秒の値にする）"""
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._unlabelled().inc(amount)
+
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+                for key, child in self._children.items()]
+
+
+class Gauge(_Metric):
+    """増減する値。set_function を使うと出力時に関数を呼んで値を取る"""
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self._function = None
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._unlabelled().set(value)
+
+    def set_function(self, function):
+        """function() はラベルなしなら数値、ラベルつきなら {ラベル値のタプル: 数値} を返す"""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            values = self._function()
+            if not self.labelnames:
+                values = {(): values}
+        else:
+            values = {key: child.value for key, child in self._children.items()}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in values.items()]
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    """値の分布（バケットごとの件数・合計・件数）"""
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets) + (float("inf"),)
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled().observe(value)
+
+    def time(self):
+        return self._unlabelled().time()
+
+    def samples(self):
+        lines = []
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+def log_event(event, **fields):
+    """構造化ログを1行出す（event key=value ...）"""
+    parts = [event]
+    for key, value in fields.items():
+        if isinstance(value, (list, tuple)):
+            value = ",".join(map(str, value))
+        parts.append(f"{key}={value}")
+    print(" ".join(parts))
+
+
+class LogSampler:
+    """N回に1回だけ log_event を出す（毎フレームのログ用）"""
+
+    def __init__(self, every=LOG_SAMPLE_EVERY):
+        self.every = every
+        self.count = 0
+
+    def log(self, event, force=False, **fields):
+        """force=True（最後のフレームなど）なら間引かずに出す"""
+        self.count += 1
+        if force or (self.every > 0 and (self.count - 1) % self.every == 0):
+            log_event(event, **fields)
+
+
+# --- BLE接続 ---
+BLE_SCAN_SECONDS = Histogram("robotarm_ble_scan_seconds", "BLEデバイスの検索にかかった時間", ["arm"])
+BLE_CONNECT_SECONDS = Histogram("robotarm_ble_connect_seconds", "BLE接続（プロトコル確認まで）にかかった時間", ["arm"])
+BLE_CONNECTS = Counter("robotarm_ble_connects_total", "BLE接続に成功した回数（2回目以降は再接続）", ["arm"])
+BLE_CONNECT_FAILURES = Counter("robotarm_ble_connect_failures_total", "BLE接続に失敗した回数", ["arm"])
+BLE_DISCONNECTS = Counter("robotarm_ble_disconnects_total", "切断を検知した回数", ["arm"])
+BLE_CONNECTED = Gauge("robotarm_ble_connected", "BLEで接続中なら1", ["arm"])
+
+# --- 送信 ---
+BLE_WRITE_SECONDS = Histogram("robotarm_ble_write_seconds", "1回の書き込みにかかった時間", ["kind"])
+BLE_WRITE_BYTES = Counter("robotarm_ble_write_bytes_total", "書き込んだバイト数", ["kind"])
+BLE_WRITE_FAILURES = Counter("robotarm_ble_write_failures_total", "失敗した書き込みの回数", ["kind"])
+FRAMES_SENT = Counter("robotarm_frames_sent_total", "送信したフレーム数")
+FRAMES_DEDUPLICATED = Counter("robotarm_frames_deduplicated_total", "直前と同じ姿勢なので送らなかったフレーム数")
+FRAMES_SKIPPED = Counter("robotarm_frames_skipped_total", "送信が遅れて飛ばした（最新にまとめた）フレーム数")
+SEND_RESYNCS = Counter("robotarm_send_resyncs_total", "送信に失敗して、再接続を待ってアームの姿勢から再開した回数", ["arm"])
+SEND_LATENESS_SECONDS = Histogram("robotarm_send_lateness_seconds", "フレームの送信時刻と締め切りのずれ",
+                                  buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1))
+
+# --- アクション・API ---
+ACTIONS = Counter("robotarm_actions_total", "終了したアクションの数（終了時の状態別）", ["status"])
+ACTION_SECONDS = Histogram("robotarm_action_seconds", "アクションの実行時間（開始から終了まで）")
+ACTION_QUEUE_WAIT_SECONDS = Histogram("robotarm_action_queue_wait_seconds", "アクションが受け付けられてから開始するまでの時間")
+JOB_QUEUE_DEPTH = Gauge("robotarm_job_queue_depth", "待機中のアクション数", ["arm"])
+HTTP_REQUEST_SECONDS = Histogram("robotarm_http_request_seconds", "APIリクエストの処理時間", ["method", "path", "status"])
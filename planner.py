@@ -0,0 +1,87 @@
+import numpy as np
+from trajectory import NUM_JOINTS
+
+# 各サーボの速度・加速度の上限（送信する角度の単位で 度/秒, 度/秒^2）
+# 最初の4つはRDS3218（0.16秒/60度 ≒ 375度/秒）、後の2つはSG-5010（0.20秒/60度 ≒ 300度/秒）。
+# どちらも無負荷の値なので8割に抑え、加速度は電源の電流スパイクを抑える値にしている。
+JOINT_MAX_VELOCITY = np.array([300.0, 300.0, 300.0, 300.0, 240.0, 240.0])
+JOINT_MAX_ACCEL = np.array([1500.0, 1500.0, 1500.0, 1500.0, 2000.0, 2000.0])
+
+
+def _segment_durations(distance, max_velocity, max_accel):
+    """各区間・各関節の台形プロファイルの最短時間を求め、区間ごとの最大値を返す"""
+    # 最高速度まで加速できる場合: d/v + v/a、できない場合（三角形）: 2*sqrt(d/a)
+    full = distance / max_velocity + max_velocity / max_accel
+    triangle = 2 * np.sqrt(distance / max_accel)
+    per_joint = np.where(distance >= max_velocity ** 2 / max_accel, full, triangle)
+    return per_joint.max(axis=1)
+
+
+def _cruise_velocity(distance, duration, max_accel):
+    """区間時間 duration で距離 distance を動く台形プロファイルの巡航速度（全関節同時に止まる）"""
+    aT = max_accel * duration[:, None]
+    disc = np.maximum(aT ** 2 - 4 * max_accel * distance, 0.0)
+    return (aT - np.sqrt(disc)) / 2
+
+
+def plan_waypoints(waypoints, interval, max_velocity=JOINT_MAX_VELOCITY, max_accel=JOINT_MAX_ACCEL):
+    """経由点の間を速度・加速度制限つき台形プロファイルで結び、interval 秒ごとにサンプリングする
+
+    各区間は全関節が同時に出発・停止し、区間時間は最も遅い関節で決まる（時間最短）。
+    戻り値は (時刻の配列 (n,), 角度のint16配列 (n, 6))。先頭は最初の経由点、末尾は最後の経由点。
+    """
+    wp = np.asarray(waypoints, dtype=np.float64).reshape(-1, NUM_JOINTS)
+    if len(wp) < 2:
+        return np.zeros(len(wp)), wp.astype(np.int16)
+    delta = np.diff(wp, axis=0)
+    distance = np.abs(delta)
+    durations = _segment_durations(distance, max_velocity, max_accel)
+    velocity = _cruise_velocity(distance, durations, max_accel)
+    ends = np.cumsum(durations)
+    total = ends[-1]
+
+    # 全体を一様な時刻格子でサンプリングし、各時刻が属する区間を求める
+    times = np.arange(0.0, total, interval)
+    seg = np.minimum(np.searchsorted(ends, times, side='right'), len(durations) - 1)
+    t = times - (ends[seg] - durations[seg])
+    T = durations[seg][:, None]
+    v = velocity[seg]
+    a = np.broadcast_to(max_accel, v.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ta = np.where(v > 0, v / a, 0.0)
+    tt = t[:, None]
+    d = distance[seg]
+    progress = np.where(
+        tt < ta,
+        0.5 * a * tt ** 2,
+        np.where(tt <= T - ta, 0.5 * a * ta ** 2 + v * (tt - ta), d - 0.5 * a * (T - tt) ** 2),
+    )
+    progress = np.clip(progress, 0.0, d)
+    angles = wp[seg] + np.sign(delta[seg]) * progress
+
+    out = np.empty((len(times) + 1, NUM_JOINTS), dtype=np.int16)
+    out[:-1] = np.rint(angles)
+    out[-1] = wp[-1]
+    return np.append(times, total), out
+
+
+def plan_last_segment_start(waypoints, interval, max_velocity=JOINT_MAX_VELOCITY, max_accel=JOINT_MAX_ACCEL):
+    """plan_waypoints(waypoints, interval) の軌道で、最後の区間に入る最初のフレーム番号
+
+    その前までのフレームは最後から2番目の経由点までの区間（軌道をサンプリングせずに区間時間だけで求める）。
+    """
+    wp = np.asarray(waypoints, dtype=np.float64).reshape(-1, NUM_JOINTS)
+    if len(wp) < 2:
+        return len(wp)
+    ends = np.cumsum(_segment_durations(np.abs(np.diff(wp, axis=0)), max_velocity, max_accel))
+    # plan_waypoints と同じ時刻格子で数える
+    return int(np.count_nonzero(np.arange(0.0, ends[-1], interval) < (ends[-2] if len(ends) > 1 else 0.0)))
+
+
+def plan_sequence(action_sequence, init_position, interval, start_position=None, **limits):
+    """初期位置→動作→初期位置を台形プロファイルで計画する
+
+    start_position を渡すと、初期位置ではなくその姿勢（中断された動作の途中など）から直接つなぐ。
+    """
+    start = init_position if start_position is None else start_position
+    return plan_waypoints([start] + list(action_sequence) + [init_position], interval, **limits)
@@ -0,0 +1,195 @@
+"""角度シーケンスのバッチ前処理（検証・最適化・コンパイルを複数プロセスで並列に行う）
+
+    python preprocess.py angle_sequences.json                    # 1ファイルを compiled.actlib に
+    python preprocess.py designs/ more.json -o show.actlib        # ディレクトリ（*.json を再帰的に探す）と複数ファイル
+    python preprocess.py designs/ --profile trapezoid --jobs 8    # 台形プロファイル、8プロセス
+
+入力の形式は次のどちらか（ファイルごとに混在してよい）:
+    angle_sequences.json 形式 {"名前": [[角度×6], ...]}            経由点をそのままつなぐ
+    robotaction.json 形式     {"名前": {"sequence": [[角度×6], ...]}} 初期位置→動作→初期位置（robotactionBLE.py と同じ）
+
+各シーケンスを検証（6関節か、稼働範囲内か）し、続けて同じ経由点を1つにまとめてからコンパイルする。
+通ったものを1つのアクションライブラリ（action_library.py の形式）に書き出し、シーケンスごとの
+フレーム数・再生時間・送信バイト数とエラーをレポート（JSON）にまとめる。確認の入力は求めない。
+1件でも失敗したら終了コードは1。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from action_library import NAME_SIZE, write_library
+from planner import plan_waypoints
+from protocol import ANGLE_FRAME_SIZE, encode_delta_frames
+from trajectory import compile_waypoints, validate_actions
+
+DEFAULT_OUTPUT = "compiled.actlib"
+DEFAULT_REPORT = "preprocess_report.json"
+# 1回にワーカーへ渡すシーケンス数の目安（ワーカー数 × この値 に分ける）
+CHUNKS_PER_WORKER = 4
+
+
+def find_inputs(paths, exclude=()):
+    """ファイルとディレクトリの一覧から、読み込むJSONファイルを並び順を保って返す"""
+    exclude = {os.path.abspath(p) for p in exclude}
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".json"))
+        else:
+            files.append(path)
+    return [f for f in dict.fromkeys(files) if os.path.abspath(f) not in exclude]
+
+
+def _dedupe_waypoints(waypoints):
+    """続けて同じ経由点を1つにまとめる（長さ0の区間は止まるだけのフレームになる）"""
+    wp = np.asarray(waypoints).reshape(-1, 6)
+    keep = np.ones(len(wp), dtype=bool)
+    keep[1:] = np.any(wp[1:] != wp[:-1], axis=1)
+    return wp[keep].tolist(), int((~keep).sum())
+
+
+def compile_task(task):
+    """1シーケンスを検証・最適化・コンパイルする（ワーカープロセスで実行する）
+
+    task は (ファイル, 名前, 定義, パラメータ)。パラメータは (方式, 最小ステップ, 周期, 初期位置, 最適化するか)。
+    戻り値は (レポートの項目, 軌道)。失敗したら軌道は None で、項目に error が入る。
+    """
+    source, name, definition, (profile, min_step, interval, init_position, optimize) = task
+    item = {"file": source, "name": name}
+    try:
+        if len(name.encode("utf-8")) > NAME_SIZE:
+            raise ValueError(f"名前が長すぎます（{NAME_SIZE}バイトまで）")
+        action = definition if isinstance(definition, dict) else {"sequence": definition}
+        validate_actions({name: action})
+        sequence = action["sequence"]
+        removed = 0
+        if optimize:
+            sequence, removed = _dedupe_waypoints(sequence)
+        if isinstance(definition, dict):
+            # robotaction.json 形式は初期位置から始めて初期位置に戻る
+            waypoints = [init_position] + list(sequence) + [init_position]
+        else:
+            waypoints = sequence
+        if profile == "trapezoid":
+            trajectory = plan_waypoints(waypoints, interval)[1]
+        else:
+            trajectory = compile_waypoints(waypoints, min_step)
+    except Exception as e:
+        item["error"] = str(e)
+        return item, None
+    deltas = encode_delta_frames(trajectory)
+    item.update({
+        "waypoints": len(action["sequence"]),
+        "waypoints_removed": removed,
+        "frames": len(trajectory),
+        "duration_s": round(len(trajectory) * interval, 3),
+        "binary_bytes": len(trajectory) * ANGLE_FRAME_SIZE,
+        "delta_bytes": sum(len(frame) for frame in deltas if frame is not None),
+    })
+    return item, trajectory
+
+
+def collect_tasks(files, params):
+    """入力ファイルを読み込んで (タスクの一覧, 読み込めなかったファイル・重複した名前のエラー) を返す"""
+    tasks = []
+    errors = []
+    defined = {}
+    for path in files:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("シーケンス名をキーにしたオブジェクトである必要があります")
+        except Exception as e:
+            errors.append({"file": path, "name": None, "error": f"読み込めません: {e}"})
+            continue
+        for name, definition in data.items():
+            if name in defined:
+                errors.append({"file": path, "name": name, "error": f"名前が重複しています（最初の定義: {defined[name]}）"})
+                continue
+            defined[name] = path
+            tasks.append((path, name, definition, params))
+    return tasks, errors
+
+
+def run(tasks, jobs):
+    """タスクをプロセスプールで並列に処理する（jobs=1ならこのプロセスで順に処理する）"""
+    if jobs <= 1 or len(tasks) <= 1:
+        return list(map(compile_task, tasks))
+    chunksize = max(1, len(tasks) // (jobs * CHUNKS_PER_WORKER))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(compile_task, tasks, chunksize=chunksize))
+
+
+def main(argv=None):
+    import robotactionBLE
+
+    parser = argparse.ArgumentParser(description="角度シーケンスを並列に検証・最適化・コンパイルしてアクションライブラリにまとめる")
+    parser.add_argument("inputs", nargs="+", help="シーケンスのJSONファイルまたはディレクトリ")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT, help="書き出すアクションライブラリ")
+    parser.add_argument("--report", default=DEFAULT_REPORT, help="書き出すレポート（JSON）")
+    parser.add_argument("--profile", choices=["linear", "trapezoid"], default="linear",
+                        help="軌道の生成方法（linear: 最小ステップ刻み、trapezoid: 速度・加速度制限つき）")
+    parser.add_argument("--min-step", type=int, default=robotactionBLE.MINIMUM_STEP, help="linear の最小ステップ（度）")
+    parser.add_argument("--interval", type=float, default=robotactionBLE.DELAY_BETWEEN_STEPS, help="フレーム間隔（秒）")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument("--no-optimize", action="store_true", help="続けて同じ経由点をまとめない")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    params = (args.profile, args.min_step, args.interval, list(robotactionBLE.INIT_POSITION), not args.no_optimize)
+    files = find_inputs(args.inputs, exclude=[args.report])
+    tasks, errors = collect_tasks(files, params)
+    results = run(tasks, args.jobs)
+
+    trajectories = {}
+    items = []
+    for item, trajectory in results:
+        if trajectory is None:
+            errors.append(item)
+        else:
+            trajectories[item["name"]] = trajectory
+            items.append(item)
+    if trajectories:
+        write_library(args.output, trajectories, params=params)
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "inputs": args.inputs,
+        "output": args.output if trajectories else None,
+        "profile": args.profile,
+        "min_step": args.min_step,
+        "interval": args.interval,
+        "jobs": args.jobs,
+        "seconds": round(elapsed, 3),
+        "files": len(files),
+        "compiled": len(items),
+        "failed": len(errors),
+        "frames": sum(item["frames"] for item in items),
+        "waypoints_removed": sum(item["waypoints_removed"] for item in items),
+        "binary_bytes": sum(item["binary_bytes"] for item in items),
+        "delta_bytes": sum(item["delta_bytes"] for item in items),
+        "errors": errors,
+        "sequences": items,
+    }
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    for error in errors:
+        print(f"エラー: {error['file']} {error['name'] or ''}: {error['error']}")
+    print(f"{len(files)}ファイル・{len(items)}件のシーケンスをコンパイルしました"
+          f"（失敗 {len(errors)}件、{elapsed:.2f}秒、{args.jobs}プロセス）")
+    if trajectories:
+        print(f"アクションライブラリ: {args.output}")
+    print(f"レポート: {args.report}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,437 @@
+import numpy as np
+
+# 角度フレームのワイヤフォーマット
+#
+# ASCII: "角度1 角度2 角度3 角度4 角度5 角度6"（BLECentral.py などの手動操作用）
+# BIN1 : 17バイト固定長（リトルエンディアン）
+#   [0]     マジック 0xA5
+#   [1]     フレーム種別 0x01（角度フレーム）
+#   [2:4]   シーケンス番号 uint16
+#   [4:16]  6軸の角度 uint16 × 6
+#   [16]    チェックサム（先頭16バイトのXOR）
+# BAT1 : 複数フレームを1回の書き込みにまとめたバッチ（ファームウェア側のリングバッファで再生）
+#   [0]     マジック 0xA5
+#   [1]     フレーム種別 0x02（バッチ）
+#   [2:4]   先頭フレームのシーケンス番号 uint16
+#   [4]     フレーム数 uint8
+#   [5:7]   予約 uint16（0）
+#   以降    フレーム × 数: 前フレームからの待ち時間ms uint16 + 角度 uint16 × 6（14バイト）
+#   末尾    チェックサム（それまでの全バイトのXOR）
+# CLEAR: リングバッファの再生待ちフレームを破棄（中断・割り込み用、3バイト）
+#   [0] マジック 0xA5, [1] 種別 0x03, [2] チェックサム
+# STATUS: ファームウェアからの通知（フロー制御用、7バイト）
+#   [0]     マジック 0xA5
+#   [1]     フレーム種別 0x81（状態通知）
+#   [2]     リングバッファの使用数 uint8
+#   [3]     リングバッファの容量 uint8
+#   [4:6]   最後に再生したフレームのシーケンス番号 uint16
+#   [6]     チェックサム（先頭6バイトのXOR）
+# TELEMETRY: ファームウェアからの定期通知（TELEMETRY_INTERVAL_MSごと、25バイト）
+#   [0]     マジック 0xA5
+#   [1]     フレーム種別 0x82（テレメトリ）
+#   [2:4]   最後に適用したフレームのシーケンス番号 uint16
+#   [4:8]   デバイスの時刻 millis() uint32
+#   [8:20]  各サーボの現在角度 uint16 × 6（moveServo で実際に書き込んだ角度）
+#   [20:24] エンコーダのカウント int32
+#   [24]    チェックサム（先頭24バイトのXOR）
+# DELTA: 前のフレームから変わった関節だけを送る角度フレーム（DLT1、6 + 2×変わった関節数 バイト）
+#   [0]     マジック 0xA5
+#   [1]     フレーム種別 0x04（差分フレーム）
+#   [2:4]   シーケンス番号 uint16
+#   [4]     変わった関節のビットマスク uint8（ビットi = サーボi+1）
+#   以降    変わった関節の角度 uint16 × ビット数（関節番号の小さい順）
+#   末尾    チェックサム（それまでの全バイトのXOR）
+#   マスクが0のフレームは角度を変えずにシーケンス番号だけを進める
+# DELTA BATCH: 差分フレームを1回の書き込みにまとめたバッチ（DLT1 + BAT1）
+#   ヘッダはBAT1と同じ（種別 0x05）
+#   以降    フレーム × 数: 前フレームからの待ち時間ms uint16 + ビットマスク uint8 + 変わった関節の角度 uint16 × ビット数
+#   末尾    チェックサム（それまでの全バイトのXOR）
+#   各バッチの先頭フレームは全関節を含める（マスク 0x3F）ので、バッチ単位で復元できる
+
+FRAME_MAGIC = 0xA5
+FRAME_TYPE_ANGLES = 0x01
+FRAME_TYPE_BATCH = 0x02
+FRAME_TYPE_CLEAR = 0x03
+FRAME_TYPE_DELTA = 0x04
+FRAME_TYPE_DELTA_BATCH = 0x05
+FRAME_TYPE_STATUS = 0x81
+FRAME_TYPE_TELEMETRY = 0x82
+
+PROTOCOL_ASCII = "ascii"
+PROTOCOL_BINARY = "binary"
+PROTOCOL_BATCH = "batch"
+# バッチ + 応答なし書き込み + 通知によるフロー制御
+PROTOCOL_STREAM = "stream"
+
+# ファームウェアがキャラクタリスティックの読み出し値として公開する対応プロトコル
+PROTOCOL_CAPS_PREFIX = b"PROTO"
+PROTOCOL_CAPS_BINARY = b"BIN1"
+PROTOCOL_CAPS_BATCH = b"BAT1"
+PROTOCOL_CAPS_FLOW = b"FLOW1"
+PROTOCOL_CAPS_TELEMETRY = b"TLM1"
+PROTOCOL_CAPS_DELTA = b"DLT1"
+
+# ATTヘッダ分（書き込み1回のペイロードは MTU - 3）
+ATT_HEADER_SIZE = 3
+
+ANGLE_FRAME_DTYPE = np.dtype([
+    ("magic", "u1"),
+    ("type", "u1"),
+    ("seq", "<u2"),
+    ("angles", "<u2", (6,)),
+    ("checksum", "u1"),
+])
+ANGLE_FRAME_SIZE = ANGLE_FRAME_DTYPE.itemsize
+
+BATCH_HEADER_DTYPE = np.dtype([
+    ("magic", "u1"),
+    ("type", "u1"),
+    ("seq", "<u2"),
+    ("count", "u1"),
+    ("reserved", "<u2"),
+])
+BATCH_ENTRY_DTYPE = np.dtype([
+    ("dt_ms", "<u2"),
+    ("angles", "<u2", (6,)),
+])
+BATCH_HEADER_SIZE = BATCH_HEADER_DTYPE.itemsize
+BATCH_ENTRY_SIZE = BATCH_ENTRY_DTYPE.itemsize
+
+DELTA_HEADER_SIZE = 5
+# 差分バッチの1フレームの固定部分（待ち時間 + ビットマスク）
+DELTA_ENTRY_HEADER_SIZE = 3
+# 全関節が変わったことを表すビットマスク
+DELTA_FULL_MASK = 0x3F
+# ビットマスクの各ビットの重み
+_JOINT_BITS = 1 << np.arange(6)
+
+STATUS_DTYPE = np.dtype([
+    ("magic", "u1"),
+    ("type", "u1"),
+    ("fill", "u1"),
+    ("capacity", "u1"),
+    ("last_seq", "<u2"),
+    ("checksum", "u1"),
+])
+STATUS_SIZE = STATUS_DTYPE.itemsize
+
+TELEMETRY_DTYPE = np.dtype([
+    ("magic", "u1"),
+    ("type", "u1"),
+    ("seq", "<u2"),
+    ("device_ms", "<u4"),
+    ("angles", "<u2", (6,)),
+    ("encoder", "<i4"),
+    ("checksum", "u1"),
+])
+TELEMETRY_SIZE = TELEMETRY_DTYPE.itemsize
+
+
+def encode_ascii_frame(angles):
+    """角度セットを空白区切りのASCIIコマンドにする"""
+    return ' '.join(map(str, angles)).encode('utf-8')
+
+
+def encode_binary_frames(trajectory, start_seq=0):
+    """軌道 (steps, 6) をまとめてBIN1フレーム列（bytesのリスト）にエンコードする"""
+    angles = np.asarray(trajectory).reshape(-1, 6)
+    frames = np.zeros(len(angles), dtype=ANGLE_FRAME_DTYPE)
+    frames["magic"] = FRAME_MAGIC
+    frames["type"] = FRAME_TYPE_ANGLES
+    frames["seq"] = (start_seq + np.arange(len(angles))) & 0xFFFF
+    frames["angles"] = angles
+    raw = frames.view(np.uint8).reshape(len(angles), ANGLE_FRAME_SIZE)
+    raw[:, -1] = np.bitwise_xor.reduce(raw[:, :-1], axis=1)
+    buf = raw.tobytes()
+    return [buf[i:i + ANGLE_FRAME_SIZE] for i in range(0, len(buf), ANGLE_FRAME_SIZE)]
+
+
+def decode_binary_frame(data):
+    """BIN1フレームを (seq, angles) に復号する。不正なフレームは ValueError"""
+    if len(data) != ANGLE_FRAME_SIZE or data[0] != FRAME_MAGIC or data[1] != FRAME_TYPE_ANGLES:
+        raise ValueError("不正なバイナリフレームです")
+    frame = np.frombuffer(bytes(data), dtype=ANGLE_FRAME_DTYPE)[0]
+    checksum = 0
+    for b in data[:-1]:
+        checksum ^= b
+    if checksum != data[-1]:
+        raise ValueError("チェックサムが一致しません")
+    return int(frame["seq"]), frame["angles"].tolist()
+
+
+def batch_capacity(mtu):
+    """MTUから1回の書き込みに入るフレーム数を求める"""
+    payload = mtu - ATT_HEADER_SIZE - BATCH_HEADER_SIZE - 1
+    return max(0, min(255, payload // BATCH_ENTRY_SIZE))
+
+
+def encode_batch_frames(trajectory, interval_ms, mtu, start_seq=0, dt_ms=None):
+    """軌道をMTUに収まるBAT1バッチ（bytesのリスト）に分割してエンコードする
+
+    dt_ms を省略すると全フレームを interval_ms 間隔で再生する（先頭フレームは即時）。
+    """
+    angles = np.asarray(trajectory).reshape(-1, 6)
+    per_batch = batch_capacity(mtu)
+    if per_batch == 0:
+        raise ValueError(f"MTU {mtu} ではバッチ送信できません")
+    entries = np.zeros(len(angles), dtype=BATCH_ENTRY_DTYPE)
+    entries["dt_ms"] = interval_ms if dt_ms is None else dt_ms
+    entries["angles"] = angles
+    batches = []
+    for offset in range(0, len(angles), per_batch):
+        chunk = entries[offset:offset + per_batch]
+        header = np.zeros(1, dtype=BATCH_HEADER_DTYPE)
+        header["magic"] = FRAME_MAGIC
+        header["type"] = FRAME_TYPE_BATCH
+        header["seq"] = (start_seq + offset) & 0xFFFF
+        header["count"] = len(chunk)
+        body = np.concatenate([header.view(np.uint8), chunk.view(np.uint8)])
+        checksum = np.bitwise_xor.reduce(body)
+        batches.append(body.tobytes() + bytes([checksum]))
+    return batches
+
+
+def decode_batch_frames(data):
+    """BAT1バッチを (先頭seq, dt_msの配列, (n, 6)の角度配列) に復号する。不正なら ValueError"""
+    if len(data) < BATCH_HEADER_SIZE + 1 or data[0] != FRAME_MAGIC or data[1] != FRAME_TYPE_BATCH:
+        raise ValueError("不正なバッチフレームです")
+    raw = np.frombuffer(bytes(data), dtype=np.uint8)
+    if np.bitwise_xor.reduce(raw[:-1]) != raw[-1]:
+        raise ValueError("チェックサムが一致しません")
+    header = raw[:BATCH_HEADER_SIZE].view(BATCH_HEADER_DTYPE)[0]
+    count = int(header["count"])
+    if len(data) != BATCH_HEADER_SIZE + count * BATCH_ENTRY_SIZE + 1:
+        raise ValueError("バッチフレームの長さが不正です")
+    entries = raw[BATCH_HEADER_SIZE:-1].view(BATCH_ENTRY_DTYPE)
+    return int(header["seq"]), entries["dt_ms"].copy(), entries["angles"].copy()
+
+
+def delta_masks(trajectory):
+    """各フレームで前のフレームから変わった関節のビットマスク（先頭フレームは全関節）"""
+    angles = np.asarray(trajectory).reshape(-1, 6)
+    changed = np.ones(angles.shape, dtype=bool)
+    changed[1:] = angles[1:] != angles[:-1]
+    return changed @ _JOINT_BITS
+
+
+def _checksum_frame(body):
+    checksum = 0
+    for b in body:
+        checksum ^= b
+    body.append(checksum)
+    return bytes(body)
+
+
+def encode_delta_frame(angles, mask, seq=0):
+    """角度セットのうち mask の関節だけを含む差分フレームにエンコードする"""
+    body = bytearray([FRAME_MAGIC, FRAME_TYPE_DELTA, seq & 0xFF, (seq >> 8) & 0xFF, mask])
+    for i in range(6):
+        if mask >> i & 1:
+            body += int(angles[i]).to_bytes(2, "little")
+    return _checksum_frame(body)
+
+
+def encode_delta_frames(trajectory, start_seq=0):
+    """軌道を「前のフレームとの差分」のフレーム列にエンコードする
+
+    先頭フレームと全関節が変わったフレームはBIN1（差分フレームより短い）、
+    何も変わらないフレームは None にする（送らなくてよい）。
+    """
+    angles = np.asarray(trajectory).reshape(-1, 6)
+    full = encode_binary_frames(angles, start_seq)
+    frames = []
+    for i, mask in enumerate(delta_masks(angles).tolist()):
+        if mask == DELTA_FULL_MASK:
+            frames.append(full[i])
+        elif mask == 0:
+            frames.append(None)
+        else:
+            frames.append(encode_delta_frame(angles[i], mask, start_seq + i))
+    return frames
+
+
+def decode_delta_frame(data):
+    """差分フレームを (seq, 関節番号のリスト, 角度のリスト) に復号する。不正なら ValueError"""
+    if len(data) < DELTA_HEADER_SIZE + 1 or data[0] != FRAME_MAGIC or data[1] != FRAME_TYPE_DELTA:
+        raise ValueError("不正な差分フレームです")
+    mask = data[4]
+    joints = [i for i in range(6) if mask >> i & 1]
+    if mask > DELTA_FULL_MASK or len(data) != DELTA_HEADER_SIZE + 2 * len(joints) + 1:
+        raise ValueError("差分フレームの長さが不正です")
+    checksum = 0
+    for b in data[:-1]:
+        checksum ^= b
+    if checksum != data[-1]:
+        raise ValueError("チェックサムが一致しません")
+    angles = [data[DELTA_HEADER_SIZE + 2 * n] | (data[DELTA_HEADER_SIZE + 2 * n + 1] << 8) for n in range(len(joints))]
+    return data[2] | (data[3] << 8), joints, angles
+
+
+def encode_delta_batch_frames(trajectory, interval_ms, mtu, start_seq=0, dt_ms=None, max_frames=255):
+    """軌道を差分バッチ（bytesのリスト）にエンコードする。引数と再生タイミングは encode_batch_frames と同じ
+
+    1フレームの長さが変わった関節の数で変わるので、MTUに収まるだけ詰めて分割する。
+    何も変わらないフレームは3バイト（待ち時間とマスク0）になり、MTU 247 なら70フレーム以上入るので、
+    1バッチのフレーム数は max_frames（デバイスのリングバッファ容量を渡す）までに抑える。
+    """
+    angles = np.asarray(trajectory).reshape(-1, 6).astype("<u2")
+    payload = mtu - ATT_HEADER_SIZE - BATCH_HEADER_SIZE - 1
+    if payload < DELTA_ENTRY_HEADER_SIZE + 12:
+        raise ValueError(f"MTU {mtu} ではバッチ送信できません")
+    masks = delta_masks(angles).tolist()
+    dts = np.broadcast_to(np.asarray(interval_ms if dt_ms is None else dt_ms, dtype="<u2"), len(angles)).tolist()
+    batches = []
+    i = 0
+    while i < len(angles):
+        body = bytearray([FRAME_MAGIC, FRAME_TYPE_DELTA_BATCH, (start_seq + i) & 0xFF, ((start_seq + i) >> 8) & 0xFF, 0, 0, 0])
+        count = 0
+        while i < len(angles) and count < min(max_frames, 255):
+            # バッチの先頭は全関節を送る
+            mask = DELTA_FULL_MASK if count == 0 else masks[i]
+            joints = _JOINT_BITS & mask != 0
+            size = DELTA_ENTRY_HEADER_SIZE + 2 * int(joints.sum())
+            if len(body) - BATCH_HEADER_SIZE + size > payload:
+                break
+            body += dts[i].to_bytes(2, "little")
+            body.append(mask)
+            body += angles[i][joints].tobytes()
+            count += 1
+            i += 1
+        body[4] = count
+        batches.append(_checksum_frame(body))
+    return batches
+
+
+def decode_delta_batch_frames(data):
+    """差分バッチを (先頭seq, dt_msの配列, (n, 6)の角度配列) に復号する。不正なら ValueError"""
+    if len(data) < BATCH_HEADER_SIZE + 1 or data[0] != FRAME_MAGIC or data[1] != FRAME_TYPE_DELTA_BATCH:
+        raise ValueError("不正な差分バッチです")
+    raw = np.frombuffer(bytes(data), dtype=np.uint8)
+    if np.bitwise_xor.reduce(raw[:-1]) != raw[-1]:
+        raise ValueError("チェックサムが一致しません")
+    count = data[4]
+    dt_ms = np.zeros(count, dtype=np.uint16)
+    angles = np.zeros((count, 6), dtype=np.uint16)
+    pos = BATCH_HEADER_SIZE
+    for n in range(count):
+        if pos + DELTA_ENTRY_HEADER_SIZE > len(data) - 1:
+            raise ValueError("差分バッチの長さが不正です")
+        dt_ms[n] = data[pos] | (data[pos + 1] << 8)
+        mask = data[pos + 2]
+        if mask > DELTA_FULL_MASK or (n == 0 and mask != DELTA_FULL_MASK):
+            raise ValueError("差分バッチのビットマスクが不正です")
+        pos += DELTA_ENTRY_HEADER_SIZE
+        if n > 0:
+            angles[n] = angles[n - 1]
+        for i in range(6):
+            if mask >> i & 1:
+                if pos + 2 > len(data) - 1:
+                    raise ValueError("差分バッチの長さが不正です")
+                angles[n, i] = data[pos] | (data[pos + 1] << 8)
+                pos += 2
+    if pos != len(data) - 1:
+        raise ValueError("差分バッチの長さが不正です")
+    return int(data[2] | (data[3] << 8)), dt_ms, angles
+
+
+def encode_clear_frame():
+    """リングバッファを空にするCLEARフレーム"""
+    return bytes([FRAME_MAGIC, FRAME_TYPE_CLEAR, FRAME_MAGIC ^ FRAME_TYPE_CLEAR])
+
+
+def is_status_packet(data):
+    """ファームウェアからの状態通知かどうか"""
+    return len(data) >= 2 and data[0] == FRAME_MAGIC and data[1] == FRAME_TYPE_STATUS
+
+
+def encode_status(fill, capacity, last_seq):
+    """状態通知をエンコードする（シミュレーションやテスト用）"""
+    body = bytes([FRAME_MAGIC, FRAME_TYPE_STATUS, fill, capacity, last_seq & 0xFF, (last_seq >> 8) & 0xFF])
+    checksum = 0
+    for b in body:
+        checksum ^= b
+    return body + bytes([checksum])
+
+
+def decode_status(data):
+    """状態通知を (使用数, 容量, 最後に再生したseq) に復号する。不正なら ValueError"""
+    if len(data) != STATUS_SIZE or not is_status_packet(data):
+        raise ValueError("不正な状態通知です")
+    checksum = 0
+    for b in data[:-1]:
+        checksum ^= b
+    if checksum != data[-1]:
+        raise ValueError("チェックサムが一致しません")
+    return data[2], data[3], data[4] | (data[5] << 8)
+
+
+def is_device_packet(data):
+    """ファームウェアからのバイナリ通知（状態通知・テレメトリ）かどうか"""
+    return len(data) >= 2 and data[0] == FRAME_MAGIC and data[1] & 0x80 != 0
+
+
+def is_telemetry_packet(data):
+    """ファームウェアからのテレメトリ通知かどうか"""
+    return len(data) >= 2 and data[0] == FRAME_MAGIC and data[1] == FRAME_TYPE_TELEMETRY
+
+
+def encode_telemetry(seq, device_ms, angles, encoder):
+    """テレメトリ通知をエンコードする（シミュレーションやテスト用）"""
+    packet = np.zeros(1, dtype=TELEMETRY_DTYPE)
+    packet["magic"] = FRAME_MAGIC
+    packet["type"] = FRAME_TYPE_TELEMETRY
+    packet["seq"] = seq & 0xFFFF
+    packet["device_ms"] = device_ms & 0xFFFFFFFF
+    packet["angles"] = angles
+    packet["encoder"] = encoder
+    raw = packet.view(np.uint8)
+    raw[-1] = np.bitwise_xor.reduce(raw[:-1])
+    return raw.tobytes()
+
+
+def decode_telemetry(data):
+    """テレメトリ通知を (seq, デバイス時刻ms, 角度(6,), エンコーダ) に復号する。不正なら ValueError"""
+    if len(data) != TELEMETRY_SIZE or not is_telemetry_packet(data):
+        raise ValueError("不正なテレメトリ通知です")
+    raw = np.frombuffer(bytes(data), dtype=np.uint8)
+    if np.bitwise_xor.reduce(raw[:-1]) != raw[-1]:
+        raise ValueError("チェックサムが一致しません")
+    packet = raw.view(TELEMETRY_DTYPE)[0]
+    return int(packet["seq"]), int(packet["device_ms"]), packet["angles"].astype(np.int16), int(packet["encoder"])
+
+
+def encode_frames(trajectory, protocol, start_seq=0):
+    """プロトコルに応じて軌道全体を送信用フレーム列にする"""
+    if protocol in (PROTOCOL_BINARY, PROTOCOL_BATCH, PROTOCOL_STREAM):
+        return encode_binary_frames(trajectory, start_seq)
+    return [encode_ascii_frame(angles) for angles in np.asarray(trajectory).tolist()]
+
+
+def parse_protocol_caps(value):
+    """キャラクタリスティックの読み出し値から使用するプロトコルを決める"""
+    value = bytes(value or b"")
+    if not value.startswith(PROTOCOL_CAPS_PREFIX):
+        return PROTOCOL_ASCII
+    caps = value.split()
+    if PROTOCOL_CAPS_BATCH in caps and PROTOCOL_CAPS_FLOW in caps:
+        return PROTOCOL_STREAM
+    if PROTOCOL_CAPS_BATCH in caps:
+        return PROTOCOL_BATCH
+    if PROTOCOL_CAPS_BINARY in caps:
+        return PROTOCOL_BINARY
+    return PROTOCOL_ASCII
+
+
+def has_capability(value, capability):
+    """対応プロトコルの読み出し値に capability（例: TLM1）が含まれるか"""
+    value = bytes(value or b"")
+    return value.startswith(PROTOCOL_CAPS_PREFIX) and capability in value.split()
+
+
+async def read_protocol_caps(client, characteristic_uuid):
+    """ファームウェアの対応プロトコルを読み出す（失敗時は空＝ASCIIのみ）"""
+    try:
+        return bytes(await client.read_gatt_char(characteristic_uuid))
+    except Exception as e:
+        print(f"[BLE] プロトコル確認に失敗しました（ASCIIを使用）: {e}")
+        return b""
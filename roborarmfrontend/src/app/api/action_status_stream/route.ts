@@ -0,0 +1,22 @@
+import { NextRequest } from 'next/server';
+
+// robotarm_api の Server-Sent Events をそのまま中継する（ポーリング不要）
+export async function GET(req: NextRequest) {
+  const { searchParams } = new URL(req.url);
+  const action_id = searchParams.get('action_id');
+  if (!action_id) {
+    return new Response(JSON.stringify({ status: 'unknown' }), { status: 400 });
+  }
+  const res = await fetch(
+    `http://localhost:8000/action_status/stream?action_id=${encodeURIComponent(action_id)}`,
+    { signal: req.signal, cache: 'no-store' }
+  );
+  return new Response(res.body, {
+    status: res.status,
+    headers: {
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache',
+      Connection: 'keep-alive',
+    },
+  });
+}
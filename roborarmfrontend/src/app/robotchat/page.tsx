@@ -108,24 +108,25 @@ export default function RobotChatPage() {
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState("");
   const [actionStatus, setActionStatus] = useState<"pending" | "done" | "unknown">("done");
-  const pollingRef = useRef<NodeJS.Timeout | null>(null);
+  const eventSourceRef = useRef<EventSource | null>(null);
   const autoSendTimerRef = useRef<NodeJS.Timeout | null>(null);
   const speechButtonRef = useRef<any>(null);
 
   useEffect(() => {
     if (response?.action_id) {
       setActionStatus("pending");
-      // ポーリング開始
-      pollingRef.current = setInterval(async () => {
-        const res = await fetch(`/api/action_status_proxy?action_id=${response.action_id}`);
-        const data = await res.json();
-        if (data.status === "done") {
+      // 状態の変化をサーバーからプッシュで受け取る（Server-Sent Events）
+      const source = new EventSource(`/api/action_status_stream?action_id=${response.action_id}`);
+      eventSourceRef.current = source;
+      source.onmessage = (e) => {
+        const data = JSON.parse(e.data);
+        if (data.status === "done" || data.status === "cancelled" || String(data.status).startsWith("error")) {
           setActionStatus("done");
-          if (pollingRef.current) clearInterval(pollingRef.current);
+          source.close();
         }
-      }, 2000);
+      };
       return () => {
-        if (pollingRef.current) clearInterval(pollingRef.current);
+        source.close();
       };
     } else {
       setActionStatus("done");
@@ -1,81 +1,235 @@
 import asyncio
-import sys
-import json
-import time
-from bleak import BleakClient, BleakScanner
+from transport import get_transport
 import numpy as np
+from trajectory import compile_last_segment_start, compile_sequence, compile_waypoints, load_actions, validate_actions
+from planner import plan_last_segment_start, plan_sequence, plan_waypoints, JOINT_MAX_VELOCITY, JOINT_MAX_ACCEL
+from kinematics import ArmKinematics, CARTESIAN_SPEED, UnreachableError
+from action_library import LibraryWatcher, open_library
+from protocol import (
+    PROTOCOL_ASCII,
+    PROTOCOL_BATCH,
+    PROTOCOL_STREAM,
+    PROTOCOL_CAPS_DELTA,
+    has_capability,
+    parse_protocol_caps,
+    read_protocol_caps,
+)
+from streaming import (
+    FlowController,
+    FrameEncoder,
+    PacedScheduler,
+    can_send_batched,
+    send_paced_frames,
+    send_trajectory_batched,
+    send_trajectory_flow_controlled,
+)
+from metrics import BLE_CONNECT_SECONDS, BLE_SCAN_SECONDS, LogSampler
 
 # BLE設定
 BLE_DEVICE_NAME = "ESP32 BLE Device"
 BLE_CHARACTERISTIC_UUID = "beb5483e-36e1-4688-b7f5-ea07361b26a8"
 DELAY_BETWEEN_STEPS = 0.02  # 秒
 MINIMUM_STEP = 10  # 角度の最小ステップ（度）
+# 軌道の生成方法（"trapezoid": 各サーボの速度・加速度制限つき台形プロファイル、"linear": MINIMUM_STEP刻みの線形補間）
+MOTION_PROFILE = "trapezoid"
 
 # 初期位置
 INIT_POSITION = [135, 200, 30, 45, 90, 90]
 
+# アクション定義ファイル（コンパイル済みの軌道は robotaction.actlib にまとめてキャッシュする）
+ACTION_FILE = "robotaction.json"
+
+# リンクの長さ・サーボの基準角（kinematics.json があれば実機の寸法）
+KINEMATICS = ArmKinematics.from_config()
+
 # グローバルなBLEクライアント・デバイス
 ble_client = None
 ble_device = None
-
-def interpolate_angles(start_angles, end_angles, min_step):
-    max_diff = max([abs(end - start) for start, end in zip(start_angles, end_angles)])
-    steps = max(1, int(np.ceil(max_diff / min_step)))
-    angle_steps = []
-    for i in range(steps + 1):
-        t = i / steps
-        interpolated = [int(start + (end - start) * t) for start, end in zip(start_angles, end_angles)]
-        angle_steps.append(interpolated)
-    return angle_steps
+ble_protocol = PROTOCOL_ASCII
+ble_flow = None
+ble_delta = False
+# BLE（実機）またはシミュレーション（ROBOTARM_TRANSPORT=sim）
+transport = get_transport()
+# APIサーバーでは robotaction.json を監視し、検証済みの定義とライブラリを差し替える（start_action_watcher）
+action_watcher = None
 
 def generate_full_sequence(action_sequence):
-    # 初期位置→動作→初期位置
-    full_seq = []
-    # 初期位置→動作の最初
-    full_seq.extend(interpolate_angles(INIT_POSITION, action_sequence[0], MINIMUM_STEP)[1:])
-    # 動作本体
-    for i in range(len(action_sequence) - 1):
-        full_seq.extend(interpolate_angles(action_sequence[i], action_sequence[i+1], MINIMUM_STEP)[1:])
-    # 動作の最後→初期位置
-    full_seq.extend(interpolate_angles(action_sequence[-1], INIT_POSITION, MINIMUM_STEP)[1:])
-    # 先頭に初期位置
-    return [INIT_POSITION] + full_seq
-
-async def send_sequence_ble(client, sequence):
-    for i, angles in enumerate(sequence):
-        angle_str = ' '.join(map(str, angles))
-        await client.write_gatt_char(BLE_CHARACTERISTIC_UUID, angle_str.encode('utf-8'))
-        print(f"送信: {angle_str}")
-        await asyncio.sleep(DELAY_BETWEEN_STEPS)
-    print("シーケンス送信完了")
+    # 初期位置→動作→初期位置（先頭は初期位置、DELAY_BETWEEN_STEPSごとのフレーム）
+    if MOTION_PROFILE == "trapezoid":
+        return plan_sequence(action_sequence, INIT_POSITION, DELAY_BETWEEN_STEPS)[1]
+    return compile_sequence(action_sequence, MINIMUM_STEP, INIT_POSITION)
+
+def _library_params():
+    # この値が変わったらライブラリを作り直す
+    if MOTION_PROFILE == "trapezoid":
+        return ("trapezoid", DELAY_BETWEEN_STEPS, tuple(INIT_POSITION),
+                tuple(JOINT_MAX_VELOCITY.tolist()), tuple(JOINT_MAX_ACCEL.tolist()))
+    return ("linear", MINIMUM_STEP, tuple(INIT_POSITION))
+
+def _compile_library_action(action_name, action_data):
+    return generate_full_sequence(action_data[action_name]["sequence"])
+
+def load_validated_actions(path=ACTION_FILE):
+    """アクション定義を読み込み、関節数と稼働範囲を検証する"""
+    action_data = load_actions(path)
+    validate_actions(action_data)
+    return action_data
+
+def get_action_library(path=ACTION_FILE):
+    """全アクションのコンパイル済み軌道（メモリマップ）。JSONが変更されたら自動で作り直す"""
+    return open_library(path, _library_params(), _compile_library_action, load_validated_actions)
+
+def load_action_set(path=ACTION_FILE):
+    """検証済みのアクション定義と、それをコンパイルしたライブラリの組"""
+    return load_validated_actions(path), get_action_library(path)
+
+def current_actions():
+    # 監視中なら差し替え済みのものを使う（ファイルI/Oなし）
+    if action_watcher is not None and action_watcher.current is not None:
+        return action_watcher.current
+    return load_actions(ACTION_FILE), get_action_library()
+
+async def start_action_watcher(path=ACTION_FILE):
+    """robotaction.json を読み込んで監視を始める。変更されたら検証してから差し替える"""
+    global action_watcher
+    if action_watcher is None:
+        action_watcher = LibraryWatcher(path, lambda: load_action_set(path))
+    await action_watcher.start()
+
+async def stop_action_watcher():
+    if action_watcher is not None:
+        await action_watcher.stop()
+
+def plan_path(waypoints):
+    """経由点をつなぐ軌道（MOTION_PROFILE の方法、先頭は最初の経由点）"""
+    if MOTION_PROFILE == "trapezoid":
+        return plan_waypoints(waypoints, DELAY_BETWEEN_STEPS)[1]
+    return compile_waypoints(waypoints, MINIMUM_STEP)
+
+def last_segment_start(waypoints):
+    """plan_path(waypoints) の軌道で、最後の区間に入る最初のフレーム番号"""
+    if MOTION_PROFILE == "trapezoid":
+        return plan_last_segment_start(waypoints, DELAY_BETWEEN_STEPS)
+    return compile_last_segment_start(waypoints, MINIMUM_STEP)
+
+def _chain_waypoints(action_names, start_position=None):
+    """開始姿勢と各アクションの経由点を並べたもの（最後の初期位置は含まない）"""
+    action_data, _ = current_actions()
+    unknown = [name for name in action_names if name not in action_data]
+    if unknown:
+        raise ValueError(f"未定義のactionです: {', '.join(unknown)}")
+    start = list(INIT_POSITION) if start_position is None else list(start_position)
+    return [start] + [angles for name in action_names for angles in action_data[name]["sequence"]]
+
+def compile_action_chain(action_names, start_position=None):
+    """複数のアクションを、間で初期位置に戻らずにつなぎ、最後に初期位置へ戻る軌道
+
+    各アクションの最後の経由点から次のアクションの最初の経由点へ直接動く。
+    """
+    return plan_path(_chain_waypoints(action_names, start_position) + [INIT_POSITION])
+
+def compile_action_sequence(action_name: str, start_position=None):
+    # 初期位置以外（中断された動作の途中など）から始める場合は、その姿勢から直接つなぐ
+    if start_position is not None and list(start_position) != INIT_POSITION:
+        return compile_action_chain([action_name], start_position)
+    # コンパイル済みライブラリから軌道のビューを取り出す（コピーもJSONの解析もしない）
+    action_data, library = current_actions()
+    return library[action_name]
+
+def compile_action_job(action, start_position=None):
+    """ジョブの軌道と、最後に初期位置へ戻る区間が始まるフレーム番号 (trajectory, home_frame)
+
+    action はアクション名、またはつないで実行するアクション名のリスト。
+    trajectory[:home_frame] で最後のアクションの最後の経由点まで動き、trajectory[home_frame:] で初期位置へ戻る。
+    """
+    names = action if isinstance(action, list) else [action]
+    waypoints = _chain_waypoints(names, start_position) + [INIT_POSITION]
+    if isinstance(action, list):
+        trajectory = plan_path(waypoints)
+    else:
+        trajectory = compile_action_sequence(action, start_position)
+    return trajectory, last_segment_start(waypoints)
+
+def compile_move_to(position, pitch=None, roll=None, gripper=None, linear=True, speed=CARTESIAN_SPEED,
+                    start_position=None):
+    """グリッパー先端を position（mm）へ動かす軌道。届かなければ kinematics.UnreachableError
+
+    linear=True ならグリッパー先端を直線で動かし（speed mm/秒）、False なら目標の姿勢まで関節ごとに動かす。
+    直線では動かせない（途中が稼働範囲外になる・特異点を通る）ときも関節ごとに動かす。
+    """
+    start = list(INIT_POSITION) if start_position is None else list(start_position)
+    if linear:
+        try:
+            return KINEMATICS.plan_linear(start, position, DELAY_BETWEEN_STEPS, pitch, roll, gripper, speed)
+        except UnreachableError as e:
+            print(f"直線では動かせないため関節ごとに動かします: {e}")
+    return plan_path([start, np.rint(KINEMATICS.inverse(position, pitch, start, roll, gripper))])
+
+async def send_sequence_ble(client, sequence, characteristic_uuid=BLE_CHARACTERISTIC_UUID,
+                            protocol=PROTOCOL_ASCII, start_seq=0, flow=None, on_progress=None, delta=False):
+    # delta=True（ファームウェアがDLT1に対応）なら、前のフレームから変わった関節だけを送る
+    if protocol == PROTOCOL_STREAM and flow is not None and can_send_batched(client):
+        # 応答なし書き込み + 状態通知によるフロー制御
+        writes = await send_trajectory_flow_controlled(client, characteristic_uuid, sequence,
+                                                       int(DELAY_BETWEEN_STEPS * 1000), flow, start_seq,
+                                                       on_progress=on_progress, delta=delta)
+        print(f"シーケンス送信完了（{len(sequence)}ステップ / {writes}回の書き込み）")
+        return
+    if protocol in (PROTOCOL_BATCH, PROTOCOL_STREAM) and can_send_batched(client):
+        # 複数ステップを1回の書き込みにまとめ、再生タイミングはファームウェアに任せる
+        writes = await send_trajectory_batched(client, characteristic_uuid, sequence,
+                                               int(DELAY_BETWEEN_STEPS * 1000), start_seq,
+                                               on_progress=on_progress, delta=delta)
+        print(f"シーケンス送信完了（{len(sequence)}ステップ / {writes}回の書き込み）")
+        return
+    # 軌道全体を先にフレーム化しておく（ASCII または BIN1、DLT1対応なら差分フレームも）
+    encoder = FrameEncoder(sequence, protocol, start_seq, delta)
+    angle_list = encoder.angles.tolist()
+    kind = PROTOCOL_ASCII if protocol == PROTOCOL_ASCII else "binary"
+    # 毎フレーム出すとコンソール出力で送信周期が乱れるので間引く
+    sampler = LogSampler()
+
+    def on_sent(i, frame):
+        # 直前と同じ姿勢のフレームは書き込まない（frame=None、送信周期はそのまま）
+        if frame is not None:
+            sampler.log("send", force=i == len(encoder) - 1, seq=(start_seq + i) & 0xFFFF,
+                        step=f"{i + 1}/{len(encoder)}", angles=angle_list[i])
+        if on_progress:
+            on_progress(i)
+
+    # 書き込み時間を周期に含めないよう、絶対時刻の締め切りで送る（失敗したフレームは次の締め切りで最新の姿勢にまとめる）
+    stats = await send_paced_frames(client, characteristic_uuid, encoder, PacedScheduler(DELAY_BETWEEN_STEPS),
+                                    kind, on_sent)
+    print(f"シーケンス送信完了 {stats.summary()}")
 
 async def send_action(action_name: str):
-    global ble_client, ble_device
-    # robotaction.jsonからsequenceを取得
-    with open("robotaction.json", "r") as f:
-        action_data = json.load(f)
-    if action_name not in action_data:
-        raise ValueError(f"未定義のactionです: {action_name}")
-    action_sequence = action_data[action_name]["sequence"]
-    full_sequence = generate_full_sequence(action_sequence)
+    global ble_client, ble_device, ble_protocol, ble_flow, ble_delta
+    full_sequence = compile_action_sequence(action_name)
     # BLE接続維持・再接続ロジック
     print(f"[BLE] 現在の接続状態: ble_client={ble_client}, is_connected={getattr(ble_client, 'is_connected', False)}")
     if ble_client is None or not getattr(ble_client, 'is_connected', False):
         print(f"[BLE] 未接続または切断状態。再接続を試みます。")
         print(f"BLEデバイス '{BLE_DEVICE_NAME}' を検索中...")
         if ble_device is None:
-            ble_device = await BleakScanner.find_device_by_name(BLE_DEVICE_NAME)
+            with BLE_SCAN_SECONDS.labels(arm=BLE_DEVICE_NAME).time():
+                ble_device = await transport.find_device(BLE_DEVICE_NAME)
             if not ble_device:
                 raise RuntimeError(f"BLEデバイスが見つかりません: {BLE_DEVICE_NAME}")
-        ble_client = BleakClient(ble_device)
-        await ble_client.connect()
-        print(f"{ble_device.name} に再接続しました")
+        ble_client = transport.create_client(ble_device)
+        with BLE_CONNECT_SECONDS.labels(arm=BLE_DEVICE_NAME).time():
+            await ble_client.connect()
+            caps = await read_protocol_caps(ble_client, BLE_CHARACTERISTIC_UUID)
+        ble_protocol = parse_protocol_caps(caps)
+        ble_delta = has_capability(caps, PROTOCOL_CAPS_DELTA)
+        ble_flow = None
+        if ble_protocol == PROTOCOL_STREAM:
+            ble_flow = FlowController()
+            await ble_client.start_notify(BLE_CHARACTERISTIC_UUID, ble_flow.handle_notification)
+        print(f"{ble_device.name} に再接続しました（プロトコル: {ble_protocol}）")
     else:
         print(f"[BLE] 既に接続済み。再利用します。")
-    await send_sequence_ble(ble_client, full_sequence)
-    await ble_client.disconnect()
-    ble_client = None
-    ble_device = None
+    # 接続は維持し、次のアクションで再利用する（切断はコンソール終了時）
+    await send_sequence_ble(ble_client, full_sequence, protocol=ble_protocol, flow=ble_flow, delta=ble_delta)
     return f"{action_name} のシーケンス送信完了"
 
 # 旧mainループはコメントアウトまたは削除
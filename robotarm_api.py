@@ -1,80 +1,219 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from pydantic import BaseModel
 import asyncio
-from robotactionBLE import send_action, ble_client, ble_device, BLE_DEVICE_NAME, BLE_CHARACTERISTIC_UUID
-from bleak import BleakClient, BleakScanner
-from typing import Dict
+import time
+from typing import List
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from fleet import Fleet, UnknownArmError
+from robotactionBLE import compile_move_to, current_actions, start_action_watcher, stop_action_watcher
+from kinematics import CARTESIAN_SPEED, UnreachableError
+from metrics import REGISTRY, BLE_CONNECTED, HTTP_REQUEST_SECONDS, JOB_QUEUE_DEPTH
+from jobs import QueueFullError, DuplicateJobError
+from status_stream import StatusBroadcaster, sse_events
+from status_store import create_status_store, new_action_id
 
 app = FastAPI()
 
-action_status: Dict[str, str] = {}  # action_id: "pending" or "done"
+# action_id: "pending" / "running" / "done" / "cancelled" / "error: ..."
+# 期限切れ・件数超過は自動で捨てる。ROBOTARM_STATUS_STORE=sqlite で再起動後も残り、ワーカー間で共有できる
+action_status = create_status_store()
+
+# 状態の変化と進捗を購読者にプッシュする
+status_broadcaster = StatusBroadcaster()
+
+def job_snapshot(job):
+    step, total = job.progress
+    return {"action_id": job.id, "status": job.status_text, "step": step, "total": total, "angles": job.angles}
+
+def update_action_status(job):
+    action_status.set(job.id, job.status_text)
+    status_broadcaster.publish(job.id, job_snapshot(job))
+
+def publish_progress(job):
+    # 進捗はストアに書かずにプッシュだけする
+    status_broadcaster.publish(job.id, job_snapshot(job))
+
+# アームごとにBLE接続を保持し、アクションはアームごとの優先度つき有限キューで1つずつ実行する
+# 複数台は arms.json（ROBOTARM_FLEET）に登録する。無ければ BLE_DEVICE_NAME の1台だけ
+fleet = Fleet.from_config(on_update=update_action_status, on_progress=publish_progress)
+# アームを指定しないAPI（/action など）は最初のアームを使う
+ble_manager = fleet.default.manager
+job_scheduler = fleet.default.scheduler
+
+# 接続状態とキュー長は /metrics の出力時に読む
+BLE_CONNECTED.set_function(lambda: {(arm.manager.label,): int(arm.manager.is_connected) for arm in fleet.arms.values()})
+JOB_QUEUE_DEPTH.set_function(lambda: {(arm.manager.label,): arm.scheduler.queue_depth for arm in fleet.arms.values()})
+
+@app.middleware("http")
+async def record_request_time(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # パスはテンプレート（/arms/{target}/action など）で集計する
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    HTTP_REQUEST_SECONDS.labels(method=request.method, path=path, status=response.status_code).observe(
+        time.perf_counter() - start)
+    return response
 
 class ActionRequest(BaseModel):
     action: str
     action_id: str = None
+    priority: int = 0  # 大きいほど先に実行
+    preempt: bool = False  # Trueなら実行中の動作（優先度が同じか低いもの）を中断して割り込む
+    blend: bool = False  # Trueなら前のアクションのあと初期位置に戻らずに、その姿勢から直接始める
+
+class BatchActionRequest(BaseModel):
+    actions: List[str]  # 初期位置に戻らずにつないで実行するアクション名（順番どおり）
+    action_id: str = None
+    priority: int = 0
+    preempt: bool = False
+    blend: bool = False
 
-# @app.on_event("startup")
-# async def startup_event():
-#     global ble_client, ble_device
-#     try:
-#         ble_device = await BleakScanner.find_device_by_name(BLE_DEVICE_NAME)
-#         if not ble_device:
-#             print(f"警告: BLEデバイスが見つかりません: {BLE_DEVICE_NAME}。リクエスト時に再スキャンします。")
-#             ble_device = None
-#             ble_client = None
-#         else:
-#             ble_client = BleakClient(ble_device)
-#             await ble_client.connect()
-#             print("BLE接続確立")
-#     except Exception as e:
-#         print(f"BLE初期化時に例外: {e}。リクエスト時に再スキャンします。")
-#         ble_device = None
-#         ble_client = None
+class MoveToRequest(BaseModel):
+    # グリッパー先端の目標位置（mm、土台の床面が原点、x が前、z が上）
+    x: float
+    y: float
+    z: float
+    pitch: float = None  # ツールの向き（度、0 が水平、-90 が真下）。省略時は今の姿勢に近い向き
+    roll: float = None  # 手首の回転（5番のサーボ角）。省略時はそのまま
+    gripper: float = None  # グリッパー（6番のサーボ角）。省略時はそのまま
+    linear: bool = True  # Trueならグリッパー先端を直線で動かす。Falseなら関節ごとに目標の姿勢へ動かす
+    speed: float = CARTESIAN_SPEED  # 直線で動かすときの速さ（mm/秒）
+    action_id: str = None
+    priority: int = 0
+    preempt: bool = False
+
+@app.on_event("startup")
+async def startup_event():
+    # アクション定義を読み込んで検証し、以後は変更を監視して差し替える（不正なら起動しない）
+    await start_action_watcher()
+    # 起動時に接続を開始（見つからなくてもバックグラウンドで再接続を続ける）
+    await fleet.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    global ble_client
-    if ble_client and ble_client.is_connected:
-        await ble_client.disconnect()
-        print("BLE切断")
+    await fleet.stop()
+    await stop_action_watcher()
+    # 書き込み待ちの状態を書き終えてから終わる
+    await asyncio.to_thread(action_status.flush)
+    print("BLE切断")
+
+def check_action_names(names):
+    """未定義のアクション名があれば 422（受け付けてからジョブが失敗しないように送る前に確かめる）"""
+    action_data, _ = current_actions()
+    unknown = [name for name in names if name not in action_data]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"未定義のactionです: {', '.join(unknown)}")
 
 @app.post("/action")
-async def do_action(req: ActionRequest, background_tasks: BackgroundTasks):
-    action_id = req.action_id or (str(asyncio.get_event_loop().time()))
-    action_status[action_id] = "pending"
-    background_tasks.add_task(run_ble_action, req.action, action_id)
-    return {"status": "started"}
+async def do_action(req: ActionRequest):
+    check_action_names([req.action])
+    action_id = req.action_id or new_action_id()
+    try:
+        job_scheduler.submit(action_id, req.action, req.priority, req.preempt, blend=req.blend)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except DuplicateJobError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "started", "action_id": action_id}
 
-async def run_ble_action(action, action_id):
+@app.post("/actions/batch")
+async def do_actions_batch(req: BatchActionRequest):
+    """複数のアクションを、間で初期位置に戻らずに1つのジョブとして続けて実行する"""
+    if not req.actions:
+        raise HTTPException(status_code=422, detail="actions が空です")
+    check_action_names(req.actions)
+    action_id = req.action_id or new_action_id()
     try:
-        await send_action(action)
-        action_status[action_id] = "done"
-    except Exception as e:
-        action_status[action_id] = f"error: {e}"
+        job_scheduler.submit(action_id, list(req.actions), req.priority, req.preempt, blend=req.blend)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except DuplicateJobError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "started", "action_id": action_id, "actions": req.actions}
+
+@app.post("/move_to")
+async def move_to(req: MoveToRequest):
+    """グリッパー先端を指定した位置へ動かす（逆運動学で関節角に変換して軌道を作る）"""
+    if req.speed <= 0:
+        raise HTTPException(status_code=422, detail="speed は正の値にしてください")
+    position = [req.x, req.y, req.z]
+
+    def plan(start_position):
+        return compile_move_to(position, req.pitch, req.roll, req.gripper, req.linear, req.speed, start_position)
+
+    try:
+        # 受け付ける前に今の姿勢からの軌道が作れるか確かめる（実際の軌道は実行開始時の姿勢から作り直す）
+        angles = (await asyncio.to_thread(plan, ble_manager.current_pose))[-1]
+    except UnreachableError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    action_id = req.action_id or new_action_id()
+    try:
+        job_scheduler.submit(action_id, "move_to", req.priority, req.preempt, plan=plan)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except DuplicateJobError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "started", "action_id": action_id, "angles": [int(a) for a in angles]}
+
+@app.post("/arms/{target}/action")
+async def do_arm_action(target: str, req: ActionRequest):
+    """target はアームID（デバイスアドレス）・グループ名・"all"。複数台なら同時に開始する"""
+    check_action_names([req.action])
+    action_id = req.action_id or new_action_id()
+    try:
+        jobs = fleet.submit(target, action_id, req.action, req.priority, req.preempt, req.blend)
+    except UnknownArmError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except DuplicateJobError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "started", "action_id": action_id, "jobs": jobs}
+
+@app.get("/arms")
+async def get_arms():
+    return fleet.status()
+
+@app.post("/action/{action_id}/cancel")
+async def cancel_action(action_id: str):
+    if not fleet.cancel(action_id):
+        raise HTTPException(status_code=404, detail=f"取り消せるactionがありません: {action_id}")
+    return {"status": "cancelled"}
 
 @app.get("/action_status")
 async def get_action_status(action_id: str):
-    return {"status": action_status.get(action_id, "unknown")}
-
-async def ensure_connected():
-    global ble_client, ble_device
-    if ble_client is not None and getattr(ble_client, 'is_connected', False):
-        try:
-            # 実際にGATT通信で疎通確認
-            await ble_client.read_gatt_char(BLE_CHARACTERISTIC_UUID)
-            return True
-        except Exception:
-            print("GATT通信失敗。再接続します。")
-    # ここまで来たら再接続
-    ble_device = await BleakScanner.find_device_by_name(BLE_DEVICE_NAME)
-    if not ble_device:
-        ble_client = None
-        return False
-    ble_client = BleakClient(ble_device)
-    await ble_client.connect()
-    try:
-        await ble_client.read_gatt_char(BLE_CHARACTERISTIC_UUID)
-        return True
-    except Exception:
-        ble_client = None
-        return False 
\ No newline at end of file
+    return {"status": await action_status.get_async(action_id) or "unknown"}
+
+@app.get("/action_status/stream")
+async def stream_action_status(action_id: str, request: Request):
+    """状態遷移と進捗（step / total / angles）を Server-Sent Events でプッシュする"""
+    async def snapshot():
+        job = fleet.find_job(action_id)
+        if job is not None:
+            return job_snapshot(job)
+        return {"action_id": action_id, "status": await action_status.get_async(action_id) or "unknown"}
+    return StreamingResponse(
+        sse_events(status_broadcaster, action_id, snapshot, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+@app.get("/telemetry")
+async def get_telemetry(arm: str = None, limit: int = 100):
+    """アームから通知された現在角度・エンコーダ・デバイス時刻と、追従遅れの統計"""
+    target = fleet.default if arm is None else fleet.arms.get(arm)
+    if target is None:
+        raise HTTPException(status_code=404, detail=f"アームが見つかりません: {arm}")
+    manager = target.manager
+    return {"arm": target.id, "enabled": manager.telemetry_enabled, **manager.telemetry.summary(limit)}
+
+@app.get("/ble_status")
+async def get_ble_status():
+    return {"connected": ble_manager.is_connected, "queue_depth": job_scheduler.queue_depth}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus 形式のメトリクス"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
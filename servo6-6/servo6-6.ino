@@ -32,8 +32,105 @@ const int defaultAngles[6] = {135, 200, 30, 45, 90, 90};
 // 現在の角度を保存する配列（各サーボの現在の角度を記録）
 int currentAngles[6] = {135, 200, 30, 45, 90, 90};
 
+// バイナリ角度フレーム（BIN1）の定義
+// [0]マジック 0xA5, [1]種別 0x01, [2-3]シーケンス番号, [4-15]角度uint16×6, [16]XORチェックサム（すべてリトルエンディアン）
+#define FRAME_MAGIC 0xA5
+#define FRAME_TYPE_ANGLES 0x01
+#define ANGLE_FRAME_SIZE 17
+
+// バッチフレーム（BAT1）の定義：複数フレームを1回の書き込みで受信し、リングバッファから自前のタイマーで再生する
+// [0]マジック 0xA5, [1]種別 0x02, [2-3]先頭シーケンス番号, [4]フレーム数, [5-6]予約,
+// 以降 フレーム×数（[0-1]前フレームからの待ち時間ms, [2-13]角度uint16×6）, 末尾 XORチェックサム
+#define FRAME_TYPE_BATCH 0x02
+#define BATCH_HEADER_SIZE 7
+#define BATCH_ENTRY_SIZE 14
+#define RING_CAPACITY 64
+
+// CLEARフレーム：[0]マジック 0xA5, [1]種別 0x03, [2]XORチェックサム。再生待ちのフレームを破棄する（中断・割り込み用）
+#define FRAME_TYPE_CLEAR 0x03
+
+// 差分フレーム（DLT1）：前のフレームから変わった関節だけを送る
+// [0]マジック 0xA5, [1]種別 0x04, [2-3]シーケンス番号, [4]変わった関節のビットマスク（ビットi = サーボi+1）,
+// 以降 変わった関節の角度uint16×ビット数（関節番号の小さい順）, 末尾 XORチェックサム。マスク0はシーケンス番号だけ進める
+#define FRAME_TYPE_DELTA 0x04
+#define DELTA_HEADER_SIZE 5
+#define DELTA_FULL_MASK 0x3F
+// 差分バッチ：ヘッダはBAT1と同じ（種別 0x05）、フレーム×数（[0-1]待ち時間ms, [2]ビットマスク, 以降 変わった関節の角度uint16）
+// 各バッチの先頭フレームは全関節を含む（マスク 0x3F）。リングバッファには全関節の角度に戻して積む
+#define FRAME_TYPE_DELTA_BATCH 0x05
+#define DELTA_ENTRY_HEADER_SIZE 3
+
+// 状態通知（フロー制御用）：[0]マジック 0xA5, [1]種別 0x81, [2]バッファ使用数, [3]容量, [4-5]最後に再生したシーケンス番号, [6]XORチェックサム
+#define FRAME_TYPE_STATUS 0x81
+#define STATUS_SIZE 7
+#define STATUS_INTERVAL_MS 20
+
+// テレメトリ通知：[0]マジック 0xA5, [1]種別 0x82, [2-3]最後に適用したシーケンス番号, [4-7]millis(),
+// [8-19]現在角度uint16×6, [20-23]エンコーダのカウントint32, [24]XORチェックサム（接続中はTELEMETRY_INTERVAL_MSごと）
+#define FRAME_TYPE_TELEMETRY 0x82
+#define TELEMETRY_SIZE 25
+#define TELEMETRY_INTERVAL_MS 50
+
+// 読み出し時に返す対応プロトコル（ホストはこれを読んでBIN1/BAT1を使うか決める）
+const char* PROTOCOL_CAPS = "PROTO ASCII BIN1 BAT1 FLOW1 TLM1 DLT1";
+
+// ロータリーエンコーダ（encoder/encoder.ino と同じ読み方。サーボと重ならないピンを使う）
+const int ENCODER_A_PIN = 33;
+const int ENCODER_B_PIN = 25;
+const unsigned long ENCODER_DEBOUNCE_MS = 1;
+volatile int32_t encoderCount = 0;
+volatile unsigned long lastEncoderInterruptMs = 0;
+portMUX_TYPE encoderMux = portMUX_INITIALIZER_UNLOCKED;
+unsigned long lastTelemetryMs = 0;
+
+// 再生待ちフレームのリングバッファ（onWriteはBLEタスク、再生はloopで行うので排他する）
+struct QueuedFrame {
+  uint16_t seq;
+  uint16_t dtMs;
+  uint16_t angles[6];
+};
+QueuedFrame ring[RING_CAPACITY];
+// 受信したバッチを復号する作業領域（BLEタスクのスタックを使わないように静的に確保、onWriteからだけ使う）
+QueuedFrame decodedFrames[255];
+int ringHead = 0;
+int ringCount = 0;
+unsigned long nextDueMs = 0; // 先頭フレームを再生する時刻
+portMUX_TYPE ringMux = portMUX_INITIALIZER_UNLOCKED;
+
+// 状態通知を送る必要があるか（バッファや再生位置が変わったとき）
+volatile bool statusDirty = false;
+unsigned long lastStatusMs = 0;
+
+// 最後に適用したフレームのシーケンス番号
+uint16_t lastSeq = 0;
+
 // 受信したコマンドを処理する関数のプロトタイプ宣言
 void processCommand(String command);
+void processBinaryFrame(const uint8_t* data, size_t len);
+void processBatchFrame(const uint8_t* data, size_t len);
+void processDeltaFrame(const uint8_t* data, size_t len);
+void processDeltaBatchFrame(const uint8_t* data, size_t len);
+void queueFrames(uint16_t seq, const QueuedFrame* frames, int count);
+void playQueuedFrames();
+void clearQueuedFrames();
+void notifyStatus();
+void notifyTelemetry();
+void moveServo(int id, int angle, bool log);
+
+// エンコーダの割り込み処理（A・Bの変化でカウントを増減する）
+void IRAM_ATTR encoderPulse() {
+  unsigned long now = millis();
+  if (now - lastEncoderInterruptMs > ENCODER_DEBOUNCE_MS) {
+    portENTER_CRITICAL_ISR(&encoderMux);
+    if (digitalRead(ENCODER_A_PIN) ^ digitalRead(ENCODER_B_PIN)) {
+      encoderCount++;
+    } else {
+      encoderCount--;
+    }
+    portEXIT_CRITICAL_ISR(&encoderMux);
+    lastEncoderInterruptMs = now;
+  }
+}
 
 // BLEサーバーコールバッククラス：接続状態の管理
 class MyServerCallbacks: public BLEServerCallbacks {
@@ -49,11 +146,31 @@ class MyServerCallbacks: public BLEServerCallbacks {
 // BLEキャラクタリスティックコールバッククラス：データ受信時の処理
 class MyCallbacks: public BLECharacteristicCallbacks {
     void onWrite(BLECharacteristic *pCharacteristic) {
-      String value = pCharacteristic->getValue().c_str(); // 受信したデータをString型に変換
-      if (value.length() > 0) {
+      auto raw = pCharacteristic->getValue();
+      const uint8_t* data = (const uint8_t*)raw.c_str();
+      size_t len = raw.length();
+      if (len == 3 && data[0] == FRAME_MAGIC && data[1] == FRAME_TYPE_CLEAR && data[2] == (FRAME_MAGIC ^ FRAME_TYPE_CLEAR)) {
+        // 再生待ちのフレームを破棄（現在の姿勢で止まる）
+        clearQueuedFrames();
+      } else if (len > 1 && data[0] == FRAME_MAGIC && data[1] == FRAME_TYPE_BATCH) {
+        // バッチフレーム：リングバッファに積んでloopで再生
+        processBatchFrame(data, len);
+      } else if (len > 1 && data[0] == FRAME_MAGIC && data[1] == FRAME_TYPE_DELTA_BATCH) {
+        // 差分バッチ：全関節の角度に戻してからリングバッファに積む
+        processDeltaBatchFrame(data, len);
+      } else if (len > 1 && data[0] == FRAME_MAGIC && data[1] == FRAME_TYPE_DELTA) {
+        // 差分フレーム：含まれている関節だけ動かす
+        processDeltaFrame(data, len);
+      } else if (len > 0 && data[0] == FRAME_MAGIC) {
+        // バイナリフレーム：文字列を作らずにそのまま解析
+        processBinaryFrame(data, len);
+      } else if (len > 0) {
+        String value = raw.c_str(); // 受信したデータをString型に変換
         Serial.println("受信したコマンド: " + value); // 受信したコマンドをシリアル出力
         processCommand(value); // 受信したコマンドを処理
       }
+      // 読み出し値を対応プロトコルに戻す
+      pCharacteristic->setValue(PROTOCOL_CAPS);
     }
 };
 
@@ -83,8 +200,15 @@ void setup() {
     Serial.printf("サーボ %d を角度 %d に初期化 (調整後 %d)\n", i + 1, defaultAngles[i], adjustedDefaultAngle);
   }
 
+  // エンコーダの初期化
+  pinMode(ENCODER_A_PIN, INPUT_PULLUP);
+  pinMode(ENCODER_B_PIN, INPUT_PULLUP);
+  attachInterrupt(digitalPinToInterrupt(ENCODER_A_PIN), encoderPulse, CHANGE);
+  attachInterrupt(digitalPinToInterrupt(ENCODER_B_PIN), encoderPulse, CHANGE);
+
   // BLEデバイスの初期化
   BLEDevice::init("ESP32 BLE Device");
+  BLEDevice::setMTU(247); // バッチ送信のためにMTUを広げる
   pServer = BLEDevice::createServer();
   pServer->setCallbacks(new MyServerCallbacks());
 
@@ -96,11 +220,13 @@ void setup() {
                       CHARACTERISTIC_UUID,
                       BLECharacteristic::PROPERTY_READ |
                       BLECharacteristic::PROPERTY_WRITE |
+                      BLECharacteristic::PROPERTY_WRITE_NR |
                       BLECharacteristic::PROPERTY_NOTIFY
                     );
 
   pCharacteristic->setCallbacks(new MyCallbacks());
   pCharacteristic->addDescriptor(new BLE2902());
+  pCharacteristic->setValue(PROTOCOL_CAPS);
 
   // サービスの開始
   pService->start();
@@ -115,6 +241,13 @@ void setup() {
 }
 
 void loop() {
+  // リングバッファに溜まったフレームを時刻どおりに再生
+  playQueuedFrames();
+  // 再生状況をホストに通知（ホストはこれをフロー制御のクレジットに使う）
+  notifyStatus();
+  // 現在角度・エンコーダを定期的に通知（ホストは追従遅れの計測と重複フレームの省略に使う）
+  notifyTelemetry();
+
   // BLE接続状態の管理
   if (!deviceConnected && oldDeviceConnected) {
     delay(500); // 接続が切れた後、再アドバタイジングを開始するまでの遅延
@@ -128,14 +261,16 @@ void loop() {
 }
 
 // 指定されたIDのサーボを指定された角度に動かす関数
-void moveServo(int id, int angle) {
+void moveServo(int id, int angle, bool log) {
   if (id >= 0 && id < 6) {
     if (angle >= minAngles[id] && angle <= maxAngles[id]) {
       // RDS3218サーボの場合、角度を2/3倍して書き込む
       int adjustedAngle = (id < 4) ? round((angle * 2.0) / 3.0) : angle;
       servos[id].write(adjustedAngle);  // サーボを指定された角度に動かす
       currentAngles[id] = angle;  // 現在の角度を更新
-      Serial.printf("サーボ %d を角度 %d に移動 (調整後 %d)\n", id + 1, angle, adjustedAngle);
+      if (log) {
+        Serial.printf("サーボ %d を角度 %d に移動 (調整後 %d)\n", id + 1, angle, adjustedAngle);
+      }
     } else {
       Serial.printf("エラー: 角度 %d はサーボ %d の範囲外です\n", angle, id + 1);
     }
@@ -177,11 +312,256 @@ void processCommand(String command) {
     Serial.println("6つのサーボ角度を設定します:");
     for (int i = 0; i < 6; i++) {
       Serial.printf("サーボ %d: %d度\n", i + 1, angles[i]);
-      moveServo(i, angles[i]);
+      moveServo(i, angles[i], true);
     }
     Serial.println("全てのサーボ角度を設定しました");
   } else {
     Serial.printf("エラー: 6つの角度が必要ですが、%d個しか取得できませんでした\n", count);
     Serial.println("正しい形式: '角度1 角度2 角度3 角度4 角度5 角度6'");
   }
-} 
\ No newline at end of file
+}
+
+// リトルエンディアンのuint16を読む
+uint16_t readU16(const uint8_t* p) {
+  return (uint16_t)p[0] | ((uint16_t)p[1] << 8);
+}
+
+// フレームのXORチェックサムを計算する
+uint8_t frameChecksum(const uint8_t* data, size_t len) {
+  uint8_t sum = 0;
+  for (size_t i = 0; i < len; i++) {
+    sum ^= data[i];
+  }
+  return sum;
+}
+
+// バイナリ角度フレーム（BIN1）を処理する関数
+void processBinaryFrame(const uint8_t* data, size_t len) {
+  if (len != ANGLE_FRAME_SIZE || data[1] != FRAME_TYPE_ANGLES) {
+    Serial.printf("エラー: 不正なバイナリフレーム (長さ %d)\n", (int)len);
+    return;
+  }
+  if (frameChecksum(data, ANGLE_FRAME_SIZE - 1) != data[ANGLE_FRAME_SIZE - 1]) {
+    Serial.println("エラー: チェックサムが一致しません");
+    return;
+  }
+  lastSeq = readU16(data + 2);
+  // 毎フレームのシリアル出力は送信レートを落とすので省略する
+  for (int i = 0; i < 6; i++) {
+    moveServo(i, readU16(data + 4 + i * 2), false);
+  }
+  statusDirty = true;
+}
+
+// バッチフレーム（BAT1）を検証してリングバッファに積む関数
+void processBatchFrame(const uint8_t* data, size_t len) {
+  if (len < BATCH_HEADER_SIZE + 1) {
+    Serial.printf("エラー: 不正なバッチフレーム (長さ %d)\n", (int)len);
+    return;
+  }
+  int count = data[4];
+  if (len != (size_t)(BATCH_HEADER_SIZE + count * BATCH_ENTRY_SIZE + 1)) {
+    Serial.printf("エラー: バッチフレームの長さが不正です (長さ %d, フレーム数 %d)\n", (int)len, count);
+    return;
+  }
+  if (frameChecksum(data, len - 1) != data[len - 1]) {
+    Serial.println("エラー: チェックサムが一致しません");
+    return;
+  }
+  QueuedFrame* frames = decodedFrames;
+  for (int n = 0; n < count; n++) {
+    const uint8_t* entry = data + BATCH_HEADER_SIZE + n * BATCH_ENTRY_SIZE;
+    frames[n].dtMs = readU16(entry);
+    for (int i = 0; i < 6; i++) {
+      frames[n].angles[i] = readU16(entry + 2 + i * 2);
+    }
+  }
+  queueFrames(readU16(data + 2), frames, count);
+}
+
+// 差分フレームを処理する関数（含まれていない関節は動かさない）
+void processDeltaFrame(const uint8_t* data, size_t len) {
+  if (len < DELTA_HEADER_SIZE + 1) {
+    Serial.printf("エラー: 不正な差分フレーム (長さ %d)\n", (int)len);
+    return;
+  }
+  uint8_t mask = data[4];
+  int joints = 0;
+  for (int i = 0; i < 6; i++) {
+    joints += (mask >> i) & 1;
+  }
+  if (mask > DELTA_FULL_MASK || len != (size_t)(DELTA_HEADER_SIZE + joints * 2 + 1)) {
+    Serial.printf("エラー: 不正な差分フレーム (長さ %d)\n", (int)len);
+    return;
+  }
+  if (frameChecksum(data, len - 1) != data[len - 1]) {
+    Serial.println("エラー: チェックサムが一致しません");
+    return;
+  }
+  lastSeq = readU16(data + 2);
+  const uint8_t* value = data + DELTA_HEADER_SIZE;
+  for (int i = 0; i < 6; i++) {
+    if ((mask >> i) & 1) {
+      moveServo(i, readU16(value), false);
+      value += 2;
+    }
+  }
+  statusDirty = true;
+}
+
+// 差分バッチを全関節の角度に戻してリングバッファに積む関数
+void processDeltaBatchFrame(const uint8_t* data, size_t len) {
+  if (len < BATCH_HEADER_SIZE + 1) {
+    Serial.printf("エラー: 不正な差分バッチ (長さ %d)\n", (int)len);
+    return;
+  }
+  if (frameChecksum(data, len - 1) != data[len - 1]) {
+    Serial.println("エラー: チェックサムが一致しません");
+    return;
+  }
+  int count = data[4];
+  QueuedFrame* frames = decodedFrames;
+  size_t pos = BATCH_HEADER_SIZE;
+  for (int n = 0; n < count; n++) {
+    if (pos + DELTA_ENTRY_HEADER_SIZE > len - 1) {
+      Serial.printf("エラー: 差分バッチの長さが不正です (長さ %d, フレーム数 %d)\n", (int)len, count);
+      return;
+    }
+    frames[n].dtMs = readU16(data + pos);
+    uint8_t mask = data[pos + 2];
+    if (mask > DELTA_FULL_MASK || (n == 0 && mask != DELTA_FULL_MASK)) {
+      Serial.println("エラー: 差分バッチのビットマスクが不正です");
+      return;
+    }
+    pos += DELTA_ENTRY_HEADER_SIZE;
+    for (int i = 0; i < 6; i++) {
+      if ((mask >> i) & 1) {
+        if (pos + 2 > len - 1) {
+          Serial.printf("エラー: 差分バッチの長さが不正です (長さ %d, フレーム数 %d)\n", (int)len, count);
+          return;
+        }
+        frames[n].angles[i] = readU16(data + pos);
+        pos += 2;
+      } else {
+        // 変わっていない関節は前のフレームの角度
+        frames[n].angles[i] = frames[n - 1].angles[i];
+      }
+    }
+  }
+  if (pos != len - 1) {
+    Serial.printf("エラー: 差分バッチの長さが不正です (長さ %d, フレーム数 %d)\n", (int)len, count);
+    return;
+  }
+  queueFrames(readU16(data + 2), frames, count);
+}
+
+// 復号したフレームをリングバッファに積む関数（満杯なら残りを破棄する）
+void queueFrames(uint16_t seq, const QueuedFrame* frames, int count) {
+  int dropped = 0;
+  portENTER_CRITICAL(&ringMux);
+  for (int n = 0; n < count; n++) {
+    if (ringCount >= RING_CAPACITY) {
+      dropped = count - n;
+      break;
+    }
+    if (ringCount == 0) {
+      // 再生が止まっていたら先頭フレームはすぐに再生する
+      nextDueMs = millis();
+    }
+    QueuedFrame& f = ring[(ringHead + ringCount) % RING_CAPACITY];
+    f = frames[n];
+    f.seq = seq + n;
+    ringCount++;
+  }
+  portEXIT_CRITICAL(&ringMux);
+  statusDirty = true;
+  if (dropped > 0) {
+    Serial.printf("エラー: リングバッファが満杯のため %d フレームを破棄しました\n", dropped);
+  }
+}
+
+// 再生時刻になったフレームをリングバッファから取り出してサーボに反映する関数
+void playQueuedFrames() {
+  QueuedFrame f;
+  portENTER_CRITICAL(&ringMux);
+  if (ringCount == 0 || (long)(millis() - nextDueMs) < 0) {
+    portEXIT_CRITICAL(&ringMux);
+    return;
+  }
+  f = ring[ringHead];
+  ringHead = (ringHead + 1) % RING_CAPACITY;
+  ringCount--;
+  if (ringCount > 0) {
+    // 次のフレームの再生時刻は前回の予定時刻から数える（遅れが積み重ならない）
+    nextDueMs += ring[ringHead].dtMs;
+  }
+  portEXIT_CRITICAL(&ringMux);
+
+  lastSeq = f.seq;
+  for (int i = 0; i < 6; i++) {
+    moveServo(i, f.angles[i], false);
+  }
+  statusDirty = true;
+}
+
+// リングバッファの再生待ちフレームをすべて破棄する関数
+void clearQueuedFrames() {
+  portENTER_CRITICAL(&ringMux);
+  ringHead = 0;
+  ringCount = 0;
+  portEXIT_CRITICAL(&ringMux);
+  statusDirty = true;
+}
+
+// バッファ使用数と最後に再生したシーケンス番号を通知する関数（STATUS_INTERVAL_MSごとに最大1回）
+void notifyStatus() {
+  if (!statusDirty || !deviceConnected || millis() - lastStatusMs < STATUS_INTERVAL_MS) {
+    return;
+  }
+  uint8_t packet[STATUS_SIZE];
+  portENTER_CRITICAL(&ringMux);
+  packet[2] = (uint8_t)ringCount;
+  portEXIT_CRITICAL(&ringMux);
+  packet[0] = FRAME_MAGIC;
+  packet[1] = FRAME_TYPE_STATUS;
+  packet[3] = RING_CAPACITY;
+  packet[4] = lastSeq & 0xFF;
+  packet[5] = (lastSeq >> 8) & 0xFF;
+  packet[6] = frameChecksum(packet, STATUS_SIZE - 1);
+  statusDirty = false;
+  lastStatusMs = millis();
+  pCharacteristic->setValue(packet, STATUS_SIZE);
+  pCharacteristic->notify();
+  // 読み出し値は対応プロトコルに戻しておく
+  pCharacteristic->setValue(PROTOCOL_CAPS);
+}
+
+// 現在角度・エンコーダのカウント・デバイス時刻を通知する関数（TELEMETRY_INTERVAL_MSごと）
+void notifyTelemetry() {
+  unsigned long now = millis();
+  if (!deviceConnected || now - lastTelemetryMs < TELEMETRY_INTERVAL_MS) {
+    return;
+  }
+  portENTER_CRITICAL(&encoderMux);
+  int32_t count = encoderCount;
+  portEXIT_CRITICAL(&encoderMux);
+  uint8_t packet[TELEMETRY_SIZE];
+  packet[0] = FRAME_MAGIC;
+  packet[1] = FRAME_TYPE_TELEMETRY;
+  packet[2] = lastSeq & 0xFF;
+  packet[3] = (lastSeq >> 8) & 0xFF;
+  for (int b = 0; b < 4; b++) {
+    packet[4 + b] = (now >> (8 * b)) & 0xFF;
+    packet[20 + b] = ((uint32_t)count >> (8 * b)) & 0xFF;
+  }
+  for (int i = 0; i < 6; i++) {
+    packet[8 + i * 2] = currentAngles[i] & 0xFF;
+    packet[9 + i * 2] = (currentAngles[i] >> 8) & 0xFF;
+  }
+  packet[TELEMETRY_SIZE - 1] = frameChecksum(packet, TELEMETRY_SIZE - 1);
+  lastTelemetryMs = now;
+  pCharacteristic->setValue(packet, TELEMETRY_SIZE);
+  pCharacteristic->notify();
+  // 読み出し値は対応プロトコルに戻しておく
+  pCharacteristic->setValue(PROTOCOL_CAPS);
+}
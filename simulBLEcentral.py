@@ -1,5 +1,6 @@
 import asyncio
-from bleak import BleakClient, BleakScanner
+from transport import get_transport
+from protocol import is_device_packet
 import aioconsole
 
 # ESP32のBLEデバイス名
@@ -11,6 +12,8 @@ CHARACTERISTIC_UUID = "beb5483e-36e1-4688-b7f5-ea07361b26a8"  # キャラクタ
 
 async def notification_handler(sender, data):
     """通知を処理するコールバック関数"""
+    if is_device_packet(data):
+        return  # 状態通知・テレメトリ（バイナリ）は表示しない
     print(f"受信した通知: {data.decode()}")  # 受信した通知をデコードして表示
 
 async def user_input(client):
@@ -50,7 +53,9 @@ async def main():
     print(f"'{DEVICE_NAME}'を検索中...")
     
     # デバイス名でBLEデバイスをスキャンし、デバイスを見つける
-    device = await BleakScanner.find_device_by_name(DEVICE_NAME)
+    # ROBOTARM_TRANSPORT=sim ならシミュレーションデバイスにつながる
+    transport = get_transport()
+    device = await transport.find_device(DEVICE_NAME)
     
     if not device:
         print(f"'{DEVICE_NAME}'という名前のデバイスが見つかりませんでした")  # デバイスが見つからない場合のメッセージ
@@ -60,7 +65,7 @@ async def main():
     
     # デバイスに接続し、接続が確立されたら以下の処理を行う
     try:
-        async with BleakClient(device) as client:
+        async with transport.create_client(device) as client:
             print(f"{device.name}に接続しました")  # デバイスに接続したことを表示
 
             # 通知を受信するためのハンドラを設定
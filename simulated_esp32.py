@@ -0,0 +1,213 @@
+import asyncio
+import re
+import time
+from collections import deque
+from protocol import (
+    FRAME_MAGIC,
+    FRAME_TYPE_ANGLES,
+    FRAME_TYPE_BATCH,
+    FRAME_TYPE_DELTA,
+    FRAME_TYPE_DELTA_BATCH,
+    ANGLE_FRAME_SIZE,
+    PROTOCOL_CAPS_TELEMETRY,
+    decode_binary_frame,
+    decode_batch_frames,
+    decode_delta_batch_frames,
+    decode_delta_frame,
+    encode_clear_frame,
+    encode_status,
+    encode_telemetry,
+)
+from trajectory import JOINT_MIN_ANGLES, JOINT_MAX_ANGLES
+
+# servo6-6.ino と同じ定数
+DEFAULT_ANGLES = [135, 200, 30, 45, 90, 90]
+PROTOCOL_CAPS = b"PROTO ASCII BIN1 BAT1 FLOW1 TLM1 DLT1"
+RING_CAPACITY = 64
+STATUS_INTERVAL = 0.02  # STATUS_INTERVAL_MS
+TELEMETRY_INTERVAL = 0.05  # TELEMETRY_INTERVAL_MS
+# シミュレーションではエンコーダをサーボ1（ベース）に取り付けたものとして、角度に比例したカウントを返す
+ENCODER_COUNTS_PER_DEGREE = 2
+# loop() の1周にかかる時間の見積もり（秒）
+LOOP_PERIOD = 0.001
+# applied_log に残す直近の適用フレーム数（長時間動かしてもメモリが増えないように）
+APPLIED_LOG_SIZE = 10000
+
+
+def _arduino_round(x):
+    return int(x + 0.5) if x >= 0 else -int(-x + 0.5)
+
+
+def _to_int(text):
+    """Arduino の String::toInt と同じく、先頭の整数部分だけを読む（読めなければ0）"""
+    m = re.match(r"\s*([+-]?\d+)", text)
+    return int(m.group(1)) if m else 0
+
+
+class SimulatedESP32:
+    """servo6-6.ino の processCommand / moveServo / リングバッファ再生を再現するシミュレータ
+
+    範囲外の角度はファームウェアと同じく無視し（そのサーボは動かさない）、
+    RDS3218（最初の4つ）には角度×2/3を書き込む。servo_outputs が実際に Servo.write される値。
+    """
+
+    def __init__(self, name="ESP32 BLE Device", address="SIM:00:00:00:00:01"):
+        self.name = name
+        self.address = address
+        self.current_angles = list(DEFAULT_ANGLES)
+        self.servo_outputs = [self._adjusted(i, a) for i, a in enumerate(DEFAULT_ANGLES)]
+        self.value = PROTOCOL_CAPS
+        self.last_seq = 0
+        self.ring = []
+        self.next_due = 0.0
+        self.status_dirty = False
+        self.last_status = 0.0
+        self.last_telemetry = 0.0
+        self.boot_time = time.perf_counter()
+        self.notify = None
+        # 計測用カウンタ
+        self.frames_applied = 0
+        self.rejected_angles = 0
+        self.bytes_received = 0
+        self.writes_received = 0
+        self.applied_log = deque(maxlen=APPLIED_LOG_SIZE)  # 直近の (時刻, seq) を記録（ベンチマーク用）
+        self._task = None
+
+    @staticmethod
+    def _adjusted(servo_id, angle):
+        return _arduino_round(angle * 2.0 / 3.0) if servo_id < 4 else angle
+
+    # --- BLEイベント ---
+
+    def start(self, notify):
+        """接続時に呼ばれる。notify(data) で状態通知を送る"""
+        self.notify = notify
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        self.notify = None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def on_write(self, data):
+        """MyCallbacks::onWrite に相当"""
+        data = bytes(data)
+        self.writes_received += 1
+        self.bytes_received += len(data)
+        if data == encode_clear_frame():
+            self.ring.clear()
+            self.status_dirty = True
+        elif len(data) > 1 and data[0] == FRAME_MAGIC and data[1] in (FRAME_TYPE_BATCH, FRAME_TYPE_DELTA_BATCH):
+            self._process_batch(data)
+        elif len(data) > 1 and data[0] == FRAME_MAGIC and data[1] == FRAME_TYPE_DELTA:
+            self._process_delta(data)
+        elif len(data) > 0 and data[0] == FRAME_MAGIC:
+            self._process_binary(data)
+        elif len(data) > 0:
+            self.process_command(data.decode('utf-8', errors='replace'))
+        self.value = PROTOCOL_CAPS
+
+    @property
+    def encoder_count(self):
+        return self.current_angles[0] * ENCODER_COUNTS_PER_DEGREE
+
+    def read(self):
+        return self.value
+
+    # --- servo6-6.ino の関数 ---
+
+    def move_servo(self, servo_id, angle):
+        if not 0 <= servo_id < 6:
+            return False
+        if not JOINT_MIN_ANGLES[servo_id] <= angle <= JOINT_MAX_ANGLES[servo_id]:
+            self.rejected_angles += 1
+            return False
+        self.servo_outputs[servo_id] = self._adjusted(servo_id, angle)
+        self.current_angles[servo_id] = angle
+        return True
+
+    def process_command(self, command):
+        angles = [_to_int(token) for token in command.split(' ') if token][:6]
+        if len(angles) != 6:
+            return False
+        self._apply(angles, None)
+        return True
+
+    def _apply(self, angles, seq, joints=range(6)):
+        for i, angle in zip(joints, angles):
+            self.move_servo(i, int(angle))
+        self.frames_applied += 1
+        self.applied_log.append((time.perf_counter(), seq))
+        if seq is not None:
+            # ASCIIコマンドでは状態通知しない（ファームウェアと同じ）
+            self.last_seq = seq
+            self.status_dirty = True
+
+    def _process_binary(self, data):
+        if len(data) != ANGLE_FRAME_SIZE or data[1] != FRAME_TYPE_ANGLES:
+            return
+        try:
+            seq, angles = decode_binary_frame(data)
+        except ValueError:
+            return
+        self._apply(angles, seq)
+
+    def _process_delta(self, data):
+        try:
+            seq, joints, angles = decode_delta_frame(data)
+        except ValueError:
+            return
+        # 含まれていない関節は動かさない
+        self._apply(angles, seq, joints)
+
+    def _process_batch(self, data):
+        decode = decode_delta_batch_frames if data[1] == FRAME_TYPE_DELTA_BATCH else decode_batch_frames
+        try:
+            seq, dt_ms, angles = decode(data)
+        except ValueError:
+            return
+        for n in range(len(angles)):
+            if len(self.ring) >= RING_CAPACITY:
+                break
+            if not self.ring:
+                # 再生が止まっていたら先頭フレームはすぐに再生する
+                self.next_due = time.perf_counter()
+            self.ring.append(((seq + n) & 0xFFFF, int(dt_ms[n]), angles[n].tolist()))
+        self.status_dirty = True
+
+    def _play_queued_frames(self):
+        if not self.ring or time.perf_counter() < self.next_due:
+            return
+        seq, _, angles = self.ring.pop(0)
+        if self.ring:
+            self.next_due += self.ring[0][1] / 1000
+        self._apply(angles, seq)
+
+    def _notify_status(self):
+        now = time.perf_counter()
+        if not self.status_dirty or self.notify is None or now - self.last_status < STATUS_INTERVAL:
+            return
+        self.status_dirty = False
+        self.last_status = now
+        self.notify(encode_status(len(self.ring), RING_CAPACITY, self.last_seq))
+
+    def _notify_telemetry(self):
+        now = time.perf_counter()
+        if self.notify is None or PROTOCOL_CAPS_TELEMETRY not in PROTOCOL_CAPS.split():
+            return
+        if now - self.last_telemetry < TELEMETRY_INTERVAL:
+            return
+        self.last_telemetry = now
+        device_ms = int((now - self.boot_time) * 1000)
+        self.notify(encode_telemetry(self.last_seq, device_ms, self.current_angles, self.encoder_count))
+
+    async def _loop(self):
+        """loop() に相当"""
+        while True:
+            self._play_queued_frames()
+            self._notify_status()
+            self._notify_telemetry()
+            await asyncio.sleep(LOOP_PERIOD)
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# 状態を保持する時間（秒）と最大件数
+STATUS_TTL = 3600.0
+STATUS_MAX_ENTRIES = 10000
+
+# バックエンドの選択（環境変数 ROBOTARM_STATUS_STORE = "memory" / "sqlite"）
+DEFAULT_BACKEND = "memory"
+DEFAULT_SQLITE_PATH = "action_status.db"
+
+
+def new_action_id():
+    """衝突しないaction_idを発行する"""
+    return uuid.uuid4().hex
+
+
+class MemoryStatusStore:
+    """プロセス内の状態ストア。TTLを過ぎたものと、最大件数を超えた更新の古いものを捨てる"""
+
+    def __init__(self, ttl=STATUS_TTL, max_entries=STATUS_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # action_id: (status, updated_at)
+
+    def set(self, action_id, status):
+        self._entries[action_id] = (status, time.time())
+        self._entries.move_to_end(action_id)
+        self._evict()
+
+    def get(self, action_id):
+        entry = self._entries.get(action_id)
+        if entry is None:
+            return None
+        status, updated_at = entry
+        if time.time() - updated_at > self.ttl:
+            del self._entries[action_id]
+            return None
+        # 読んでも並び順は変えない（_evict は更新順に並んでいることを前提に先頭から期限切れを捨てる）
+        return status
+
+    async def get_async(self, action_id):
+        # メモリ上の参照だけでブロックしないので、そのまま返す
+        return self.get(action_id)
+
+    def flush(self):
+        # 書き込みはその場で終わっている
+        pass
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        # 先頭から期限切れを捨てる（更新順に並んでいる）
+        now = time.time()
+        while self._entries:
+            action_id, (_, updated_at) = next(iter(self._entries.items()))
+            if now - updated_at <= self.ttl:
+                break
+            del self._entries[action_id]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStatusStore:
+    """ローカルSQLiteの状態ストア。再起動後も残り、複数のuvicornワーカーで共有できる
+
+    データベースがロックされていると書き込みは busy timeout まで待つので、イベントループを止めないよう
+    set() は書き込み用のスレッドに渡すだけにする（更新順はそのまま）。API からは get_async() で読む。
+    """
+
+    # 掃除（期限切れ・件数超過の削除）を何回の書き込みごとに行うか
+    PURGE_EVERY = 100
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH, ttl=STATUS_TTL, max_entries=STATUS_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS action_status ("
+            "action_id TEXT PRIMARY KEY, status TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS action_status_updated_at ON action_status (updated_at)"
+        )
+        # まだ書き込んでいない状態（書き込み前に読まれても最新を返す）。書き込み中も set() が待たないよう
+        # データベースとは別のロックで守る
+        self._unwritten = {}
+        self._unwritten_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="status-store-writer", daemon=True)
+        self._writer.start()
+
+    def set(self, action_id, status):
+        with self._unwritten_lock:
+            self._unwritten[action_id] = status
+        self._queue.put((action_id, status, time.time()))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                action_id, status, updated_at = item
+                with self._lock:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO action_status (action_id, status, updated_at) VALUES (?, ?, ?)",
+                        (action_id, status, updated_at),
+                    )
+                    self._writes += 1
+                    if self._writes % self.PURGE_EVERY == 0:
+                        self._purge()
+            except sqlite3.Error as e:
+                print(f"[STATUS] 状態の書き込みに失敗しました: {e}")
+            finally:
+                if item is not None:
+                    with self._unwritten_lock:
+                        if self._unwritten.get(item[0]) == item[1]:
+                            del self._unwritten[item[0]]
+                self._queue.task_done()
+
+    def flush(self):
+        """書き込み待ちの状態をすべて書き込むまで待つ"""
+        self._queue.join()
+
+    def get(self, action_id):
+        with self._unwritten_lock:
+            status = self._unwritten.get(action_id)
+        if status is not None:
+            return status
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status FROM action_status WHERE action_id = ? AND updated_at >= ?",
+                (action_id, time.time() - self.ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    async def get_async(self, action_id):
+        return await asyncio.to_thread(self.get, action_id)
+
+    def _purge(self):
+        self._conn.execute("DELETE FROM action_status WHERE updated_at < ?", (time.time() - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM action_status WHERE action_id IN ("
+            "SELECT action_id FROM action_status ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def __len__(self):
+        self.flush()
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM action_status").fetchone()[0]
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self._conn.close()
+
+
+def create_status_store(backend=None, **kwargs):
+    """設定（引数または環境変数）に応じて状態ストアを作る"""
+    backend = backend or os.environ.get("ROBOTARM_STATUS_STORE", DEFAULT_BACKEND)
+    if backend == "memory":
+        return MemoryStatusStore(**kwargs)
+    if backend == "sqlite":
+        path = kwargs.pop("path", os.environ.get("ROBOTARM_STATUS_DB", DEFAULT_SQLITE_PATH))
+        return SQLiteStatusStore(path, **kwargs)
+    raise ValueError(f"未対応の状態ストアです: {backend}")
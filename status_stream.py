@@ -0,0 +1,70 @@
+import asyncio
+import json
+from collections import defaultdict
+
+# 終了状態（これを送ったらストリームを閉じる）
+TERMINAL_STATUSES = ("done", "cancelled", "error")
+# 無通信時に送るキープアライブの間隔（秒）
+KEEPALIVE_INTERVAL = 15.0
+
+
+class StatusBroadcaster:
+    """action_id ごとの購読者に状態スナップショットをプッシュする
+
+    購読者ごとのキューは長さ1で、遅い購読者には最新のスナップショットだけが残る
+    （各イベントは状態全体を含むので、途中を捨てても最終状態は必ず届く）。
+    """
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, action_id):
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers[action_id].add(queue)
+        return queue
+
+    def unsubscribe(self, action_id, queue):
+        queues = self._subscribers.get(action_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[action_id]
+
+    def publish(self, action_id, event):
+        for queue in self._subscribers.get(action_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+def is_terminal(status):
+    return status.split(":", 1)[0] in TERMINAL_STATUSES
+
+
+def format_sse(event):
+    """Server-Sent Events の data 行にする"""
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+async def sse_events(broadcaster, action_id, snapshot, is_disconnected=None):
+    """現在のスナップショットを送り、以降は変化をプッシュする。終了状態を送ったら閉じる
+
+    snapshot() は現在の状態を返すコルーチン関数（状態ストアを読むのでイベントループを止めないように）。action_id がまだ登録されていなくても待ち続ける
+    （フロントエンドが /action より先に購読を始めることがあるため）。
+    """
+    queue = broadcaster.subscribe(action_id)
+    try:
+        event = await snapshot()
+        yield format_sse(event)
+        while not is_terminal(event["status"]):
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                if is_disconnected is not None and await is_disconnected():
+                    break
+                yield ": keepalive\n\n"
+                continue
+            yield format_sse(event)
+    finally:
+        broadcaster.unsubscribe(action_id, queue)
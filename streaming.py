@@ -0,0 +1,369 @@
+import asyncio
+import time
+from collections import deque
+import numpy as np
+from protocol import (
+    FRAME_TYPE_DELTA,
+    PROTOCOL_ASCII,
+    batch_capacity,
+    decode_status,
+    encode_batch_frames,
+    encode_delta_batch_frames,
+    encode_delta_frame,
+    encode_delta_frames,
+    encode_frames,
+    is_status_packet,
+)
+from metrics import (
+    BLE_WRITE_BYTES,
+    BLE_WRITE_FAILURES,
+    BLE_WRITE_SECONDS,
+    FRAMES_DEDUPLICATED,
+    FRAMES_SENT,
+    FRAMES_SKIPPED,
+    SEND_LATENESS_SECONDS,
+    log_event,
+)
+
+# ファームウェアのリングバッファ容量（servo6-6.ino の RING_CAPACITY と合わせる）
+DEVICE_RING_CAPACITY = 64
+# MTUが取得できない場合の既定値（ESP32側で setMTU(247) している）
+DEFAULT_MTU = 247
+# 状態通知が途絶えたとみなすまでの余裕時間（秒）
+STATUS_TIMEOUT = 1.0
+# 1フレームずつ送る経路で、書き込みが続けて失敗してよい回数（超えたら送信を諦めて例外を上げる）
+MAX_WRITE_RETRIES = 3
+# 送信タイミングの p95 を求めるために残す直近のフレーム数
+JITTER_WINDOW = 4096
+
+
+def get_mtu(client):
+    """接続済みクライアントのMTUを返す（取得できなければ既定値）"""
+    mtu = getattr(client, 'mtu_size', None)
+    return mtu if mtu else DEFAULT_MTU
+
+
+def can_send_batched(client):
+    """現在のMTUでバッチ送信（2フレーム以上/書き込み）が意味を持つか"""
+    return batch_capacity(get_mtu(client)) >= 2
+
+
+async def timed_write(client, characteristic_uuid, data, kind, frames=1, response=None):
+    """書き込みを1回行い、所要時間・バイト数・フレーム数・失敗をメトリクスに記録する"""
+    start = time.perf_counter()
+    try:
+        if response is None:
+            await client.write_gatt_char(characteristic_uuid, data)
+        else:
+            await client.write_gatt_char(characteristic_uuid, data, response=response)
+    except Exception:
+        BLE_WRITE_FAILURES.labels(kind=kind).inc()
+        raise
+    BLE_WRITE_SECONDS.labels(kind=kind).observe(time.perf_counter() - start)
+    BLE_WRITE_BYTES.labels(kind=kind).inc(len(data))
+    FRAMES_SENT.inc(frames)
+
+
+def encode_batches(client, trajectory, interval_ms, start_seq=0, delta=False, capacity=DEVICE_RING_CAPACITY):
+    """MTUに合わせてバッチを作る。delta=True（DLT1対応）なら変わった関節だけを送る差分バッチ
+
+    1バッチはデバイスのリングバッファ容量 capacity 以下のフレーム数にする（超えると受け取れない）。
+    """
+    if delta:
+        # 止まっている区間は1フレーム3バイトなので、MTUより先にリングバッファの容量で区切られる
+        return (encode_delta_batch_frames(trajectory, interval_ms, get_mtu(client), start_seq,
+                                          max_frames=capacity), "delta_batch")
+    return encode_batch_frames(trajectory, interval_ms, get_mtu(client), start_seq), "batch"
+
+
+class FrameEncoder:
+    """1フレームずつ送る経路で、直前に送った姿勢と同じフレームを省き、差分フレームに置き換える
+
+    フレームは先にまとめてエンコードしておき、送信時にはどれを送るか選ぶだけにする。
+    差分フレームは「1つ前のフレーム」との差なので、PacedScheduler が遅れてフレームを
+    飛ばした直後は、デバイスの姿勢と1つ前のフレームが一致しないことがある。
+    そのときは全関節のフレームを送る。
+    """
+
+    def __init__(self, trajectory, protocol, start_seq=0, delta=False):
+        self.angles = np.asarray(trajectory).reshape(-1, 6)
+        self.protocol = protocol
+        self.start_seq = start_seq
+        self.frames = encode_frames(self.angles, protocol, start_seq)
+        self.deltas = encode_delta_frames(self.angles, start_seq) if delta and protocol != PROTOCOL_ASCII else None
+        self._unchanged = np.zeros(len(self.angles), dtype=bool)
+        self._unchanged[1:] = np.all(self.angles[1:] == self.angles[:-1], axis=1)
+        # デバイスが今その姿勢にいるフレーム番号
+        self._applied = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def reset(self):
+        """デバイスの姿勢が分からなくなったとき（同じ軌道をもう一度送る、書き込みに失敗した）に呼ぶ
+
+        次に送るフレームは直前と同じでも省かず、全関節を送る。
+        """
+        self._applied = None
+
+    def frame(self, i):
+        """i番目のフレームの送信時に書き込むバイト列。送らなくてよければ None"""
+        previous, self._applied = self._applied, i
+        if previous is None:
+            return self.frames[i]
+        consecutive = previous == i - 1
+        if self._unchanged[i] if consecutive else np.array_equal(self.angles[previous], self.angles[i]):
+            if i < len(self.frames) - 1:
+                FRAMES_DEDUPLICATED.inc()
+                return None
+            # 最後のフレームは送る（差分ならシーケンス番号だけ進め、完了をテレメトリで確認できるようにする）
+            if self.deltas is not None:
+                return encode_delta_frame(self.angles[i], 0, self.start_seq + i)
+            return self.frames[i]
+        if consecutive and self.deltas is not None:
+            return self.deltas[i]
+        return self.frames[i]
+
+
+async def send_paced_frames(client, characteristic_uuid, encoder, scheduler, kind, on_sent=None,
+                            retries=MAX_WRITE_RETRIES):
+    """FrameEncoder のフレームを scheduler の締め切りどおりに1つずつ書き込む
+
+    書き込みに失敗したフレームは送り直さず、次の締め切りでその時点のフレームを全関節で送る
+    （失敗したフレームを溜めて後から流すと、古い姿勢を順に再生し直すことになる）。
+    最後のフレームだけは届くまで送り直す。続けて retries 回を超えて失敗したら例外を上げる。
+    on_sent(i, frame) は送ったフレームごと（省いたフレームは frame=None）に呼ぶ。
+    """
+    failures = 0
+    last = len(encoder) - 1
+
+    async def send(i, _):
+        nonlocal failures
+        frame = encoder.frame(i)
+        while frame is not None:
+            try:
+                await timed_write(client, characteristic_uuid, frame,
+                                  "delta" if frame[1] == FRAME_TYPE_DELTA else kind)
+                failures = 0
+                break
+            except Exception as e:
+                failures += 1
+                if failures > retries:
+                    raise
+                log_event("write_retry", seq=(encoder.start_seq + i) & 0xFFFF, attempt=failures, error=repr(e))
+                encoder.reset()
+                if i < last:
+                    return
+                await asyncio.sleep(scheduler.interval)
+                frame = encoder.frame(i)
+        if on_sent:
+            on_sent(i, frame)
+
+    return await scheduler.run(encoder.frames, send)
+
+
+async def send_trajectory_batched(client, characteristic_uuid, trajectory, interval_ms,
+                                  start_seq=0, capacity=DEVICE_RING_CAPACITY, on_progress=None, delta=False):
+    """軌道をMTUサイズのバッチにまとめて送信し、再生はファームウェアのタイマーに任せる
+
+    デバイスのリングバッファがあふれないよう、再生済みと見込まれるフレーム数から
+    送信を待つ。戻るのは最後のフレームが再生される見込み時刻。
+    on_progress(i) には再生済みと見込まれるフレーム番号を渡す。
+    """
+    batches, kind = encode_batches(client, trajectory, interval_ms, start_seq, delta, capacity)
+    loop = asyncio.get_running_loop()
+    interval = interval_ms / 1000
+    started = None
+    sent = 0
+    for batch in batches:
+        count = batch[4]
+        if started is not None:
+            # 先頭フレームは受信と同時に再生されるので +1
+            played = int((loop.time() - started) / interval) + 1
+            wait = (sent + count - capacity - played) * interval
+            if wait > 0:
+                await asyncio.sleep(wait)
+        await timed_write(client, characteristic_uuid, batch, kind, count)
+        if started is None:
+            started = loop.time()
+        sent += count
+        if on_progress:
+            on_progress(min(sent, int((loop.time() - started) / interval) + 1) - 1)
+    # 最後のフレームの再生まで待つ
+    if started is not None:
+        remaining = started + (sent - 1) * interval - loop.time()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        if on_progress:
+            on_progress(sent - 1)
+    return len(batches)
+
+
+class FlowController:
+    """ファームウェアの状態通知（再生済みseq・バッファ使用数）からクレジットを計算する"""
+
+    def __init__(self, capacity=DEVICE_RING_CAPACITY):
+        self.capacity = capacity
+        self.fill = 0
+        self.last_seq = None
+        self.start_seq = 0
+        self.next_seq = 0
+        self._updated = asyncio.Event()
+
+    def reset(self, start_seq):
+        """送信開始時に、start_seq より前は再生済みとみなす"""
+        self.start_seq = start_seq & 0xFFFF
+        self.next_seq = start_seq & 0xFFFF
+        self.last_seq = (start_seq - 1) & 0xFFFF
+
+    def handle_notification(self, sender, data):
+        """通知ハンドラ。状態通知なら処理して True を返す"""
+        if not is_status_packet(data):
+            return False
+        try:
+            self.fill, self.capacity, self.last_seq = decode_status(data)
+        except ValueError as e:
+            print(f"[BLE] 状態通知エラー: {e}")
+            return True
+        self._updated.set()
+        return True
+
+    @property
+    def played(self):
+        """reset() 以降に再生されたフレーム数"""
+        if self.last_seq is None:
+            return 0
+        return (self.last_seq - self.start_seq + 1) & 0xFFFF
+
+    def sent(self, count):
+        self.next_seq = (self.next_seq + count) & 0xFFFF
+
+    @property
+    def outstanding(self):
+        """送信済みで未再生のフレーム数（転送中 + バッファ内）"""
+        if self.last_seq is None:
+            return 0
+        return (self.next_seq - self.last_seq - 1) & 0xFFFF
+
+    @property
+    def credits(self):
+        return self.capacity - self.outstanding
+
+    async def wait_update(self, timeout):
+        """前回の待ち以降に状態通知が届くまで待つ"""
+        try:
+            await asyncio.wait_for(self._updated.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError("ESP32からの状態通知が届きません")
+        self._updated.clear()
+
+
+async def send_trajectory_flow_controlled(client, characteristic_uuid, trajectory, interval_ms,
+                                          flow, start_seq=0, on_progress=None, delta=False):
+    """応答なし書き込みでバッチを送り、状態通知のクレジットの範囲でだけ先送りする
+
+    書き込みの往復を待たないので、送信レートは接続間隔ではなくバッファの空きで決まる。
+    戻るのは最後のフレームの再生が通知された時点。on_progress(i) には再生済みのフレーム番号を渡す。
+    """
+    batches, kind = encode_batches(client, trajectory, interval_ms, start_seq, delta, flow.capacity)
+    flow.reset(start_seq)
+    # バッファ1周分の再生時間 + 余裕を通知のタイムアウトにする
+    timeout = flow.capacity * interval_ms / 1000 + STATUS_TIMEOUT
+    for batch in batches:
+        count = batch[4]
+        while flow.credits < count:
+            await flow.wait_update(timeout)
+            if on_progress and flow.played:
+                on_progress(flow.played - 1)
+        await timed_write(client, characteristic_uuid, batch, kind, count, response=False)
+        flow.sent(count)
+    while flow.outstanding > 0:
+        await flow.wait_update(timeout)
+        if on_progress and flow.played:
+            on_progress(flow.played - 1)
+    return len(batches)
+
+
+class JitterStats:
+    """送信時刻と締め切りのずれ（ジッタ）を記録する
+
+    件数・平均・最大は全フレームで集計し、p95 は直近 window フレームから求める
+    （無限に繰り返す送信でもメモリが増えないように）。
+    """
+
+    def __init__(self, window=JITTER_WINDOW):
+        self.lateness = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.skipped = 0
+
+    def record(self, lateness):
+        self.lateness.append(lateness)
+        self.count += 1
+        self.total += lateness
+        self.max = lateness if self.count == 1 else max(self.max, lateness)
+        SEND_LATENESS_SECONDS.observe(lateness)
+
+    def summary(self):
+        """ミリ秒単位の統計を返す"""
+        if not self.count:
+            return {"frames": 0, "skipped": self.skipped}
+        return {
+            "frames": self.count,
+            "skipped": self.skipped,
+            "mean_ms": round(self.total / self.count * 1000, 3),
+            "p95_ms": round(float(np.percentile(np.asarray(self.lateness), 95)) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class PacedScheduler:
+    """loop.time() の絶対時刻を締め切りとしてフレームを等間隔に送る
+
+    「書き込み + sleep」と違い、書き込みにかかった時間が周期に足されないので、
+    長いシーケンスや繰り返しでも遅れが積み重ならない。遅れて複数の締め切りを
+    過ぎた場合は、過ぎたフレームを飛ばして最新の1フレームにまとめる（角度は
+    絶対値なので最新だけ送れば追いつく）。最後のフレームは必ず送る。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stats = JitterStats()
+        self._next = None
+
+    def reset(self):
+        self._next = None
+
+    def delay(self, seconds):
+        """次のフレームの締め切りを seconds だけ後ろにずらす（シーケンス間の待ち）"""
+        if self._next is not None:
+            self._next += seconds
+
+    async def run(self, frames, send, start_at=None):
+        """frames を順に send(i, frame) で送る。start_at を渡すとその時刻から開始する"""
+        loop = asyncio.get_running_loop()
+        if start_at is not None:
+            self._next = start_at
+        elif self._next is None:
+            self._next = loop.time()
+        i = 0
+        n = len(frames)
+        while i < n:
+            now = loop.time()
+            if now < self._next:
+                await asyncio.sleep(self._next - now)
+                now = loop.time()
+            behind = int((now - self._next) / self.interval)
+            if behind > 0:
+                # 締め切りを過ぎたフレームは飛ばして最新にまとめる
+                skip = min(behind, n - 1 - i)
+                i += skip
+                self._next += skip * self.interval
+                self.stats.skipped += skip
+                FRAMES_SKIPPED.inc(skip)
+            self.stats.record(now - self._next)
+            await send(i, frames[i])
+            i += 1
+            self._next += self.interval
+        return self.stats
@@ -0,0 +1,122 @@
+import time
+import numpy as np
+from protocol import is_telemetry_packet, decode_telemetry
+
+# 保持するテレメトリのサンプル数（50msごとなら約3分半）
+TELEMETRY_CAPACITY = 4096
+# これより古いテレメトリは現在の姿勢として使わない（秒）
+TELEMETRY_MAX_AGE = 0.5
+
+TELEMETRY_SAMPLE_DTYPE = np.dtype([
+    ("host_time", "<f8"),  # 受信時刻（time.perf_counter）
+    ("device_ms", "<u4"),  # デバイスの millis()
+    ("seq", "<u2"),  # 最後に適用したフレームのシーケンス番号
+    ("angles", "<i2", (6,)),  # 各サーボの現在角度
+    ("encoder", "<i4"),  # エンコーダのカウント
+    ("latency", "<f4"),  # 追従遅れ（秒）。新しいフレームが適用されたサンプルだけ、それ以外はNaN
+])
+
+
+class TelemetryBuffer:
+    """ファームウェアからのテレメトリ通知を固定長のリングバッファに貯める
+
+    追従遅れは「フレームを再生する予定だったホスト時刻」から「そのフレームの適用が
+    テレメトリで報告された時刻」までの時間（送信・再生待ち・通知間隔をすべて含む）。
+    """
+
+    def __init__(self, capacity=TELEMETRY_CAPACITY):
+        self.capacity = capacity
+        self.samples = np.zeros(capacity, dtype=TELEMETRY_SAMPLE_DTYPE)
+        self.count = 0  # これまでに受信したサンプル数
+        self.errors = 0
+        # シーケンス番号 → 再生予定時刻
+        self._planned = np.full(0x10000, np.nan)
+
+    def schedule(self, start_seq, count, start_time, interval):
+        """start_seq から count フレームを start_time から interval ごとに再生する予定を記録する"""
+        seqs = (start_seq + np.arange(count)) & 0xFFFF
+        self._planned[seqs] = start_time + np.arange(count) * interval
+
+    def handle_notification(self, sender, data):
+        """通知を受け取る。テレメトリなら記録して True を返す"""
+        if not is_telemetry_packet(data):
+            return False
+        try:
+            seq, device_ms, angles, encoder = decode_telemetry(data)
+        except ValueError:
+            self.errors += 1
+            return True
+        self.record(seq, device_ms, angles, encoder)
+        return True
+
+    def record(self, seq, device_ms, angles, encoder, host_time=None):
+        host_time = time.perf_counter() if host_time is None else host_time
+        latency = np.nan
+        if self.count == 0 or self.latest()["seq"] != seq:
+            # 新しいフレームが適用されたときだけ遅れを測る（同じseqの報告が続く間は数えない）
+            latency = host_time - self._planned[seq]
+            self._planned[seq] = np.nan
+        self.samples[self.count % self.capacity] = (host_time, device_ms, seq, angles, encoder, latency)
+        self.count += 1
+
+    def latest(self):
+        if self.count == 0:
+            return None
+        return self.samples[(self.count - 1) % self.capacity]
+
+    def recent(self, n=None):
+        """直近 n 件のサンプルを古い順に並べたコピーを返す"""
+        size = min(self.count, self.capacity)
+        n = size if n is None else min(n, size)
+        end = self.count % self.capacity
+        idx = (np.arange(end - n, end)) % self.capacity
+        return self.samples[idx]
+
+    def current_pose(self, max_age=TELEMETRY_MAX_AGE):
+        """最近のテレメトリで報告された (seq, 角度)。古ければ None"""
+        latest = self.latest()
+        if latest is None or time.perf_counter() - latest["host_time"] > max_age:
+            return None
+        return int(latest["seq"]), latest["angles"].copy()
+
+    def pose_since(self, host_time):
+        """host_time（time.perf_counter）より後に受信したテレメトリの (seq, 角度)。まだ無ければ None"""
+        latest = self.latest()
+        if latest is None or latest["host_time"] < host_time:
+            return None
+        return int(latest["seq"]), latest["angles"].copy()
+
+    def summary(self, limit=100):
+        """APIで返す形（最新のサンプル、直近のサンプル、追従遅れの統計）"""
+        samples = self.recent(limit)
+        latency = self.recent()["latency"]
+        latency = latency[~np.isnan(latency)] * 1000
+        rate = 0.0
+        if len(samples) > 1:
+            span = samples["host_time"][-1] - samples["host_time"][0]
+            rate = (len(samples) - 1) / span if span > 0 else 0.0
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "rate_hz": rate,
+            "latest": _sample_dict(self.latest()) if self.count else None,
+            "samples": [_sample_dict(s) for s in samples],
+            "latency_ms": {
+                "count": int(len(latency)),
+                "p50": float(np.percentile(latency, 50)) if len(latency) else None,
+                "p95": float(np.percentile(latency, 95)) if len(latency) else None,
+                "max": float(latency.max()) if len(latency) else None,
+            },
+        }
+
+
+def _sample_dict(sample):
+    latency = float(sample["latency"])
+    return {
+        "host_time": float(sample["host_time"]),
+        "device_ms": int(sample["device_ms"]),
+        "seq": int(sample["seq"]),
+        "angles": sample["angles"].tolist(),
+        "encoder": int(sample["encoder"]),
+        "latency_ms": None if np.isnan(latency) else latency * 1000,
+    }
@@ -0,0 +1,87 @@
+import json
+import os
+from functools import lru_cache
+import numpy as np
+
+# 関節数（サーボ6個）
+NUM_JOINTS = 6
+
+# 各サーボの稼働範囲（servo6-6.ino の minAngles / maxAngles と同じ）
+JOINT_MIN_ANGLES = np.array([0, 30, 30, 30, 0, 0])
+JOINT_MAX_ANGLES = np.array([270, 240, 240, 240, 180, 180])
+
+
+def compile_waypoints(waypoints, min_step):
+    """経由点の列を最小ステップで補間し、(steps, 6) のint16配列を1回のベクトル演算で生成する
+
+    先頭の経由点をそのまま1行目に置き、以降は各区間の補間結果（区間の始点を除く）を連結する。
+    区間の始点から終点へ t = i/steps で線形補間し、0方向に切り捨てた値になる。
+    """
+    wp = np.asarray(waypoints, dtype=np.float64).reshape(-1, NUM_JOINTS)
+    if len(wp) == 0:
+        return np.empty((0, NUM_JOINTS), dtype=np.int16)
+    start = wp[:-1]
+    delta = np.diff(wp, axis=0)
+    # 各区間のステップ数（最大の角度差を最小ステップで分割）
+    steps = np.maximum(1, np.ceil(np.abs(delta).max(axis=1, initial=0) / min_step).astype(np.int64))
+    seg = np.repeat(np.arange(len(steps)), steps)
+    offsets = np.cumsum(steps) - steps
+    i = np.arange(int(steps.sum())) - offsets[seg] + 1
+    t = i / steps[seg]
+    out = np.empty((len(seg) + 1, NUM_JOINTS), dtype=np.int16)
+    out[0] = wp[0]
+    # int() と同じく0方向への切り捨て
+    out[1:] = np.trunc(start[seg] + delta[seg] * t[:, None])
+    return out
+
+
+def compile_last_segment_start(waypoints, min_step):
+    """compile_waypoints(waypoints, min_step) の軌道で、最後の区間に入る最初のフレーム番号
+
+    その前までのフレームは最後から2番目の経由点まで（その経由点自体を含む）。
+    """
+    wp = np.asarray(waypoints, dtype=np.float64).reshape(-1, NUM_JOINTS)
+    if len(wp) < 2:
+        return len(wp)
+    steps = np.maximum(1, np.ceil(np.abs(np.diff(wp, axis=0)).max(axis=1) / min_step).astype(np.int64))
+    return int(steps[:-1].sum()) + 1
+
+
+def compile_sequence(action_sequence, min_step, init_position, start_position=None):
+    """初期位置→動作→初期位置の全軌道を生成する（start_position があればそこから開始）"""
+    start = init_position if start_position is None else start_position
+    return compile_waypoints([start] + list(action_sequence) + [init_position], min_step)
+
+
+def validate_actions(action_data):
+    """アクション定義を検証する（各経由点が6関節で、稼働範囲内か）。問題はまとめて ValueError で報告する"""
+    if not isinstance(action_data, dict):
+        raise ValueError("アクション定義はアクション名をキーにしたオブジェクトである必要があります")
+    errors = []
+    for name, action in action_data.items():
+        sequence = action.get("sequence") if isinstance(action, dict) else None
+        if not isinstance(sequence, list) or not sequence:
+            errors.append(f"{name}: sequence がありません")
+            continue
+        for i, angles in enumerate(sequence):
+            if (not isinstance(angles, list) or len(angles) != NUM_JOINTS
+                    or not all(isinstance(a, (int, float)) and not isinstance(a, bool) for a in angles)):
+                errors.append(f"{name}[{i}]: {NUM_JOINTS}個の角度ではありません: {angles}")
+                continue
+            a = np.asarray(angles)
+            out_of_range = np.flatnonzero((a < JOINT_MIN_ANGLES) | (a > JOINT_MAX_ANGLES))
+            if out_of_range.size:
+                errors.append(f"{name}[{i}]: サーボ{out_of_range.tolist()}の角度が稼働範囲外です: {angles}")
+    if errors:
+        raise ValueError("アクション定義が不正です:\n" + "\n".join(errors))
+
+
+@lru_cache(maxsize=8)
+def _load_actions(path, mtime_ns):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_actions(path="robotaction.json"):
+    """アクション定義を読み込む（ファイル更新時刻が変わるまではキャッシュを返す）"""
+    return _load_actions(path, os.stat(path).st_mtime_ns)
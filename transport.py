@@ -0,0 +1,162 @@
+import asyncio
+import os
+import random
+from bleak import BleakClient, BleakScanner
+from bleak.exc import BleakError
+from simulated_esp32 import SimulatedESP32
+
+# トランスポートの選択（環境変数 ROBOTARM_TRANSPORT = "ble" / "sim"）
+DEFAULT_TRANSPORT = "ble"
+
+# シミュレーションの既定値
+SIM_CONNECTION_INTERVAL = 0.0075  # 接続間隔（秒）
+SIM_MTU = 247
+SIM_WRITE_LATENCY = 0.0  # 書き込みがESP32に届くまでの追加の遅延（秒）
+SIM_PACKETS_PER_EVENT = 4  # 1回の接続イベントで送れる応答なし書き込みの数
+SIM_CONNECT_TIME = 0.05  # 接続にかかる時間（秒）
+SIM_WRITE_FAILURE_RATE = 0.0  # 書き込みが失敗する確率（再試行・再同期の確認用）
+
+# 接続・電波状況による一時的なエラー（再接続して送り直せば直るもの）。これ以外は送り直さない
+TRANSPORT_ERRORS = (BleakError, asyncio.TimeoutError, ConnectionError)
+
+
+class BLETransport:
+    """bleak を使う実機用のトランスポート"""
+
+    async def find_device(self, name):
+        return await BleakScanner.find_device_by_name(name)
+
+    async def find_device_by_address(self, address):
+        return await BleakScanner.find_device_by_address(address)
+
+    def create_client(self, device, disconnected_callback=None):
+        return BleakClient(device, disconnected_callback=disconnected_callback)
+
+
+class SimulatedClient:
+    """SimulatedESP32 につながる BleakClient 互換のクライアント
+
+    書き込みは接続間隔単位で直列化する。応答ありの書き込みは往復で2接続間隔、
+    応答なしの書き込みは1接続間隔に SIM_PACKETS_PER_EVENT 個まで送れる。
+    """
+
+    def __init__(self, device, disconnected_callback=None, connection_interval=SIM_CONNECTION_INTERVAL,
+                 mtu=SIM_MTU, write_latency=SIM_WRITE_LATENCY, packets_per_event=SIM_PACKETS_PER_EVENT,
+                 write_failure_rate=SIM_WRITE_FAILURE_RATE):
+        self.device = device
+        self.address = device.address
+        self.disconnected_callback = disconnected_callback
+        self.connection_interval = connection_interval
+        self.mtu_size = mtu
+        self.write_latency = write_latency
+        self.packets_per_event = packets_per_event
+        self.write_failure_rate = write_failure_rate
+        self.is_connected = False
+        self._link = asyncio.Lock()
+        self._notify_callbacks = []
+
+    async def connect(self):
+        await asyncio.sleep(SIM_CONNECT_TIME)
+        self.is_connected = True
+        self.device.start(self._on_device_notify)
+        return True
+
+    async def disconnect(self):
+        if not self.is_connected:
+            return True
+        self.is_connected = False
+        await self.device.stop()
+        if self.disconnected_callback:
+            self.disconnected_callback(self)
+        return True
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+    def _check_connected(self):
+        if not self.is_connected:
+            raise ConnectionError("シミュレーションデバイスに接続されていません")
+
+    async def write_gatt_char(self, characteristic_uuid, data, response=None):
+        self._check_connected()
+        if len(data) > self.mtu_size - 3:
+            raise ValueError(f"書き込みがMTUを超えています（{len(data)} > {self.mtu_size - 3}）")
+        # bleak と同じく response を省略したら応答ありとして扱う
+        acknowledged = response is None or response
+        air_time = self.connection_interval * 2 if acknowledged else self.connection_interval / self.packets_per_event
+        async with self._link:
+            await asyncio.sleep(air_time)
+        if self.write_failure_rate and random.random() < self.write_failure_rate:
+            # 電波状況などで届かなかった書き込み（デバイスには何も届かない）
+            raise ConnectionError("シミュレーション: 書き込みに失敗しました")
+        if self.write_latency:
+            await asyncio.sleep(self.write_latency)
+        self.device.on_write(data)
+
+    async def read_gatt_char(self, characteristic_uuid):
+        self._check_connected()
+        async with self._link:
+            await asyncio.sleep(self.connection_interval * 2)
+        return bytearray(self.device.read())
+
+    async def start_notify(self, characteristic_uuid, callback):
+        self._notify_callbacks.append(callback)
+
+    async def stop_notify(self, characteristic_uuid):
+        self._notify_callbacks.clear()
+
+    def _on_device_notify(self, data):
+        for callback in list(self._notify_callbacks):
+            result = callback(None, bytearray(data))
+            if asyncio.iscoroutine(result):
+                asyncio.ensure_future(result)
+
+
+class SimulatedTransport:
+    """ハードウェアなしで動くシミュレーション用のトランスポート"""
+
+    def __init__(self, connection_interval=SIM_CONNECTION_INTERVAL, mtu=SIM_MTU,
+                 write_latency=SIM_WRITE_LATENCY, packets_per_event=SIM_PACKETS_PER_EVENT,
+                 write_failure_rate=SIM_WRITE_FAILURE_RATE):
+        self.connection_interval = connection_interval
+        self.mtu = mtu
+        self.write_latency = write_latency
+        self.packets_per_event = packets_per_event
+        self.write_failure_rate = write_failure_rate
+        self.devices = {}
+
+    async def find_device(self, name):
+        if name not in self.devices:
+            self.devices[name] = SimulatedESP32(name)
+        return self.devices[name]
+
+    async def find_device_by_address(self, address):
+        # アドレスを指定されたら、そのアドレスのデバイスがあるものとして作る
+        for device in self.devices.values():
+            if device.address == address:
+                return device
+        self.devices[address] = SimulatedESP32(f"ESP32 BLE Device {address}", address)
+        return self.devices[address]
+
+    def create_client(self, device, disconnected_callback=None):
+        return SimulatedClient(device, disconnected_callback, self.connection_interval, self.mtu,
+                               self.write_latency, self.packets_per_event, self.write_failure_rate)
+
+
+def get_transport(kind=None):
+    """設定（引数または環境変数）に応じたトランスポートを返す"""
+    kind = kind or os.environ.get("ROBOTARM_TRANSPORT", DEFAULT_TRANSPORT)
+    if kind == "ble":
+        return BLETransport()
+    if kind == "sim":
+        return SimulatedTransport(
+            connection_interval=float(os.environ.get("ROBOTARM_SIM_CONNECTION_INTERVAL", SIM_CONNECTION_INTERVAL)),
+            mtu=int(os.environ.get("ROBOTARM_SIM_MTU", SIM_MTU)),
+            write_latency=float(os.environ.get("ROBOTARM_SIM_WRITE_LATENCY", SIM_WRITE_LATENCY)),
+            write_failure_rate=float(os.environ.get("ROBOTARM_SIM_WRITE_FAILURE_RATE", SIM_WRITE_FAILURE_RATE)),
+        )
+    raise ValueError(f"未対応のトランスポートです: {kind}")